@@ -1,4 +1,10 @@
 import logging
+import mmap
+import os
+import socket
+import ssl
+import time
+from collections import deque
 from proxy.http.proxy import HttpProxyBasePlugin
 from proxy.http import httpHeaders
 import gzip
@@ -8,15 +14,38 @@ from proxy.common.utils import build_http_response
 from ontologytimemachine.utils.mock_responses import (
     mock_response_403,
     mock_response_500,
+    mock_response_503,
 )
 from ontologytimemachine.proxy_wrapper import HttpRequestWrapper
+from ontologytimemachine.utils import admission, fetch_pool
+from ontologytimemachine.utils.fetch_pool import FetchPoolFull, configure_fetch_pool
+from ontologytimemachine.utils.upstream import configure_upstream
+from ontologytimemachine.utils import streaming
+from ontologytimemachine.utils.streaming import (
+    END_OF_STREAM,
+    STREAM_CHUNK_SIZE,
+    ResponseStream,
+    configure_streaming,
+    is_file_backed,
+    is_streamed,
+)
+from ontologytimemachine.utils.utils import strip_transfer_headers
 from ontologytimemachine.utils.proxy_logic import (
     get_response_from_request,
+    get_response_from_intercepted_request,
     do_block_CONNECT_request,
     is_archivo_ontology_request,
     evaluate_configuration,
 )
 from ontologytimemachine.utils.config import Config, HttpsInterception, parse_arguments
+from ontologytimemachine.utils.response_cache import configure_response_cache
+from ontologytimemachine.utils.disk_cache import configure_disk_cache
+from ontologytimemachine.utils.negative_cache import configure_negative_cache
+from ontologytimemachine.utils.host_health import configure_host_health
+from ontologytimemachine.utils.upstream_limits import configure_upstream_limits
+from ontologytimemachine.utils.admission import configure_admission
+from ontologytimemachine.utils.scheme_preference import configure_scheme_preferences
+from ontologytimemachine.utils.single_flight import configure_single_flight
 from http.client import responses
 import proxy
 import sys
@@ -34,6 +63,10 @@ IP = default_cfg.host
 PORT = default_cfg.port
 
 
+# seconds between the empty writes that keep a client waiting for its response active
+PENDING_KEEPALIVE_INTERVAL = 1.0
+
+
 # config = parse_arguments() # will break pytest discovery in vscode since it 
 
 logger = logging.getLogger(__name__)
@@ -57,6 +90,20 @@ class OntologyTimeMachinePlugin(HttpProxyBasePlugin):
         logger.info(f"~~~~~~~~~~~___________________________OntologyTimeMachinePlugin Init - Object ID: {id(self)}")
         super().__init__(*args, **kwargs)
         self.config = config
+        # responses computed on the fetch pool, queued to the client in request order
+        self.pending_responses = deque()
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        # time of the first wakeup not yet seen by the event loop, for measuring its lag
+        self.wakeup_sent_at = None
+        self.last_keepalive = 0.0
+        # body of a large response being streamed to the client
+        self.active_stream = None
+        self.stream_chunked = False
+        # cached file being sent to a plain HTTP client with sendfile
+        self.active_file = None
+        self.file_offset = 0
+        self.file_end = 0
         logger.info(f"Config: {self.config}")
 
     def before_upstream_connection(self, request: HttpParser) -> HttpParser | None:
@@ -81,7 +128,7 @@ class OntologyTimeMachinePlugin(HttpProxyBasePlugin):
             config_from_auth = evaluate_configuration(wrapped_request, self.config)
             if (not config_from_auth and self.config.clientConfigViaProxyAuth == ClientConfigViaProxyAuth.REQUIRED):
                 logger.info( "Client configuration via proxy auth is required btu configuration is not provided, return 500.")
-                self.queue_response(mock_response_500)
+                self.queue_response(mock_response_500())
                 return None
             if (not config_from_auth and self.config.clientConfigViaProxyAuth == ClientConfigViaProxyAuth.OPTIONAL):
                 logger.info("Auth configuration is optional, not provided.")
@@ -122,11 +169,9 @@ class OntologyTimeMachinePlugin(HttpProxyBasePlugin):
             if not wrapped_request.get_request_path():
                 if hasattr(self.client, "request_path"):
                     wrapped_request.set_request_path(self.client.request_path)
-            response = get_response_from_request(wrapped_request, config)
-            if response.status_code:
-                logger.info('Queue response from proxy logic')
-                self.queue_response(response)
-                return None
+            logger.info('Queue response from proxy logic')
+            self.queue_response_from_pool(get_response_from_request, wrapped_request, config)
+            return None
 
         return request
 
@@ -194,10 +239,9 @@ class OntologyTimeMachinePlugin(HttpProxyBasePlugin):
                     if hasattr(self.client, "request_path"):
                         wrapped_request.set_request_path(self.client.request_path)
 
-                response = get_response_from_request(wrapped_request, config)
-            if response and response.status_code:
-                logger.info(response.status_code)
-                self.queue_response(response)
+                self.queue_response_from_pool(
+                    get_response_from_intercepted_request, wrapped_request, config
+                )
                 return None
 
         logger.info('Return original request')
@@ -206,15 +250,272 @@ class OntologyTimeMachinePlugin(HttpProxyBasePlugin):
     def handle_upstream_chunk(self, chunk: memoryview):
         return chunk
 
+    def queue_response_from_pool(self, get_response, wrapped_request, config):
+        # upstream fetches block, so they run on the fetch pool instead of the
+        # event loop of this worker, the wakeup socket signals their completion
+        controller = admission.ADMISSION
+        decision = controller.admit(admission.request_priority(config))
+        if decision == admission.REJECT:
+            self.queue_response(mock_response_503(admission.RETRY_AFTER))
+            return
+        wrapped_request.degraded = decision == admission.DEGRADE
+        try:
+            future = fetch_pool.FETCH_POOL.submit(
+                controller.run, get_response, time.monotonic(), wrapped_request, config
+            )
+        except FetchPoolFull as e:
+            controller.done()
+            logger.warning(f"Rejecting request, fetch pool is full: {e}")
+            self.queue_response(mock_response_503())
+            return
+        future.add_done_callback(lambda _: controller.done())
+        self._open_wakeup_socket()
+        self.pending_responses.append(future)
+        future.add_done_callback(self._wakeup)
+
+    def _open_wakeup_socket(self):
+        if self.wakeup_reader is None:
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.wakeup_writer.setblocking(False)
+
+    def _wakeup(self, _future=None):
+        if self.wakeup_sent_at is None:
+            self.wakeup_sent_at = time.monotonic()
+        try:
+            self.wakeup_writer.send(b"\0")
+        except (AttributeError, OSError):
+            pass  # connection was closed in the meantime or enough wakeups are pending
+
+    def _keep_client_active(self):
+        # proxy.py closes connections without buffered data that were idle for
+        # longer than its --timeout, fetches may take longer than that. Flushing
+        # an empty buffer entry counts as activity without sending anything.
+        now = time.monotonic()
+        if not self.client.has_buffer() and now - self.last_keepalive >= PENDING_KEEPALIVE_INTERVAL:
+            self.last_keepalive = now
+            self.client.queue(memoryview(b""))
+
+    def _client_has_room(self):
+        return sum(len(mv) for mv in self.client.buffer) < streaming.STREAM_BUFFER_SIZE
+
+    async def get_descriptors(self):
+        if self.wakeup_reader is None:
+            return [], []
+        if not self.pending_responses and self.active_stream is None:
+            return [], []
+        self._keep_client_active()
+        writables = []
+        if self.active_stream is not None and self.active_stream.has_chunks() and self._client_has_room():
+            # chunks waited for the client buffer to drain, the always writable
+            # wakeup socket makes the event loop call back right away
+            writables.append(self.wakeup_writer.fileno())
+        return [self.wakeup_reader.fileno()], writables
+
+    async def write_to_descriptors(self, w) -> bool:
+        # the file follows the header block, so it is only sent once the buffer is flushed
+        if (
+            self.active_file is not None
+            and not self.client.has_buffer()
+            and self.client.connection.fileno() in w
+        ):
+            return self.send_file()
+        if self.wakeup_writer is None or self.wakeup_writer.fileno() not in w:
+            return False
+        return self.pump_stream()
+
+    async def read_from_descriptors(self, r) -> bool:
+        if self.wakeup_reader is None or self.wakeup_reader.fileno() not in r:
+            return False
+        try:
+            self.wakeup_reader.recv(1024)
+        except BlockingIOError:
+            pass
+        if self.wakeup_sent_at is not None:
+            admission.ADMISSION.record_loop_lag(time.monotonic() - self.wakeup_sent_at)
+            self.wakeup_sent_at = None
+        if self.pump_stream():
+            return True
+        # responses are sent in request order, later ones wait for an active stream or file
+        while (
+            self.active_stream is None
+            and self.active_file is None
+            and self.pending_responses
+            and self.pending_responses[0].done()
+        ):
+            future = self.pending_responses.popleft()
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.error(f"Error while computing the response: {e}", exc_info=True)
+                response = None
+            if response is None:
+                response = mock_response_500()
+            self.queue_response(response)
+        return False
+
+    def pump_stream(self) -> bool:
+        """Move ready chunks of the active stream to the client while its buffer has room.
+
+        Returns True if the connection has to be closed."""
+        stream = self.active_stream
+        while stream is not None and self._client_has_room():
+            chunk = stream.get()
+            if chunk is None:
+                return False
+            if chunk is END_OF_STREAM:
+                self.active_stream = None
+                if stream.error is not None:
+                    # the status line is sent already, only closing the
+                    # connection tells the client that the body is incomplete
+                    return True
+                if self.stream_chunked:
+                    self.client.queue(memoryview(b"0\r\n\r\n"))
+                # a pipelined response may be waiting for this stream to end
+                if self.pending_responses:
+                    self._wakeup()
+                return False
+            if self.stream_chunked:
+                self.client.queue(memoryview(b"%x\r\n" % len(chunk)))
+                self.client.queue(memoryview(chunk))
+                self.client.queue(memoryview(b"\r\n"))
+            else:
+                self.client.queue(memoryview(chunk))
+        return False
+
+    def send_file(self) -> bool:
+        """Let the kernel copy the next part of the active file to the client.
+
+        Returns True if the connection has to be closed."""
+        try:
+            sent = os.sendfile(
+                self.client.connection.fileno(),
+                self.active_file.fileno(),
+                self.file_offset,
+                self.file_end - self.file_offset,
+            )
+        except BlockingIOError:
+            sent = None
+        except OSError as e:
+            logger.warning(f"Error while sending the cached file: {e}")
+            self.close_file()
+            return True
+        if sent == 0:
+            # the file is shorter than the announced Content-Length
+            logger.error("Cached file ended before its announced length")
+            self.close_file()
+            return True
+        self.file_offset += sent or 0
+        if self.file_offset >= self.file_end:
+            self.close_file()
+            if self.pending_responses:
+                self._wakeup()
+            return False
+        # an empty buffer entry keeps the client socket registered for writing,
+        # its flush also counts as activity for the inactivity timeout of proxy.py
+        self.client.queue(memoryview(b""))
+        return False
+
+    def close_file(self):
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+
+    def on_upstream_connection_close(self):
+        # also called when the client connection closes
+        for future in self.pending_responses:
+            future.cancel()
+        self.pending_responses.clear()
+        if self.active_stream is not None:
+            self.active_stream.close()
+            self.active_stream = None
+        self.close_file()
+        if self.wakeup_reader is not None:
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+            self.wakeup_reader = None
+            self.wakeup_writer = None
+
+    def queue_stream(self, response):
+        stream = ResponseStream(
+            response, streaming.STREAM_BUFFER_SIZE // STREAM_CHUNK_SIZE, self._wakeup
+        )
+        try:
+            fetch_pool.FETCH_POOL.submit(stream.pump)
+        except FetchPoolFull as e:
+            logger.warning(f"Rejecting streamed response, fetch pool is full: {e}")
+            response.close()
+            self.queue_response(mock_response_503())
+            return
+        self._open_wakeup_socket()
+        headers = strip_transfer_headers(response.headers)
+        content_length = response.headers.get("Content-Length")
+        # the upstream length is only valid if the body was not decoded
+        self.stream_chunked = content_length is None or "Content-Encoding" in response.headers
+        if self.stream_chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            headers["Content-Length"] = content_length
+        self.client.queue(
+            build_http_response(
+                response.status_code,
+                reason=bytes(responses[response.status_code], "utf-8"),
+                headers={
+                    bytes(key, "utf-8"): bytes(value, "utf-8")
+                    for key, value in headers.items()
+                },
+                no_cl=True,
+            )
+        )
+        self.active_stream = stream
+
+    def queue_file(self, response):
+        headers = strip_transfer_headers(response.headers)
+        headers["Content-Length"] = str(response.body_size)
+        self.client.queue(
+            build_http_response(
+                response.status_code,
+                reason=bytes(responses[response.status_code], "utf-8"),
+                headers={
+                    bytes(key, "utf-8"): bytes(value, "utf-8")
+                    for key, value in headers.items()
+                },
+                no_cl=True,
+            )
+        )
+        body_file = response.body_file
+        if response.body_size == 0:
+            body_file.close()
+            return
+        if hasattr(os, "sendfile") and not isinstance(self.client.connection, ssl.SSLSocket):
+            self.active_file = body_file
+            self.file_offset = 0
+            self.file_end = response.body_size
+            return
+        # TLS encrypts in user space, the body is handed over as a view of the
+        # mapped file so that it is neither read nor copied into a buffer
+        with body_file:
+            body = mmap.mmap(body_file.fileno(), response.body_size, access=mmap.ACCESS_READ)
+        self.client.queue(memoryview(body))
+
     def queue_response(self, response):
+        if is_streamed(response):
+            self.queue_stream(response)
+            return
+        if is_file_backed(response):
+            self.queue_file(response)
+            return
         self.client.queue(
             build_http_response(
                 response.status_code,
                 reason=bytes(responses[response.status_code], "utf-8"),
                 headers={
-                    bytes(key, "utf-8"): bytes(value, "utf-8") for key, value in response.headers.items()
+                    bytes(key, "utf-8"): bytes(value, "utf-8")
+                    for key, value in strip_transfer_headers(response.headers).items()
                 },
                 body=response.content,
+                # a 304 has no body, a Content-Length would describe the full response
+                no_cl=response.status_code == 304,
             )
         )
 
@@ -224,6 +525,18 @@ if __name__ == "__main__":
     config = parse_arguments()
     from ontologytimemachine.utils.config import logger
 
+    configure_response_cache(config)
+    configure_disk_cache(config)
+    configure_negative_cache(config)
+    configure_scheme_preferences(config)
+    configure_single_flight(config)
+    configure_fetch_pool(config)
+    configure_host_health(config)
+    configure_upstream_limits(config)
+    configure_admission(config)
+    configure_upstream(config)
+    configure_streaming(config)
+
     sys.argv = [sys.argv[0]]
 
     # check it https interception is enabled add the necessary certificates to proxypy
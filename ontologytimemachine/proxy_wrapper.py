@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from proxy.http.parser import HttpParser
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, Optional
 import base64
 from ontologytimemachine.utils.config import logger
 
@@ -8,6 +8,12 @@ from ontologytimemachine.utils.config import logger
 class AbstractRequestWrapper(ABC):
     def __init__(self, request: Any) -> None:
         self.request = request
+        # (host, path, is archivo ontology) of the last archivo classification of this request
+        self.archivo_classification: Optional[Tuple[str, str, bool]] = None
+        # matching ontology IRI of the Archivo index, its scheme is the one Archivo knows
+        self.archivo_iri: Optional[str] = None
+        # set by the admission control of an overloaded worker, the request is answered without Archivo lookup
+        self.degraded = False
 
     @abstractmethod
     def is_get_request(self) -> bool:
@@ -62,6 +68,50 @@ class AbstractRequestWrapper(ABC):
         pass
 
 
+class RequestSnapshot:
+    """The request details a fetch needs, copied while the request is handled.
+
+    proxy.py reuses the parser of a request once its response is sent. Work
+    that may outlive the response, like background refreshes and the fetches
+    a hedged or timed out request gives up on, gets a snapshot instead of the
+    wrapper.
+    """
+
+    def __init__(self, wrapped_request) -> None:
+        self._is_get = wrapped_request.is_get_request()
+        self._is_head = wrapped_request.is_head_request()
+        self._host = wrapped_request.get_request_host()
+        self._path = wrapped_request.get_request_path()
+        self._url_host_path = wrapped_request.get_request_url_host_path()
+        self._headers = dict(wrapped_request.get_request_headers())
+        self.archivo_classification = wrapped_request.archivo_classification
+        self.archivo_iri = wrapped_request.archivo_iri
+        self.degraded = wrapped_request.degraded
+
+    def is_get_request(self) -> bool:
+        return self._is_get
+
+    def is_head_request(self) -> bool:
+        return self._is_head
+
+    def get_request_host(self) -> str:
+        return self._host
+
+    def get_request_path(self) -> str:
+        return self._path
+
+    def set_request_path(self, new_path: str) -> None:
+        url, host, path = self._url_host_path
+        self._url_host_path = (url[: len(url) - len(path)] + new_path, host, new_path)
+        self._path = new_path
+
+    def get_request_headers(self) -> Dict[str, str]:
+        return dict(self._headers)
+
+    def get_request_url_host_path(self) -> Tuple[str, str, str]:
+        return self._url_host_path
+
+
 class HttpRequestWrapper(AbstractRequestWrapper):
     def __init__(self, request: HttpParser) -> None:
         super().__init__(request)
@@ -108,6 +158,8 @@ class HttpRequestWrapper(AbstractRequestWrapper):
 
     def get_request_accept_header(self) -> str:
         logger.info("Wrapper - get_request_accept_header")
+        if b"accept" not in self.request.headers:
+            return ""
         return self.request.headers[b"accept"][1].decode("utf-8")
 
     def set_request_accept_header(self, mime_type: str) -> None:
@@ -0,0 +1,148 @@
+import threading
+import time
+from typing import Any, Callable, Dict
+from ontologytimemachine.utils.config import Config, OntoVersion, logger
+
+
+# priorities of requests, lower ones are shed first
+PASSTHROUGH = 0
+ARCHIVO = 1
+PINNED = 2
+
+ADMIT = "admit"
+# served from the cache only, or from the original server without Archivo lookup
+DEGRADE = "degrade"
+REJECT = "reject"
+
+# above this pressure every request that is not pinned is rejected
+SHED_PRESSURE = 2.0
+# the measured delays lose half their weight per second without new samples
+DECAY_HALF_LIFE = 1.0
+EWMA_ALPHA = 0.3
+RETRY_AFTER = 1
+
+
+class DecayingAverage:
+    """Moving average of a delay that fades back to 0 when no samples arrive."""
+
+    def __init__(self) -> None:
+        self._value = 0.0
+        self._updated_at = time.monotonic()
+
+    def value(self, now: float) -> float:
+        return self._value * 0.5 ** (max(now - self._updated_at, 0) / DECAY_HALF_LIFE)
+
+    def add(self, sample: float, now: float) -> None:
+        current = self.value(now)
+        self._value = current + EWMA_ALPHA * (sample - current)
+        self._updated_at = now
+
+
+def request_priority(config: Config) -> int:
+    if config.ontoVersion == OntoVersion.TIMESTAMP_ARCHIVED:
+        return PINNED
+    if config.ontoVersion == OntoVersion.ORIGINAL:
+        return PASSTHROUGH
+    return ARCHIVO
+
+
+class AdmissionController:
+    """Decides whether a proxy worker takes on a new request.
+
+    The load of the worker is measured by the requests in flight, the time
+    they wait for a fetch pool thread and the delay of the event loop in
+    reacting to finished fetches. The pressure is the highest of these
+    relative to its limit, a limit of 0 is ignored. Below a pressure of 1
+    every request is admitted. Above it pass-through requests are rejected
+    and Archivo requests are degraded, and above SHED_PRESSURE both are
+    rejected. Pinned timestamp requests are always admitted.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue_wait: float, max_loop_lag: float) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.max_loop_lag = max_loop_lag
+        self.in_flight = 0
+        self.degraded = 0
+        self.rejected = 0
+        self._queue_wait = DecayingAverage()
+        self._loop_lag = DecayingAverage()
+        self._lock = threading.Lock()
+
+    def pressure(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            loads = [
+                (self.in_flight, self.max_in_flight),
+                (self._queue_wait.value(now), self.max_queue_wait),
+                (self._loop_lag.value(now), self.max_loop_lag),
+            ]
+        return max((load / limit for load, limit in loads if limit > 0), default=0.0)
+
+    def admit(self, priority: int) -> str:
+        """Decide on a new request, ADMIT and DEGRADE count it as in flight until done() is called."""
+        pressure = self.pressure()
+        if priority == PINNED or pressure < 1:
+            decision = ADMIT
+        elif priority == ARCHIVO and pressure < SHED_PRESSURE:
+            decision = DEGRADE
+        else:
+            decision = REJECT
+        with self._lock:
+            if decision == REJECT:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+                if decision == DEGRADE:
+                    self.degraded += 1
+        if decision != ADMIT:
+            logger.warning(f"Load pressure {pressure:.2f}, request with priority {priority}: {decision}")
+        return decision
+
+    def done(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def run(self, fn: Callable[..., Any], submitted_at: float, *args: Any) -> Any:
+        """Run fn on a fetch pool thread, recording how long it waited for the thread."""
+        now = time.monotonic()
+        with self._lock:
+            self._queue_wait.add(now - submitted_at, now)
+        return fn(*args)
+
+    def record_loop_lag(self, lag: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._loop_lag.add(lag, now)
+
+    def stats(self) -> Dict[str, float]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queue_wait": self._queue_wait.value(now),
+                "loop_lag": self._loop_lag.value(now),
+                "degraded": self.degraded,
+                "rejected": self.rejected,
+            }
+
+
+_default_cfg = Config()
+ADMISSION = AdmissionController(
+    _default_cfg.admissionMaxInFlight,
+    _default_cfg.admissionMaxQueueWait,
+    _default_cfg.admissionMaxLoopLag,
+)
+
+
+def configure_admission(config: Config) -> None:
+    global ADMISSION
+    logger.info(
+        f"Configuring admission control: {config.admissionMaxInFlight} requests in flight, "
+        f"queue wait {config.admissionMaxQueueWait}s, event loop lag {config.admissionMaxLoopLag}s"
+    )
+    ADMISSION = AdmissionController(
+        config.admissionMaxInFlight,
+        config.admissionMaxQueueWait,
+        config.admissionMaxLoopLag,
+    )
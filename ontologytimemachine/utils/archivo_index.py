@@ -0,0 +1,312 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+
+CLASSIFICATION_MEMO_SIZE = 10000
+
+SNAPSHOT_MAGIC = b"OTMARCHV"
+SNAPSHOT_VERSION = 1
+# magic, version, host count, entry count
+_HEADER = struct.Struct("<8sIII")
+# host name offset, host name length, first entry, entry count
+_HOST = struct.Struct("<IIII")
+# path offset, path length, trailing slash, iri offset, iri length
+_ENTRY = struct.Struct("<IIIII")
+
+
+class ArchivoMatch(NamedTuple):
+    iri: str
+    host: str
+    path: str
+
+
+class _Node:
+    __slots__ = ("children", "iris")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        # registered IRIs ending at this node, keyed by whether their path has a trailing slash
+        self.iris: Dict[bool, str] = {}
+
+
+def split_path(path: str) -> List[str]:
+    stripped = path.strip("/")
+    return stripped.split("/") if stripped else []
+
+
+def _select(iris: Dict[bool, str], prefer_trailing_slash: bool) -> Optional[str]:
+    if not iris:
+        return None
+    return iris.get(prefer_trailing_slash) or iris.get(not prefer_trailing_slash)
+
+
+class _MemoizedIndex:
+    """classify() memoizes lookup() results in a bounded LRU memo that belongs
+    to the index, so replacing the index also replaces the memo."""
+
+    def __init__(self, memo_size: int = CLASSIFICATION_MEMO_SIZE) -> None:
+        self.memo_size = memo_size
+        self._memo: "OrderedDict[Tuple[str, str], Optional[ArchivoMatch]]" = OrderedDict()
+        self._memo_lock = threading.Lock()
+
+    def lookup(self, host: str, path: str) -> Optional[ArchivoMatch]:
+        raise NotImplementedError
+
+    def classify(self, host: str, path: str) -> Optional[ArchivoMatch]:
+        """Memoized lookup(), negative results are remembered as well."""
+        key = (host, path)
+        with self._memo_lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+        match = self.lookup(host, path)
+        with self._memo_lock:
+            self._memo[key] = match
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return match
+
+    def clear_memo(self) -> None:
+        with self._memo_lock:
+            self._memo.clear()
+
+
+class ArchivoIndex(_MemoizedIndex):
+    """Per host path trie of the ontology IRIs available on Archivo.
+
+    lookup() walks the requested path once and returns the longest registered
+    ontology IRI that is a prefix of it, has_host() answers whether a host has
+    any ontology at all with a single dictionary lookup.
+    """
+
+    def __init__(self, memo_size: int = CLASSIFICATION_MEMO_SIZE) -> None:
+        super().__init__(memo_size)
+        self._hosts: Dict[str, _Node] = {}
+        self._size = 0
+
+    @classmethod
+    def from_iris(cls, iris: Iterable[str]) -> "ArchivoIndex":
+        index = cls()
+        for iri in iris:
+            iri = iri.strip()
+            if iri:
+                index.add(iri)
+        return index
+
+    def add(self, iri: str) -> bool:
+        parsed = urlparse(iri)
+        node = self._hosts.setdefault(parsed.netloc, _Node())
+        for segment in split_path(parsed.path):
+            node = node.children.setdefault(segment, _Node())
+        trailing_slash = parsed.path.endswith("/")
+        if trailing_slash in node.iris:
+            return False
+        node.iris[trailing_slash] = iri
+        self._size += 1
+        self.clear_memo()
+        return True
+
+    def has_host(self, host: str) -> bool:
+        return host in self._hosts
+
+    def lookup(self, host: str, path: str) -> Optional[ArchivoMatch]:
+        """Return the longest registered ontology IRI that is a prefix of host + path."""
+        node = self._hosts.get(host)
+        if node is None:
+            return None
+        segments = split_path(path)
+        best = _select(node.iris, prefer_trailing_slash=not segments and path.endswith("/"))
+        for depth, segment in enumerate(segments, start=1):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            exact = depth == len(segments)
+            iri = _select(node.iris, prefer_trailing_slash=exact and path.endswith("/"))
+            if iri is not None:
+                best = iri
+        if best is None:
+            return None
+        return ArchivoMatch(best, host, urlparse(best).path)
+
+    def iris(self) -> Iterator[str]:
+        stack = list(self._hosts.values())
+        while stack:
+            node = stack.pop()
+            yield from node.iris.values()
+            stack.extend(node.children.values())
+
+    def hosts(self) -> Iterable[str]:
+        return self._hosts.keys()
+
+    def __len__(self) -> int:
+        return self._size
+
+
+def write_snapshot(iris: Iterable[str], path: str) -> int:
+    """Compile IRIs into a binary snapshot for MappedArchivoIndex.
+
+    The file holds a header, a host table sorted by host name, an entry table
+    sorted by (path, trailing slash) within each host and a blob with all
+    strings. It is written atomically and the number of entries is returned.
+    """
+    hosts: Dict[bytes, Dict[Tuple[bytes, int], bytes]] = {}
+    for iri in iris:
+        iri = iri.strip()
+        if not iri:
+            continue
+        parsed = urlparse(iri)
+        entry_key = ("/".join(split_path(parsed.path)).encode(), int(parsed.path.endswith("/")))
+        # the first IRI registered for a path wins, as in ArchivoIndex.add()
+        hosts.setdefault(parsed.netloc.encode(), {}).setdefault(entry_key, iri.encode())
+
+    blob = bytearray()
+    host_table = bytearray()
+    entry_table = bytearray()
+    entry_count = 0
+    for host in sorted(hosts):
+        entries = hosts[host]
+        host_table += _HOST.pack(len(blob), len(host), entry_count, len(entries))
+        blob += host
+        for (entry_path, trailing_slash), iri in sorted(entries.items()):
+            entry_table += _ENTRY.pack(len(blob), len(entry_path), trailing_slash, len(blob) + len(entry_path), len(iri))
+            blob += entry_path
+            blob += iri
+        entry_count += len(entries)
+
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(hosts), entry_count))
+            temp_file.write(host_table)
+            temp_file.write(entry_table)
+            temp_file.write(blob)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return entry_count
+
+
+class MappedArchivoIndex(_MemoizedIndex):
+    """Read only ArchivoIndex backed by a memory mapped snapshot file.
+
+    Opening the snapshot only validates its header, lookups binary search the
+    host table and then the entries of that host for each prefix of the
+    requested path. Hosts without any ontology are rejected by a frozenset of
+    all host names, built on first use, before touching the mapped tables.
+    All worker processes mapping the same file share one copy
+    in the page cache. Raises ValueError for files that are not a snapshot of
+    the supported version.
+    """
+
+    def __init__(self, path: str, memo_size: int = CLASSIFICATION_MEMO_SIZE) -> None:
+        super().__init__(memo_size)
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._file_id = self._stat_id(os.fstat(f.fileno()))
+        if len(self._mm) < _HEADER.size:
+            raise ValueError(f"Archivo index snapshot {path} is truncated")
+        magic, version, self._host_count, self._entry_count = _HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not an archivo index snapshot of version {SNAPSHOT_VERSION}")
+        self._hosts_at = _HEADER.size
+        self._entries_at = self._hosts_at + self._host_count * _HOST.size
+        self._blob_at = self._entries_at + self._entry_count * _ENTRY.size
+        if len(self._mm) < self._blob_at:
+            raise ValueError(f"Archivo index snapshot {path} is truncated")
+        self._host_set: Optional[FrozenSet[str]] = None
+
+    def is_current(self) -> bool:
+        """Whether path still refers to the mapped file, snapshots are replaced and not modified."""
+        try:
+            return self._stat_id(os.stat(self.path)) == self._file_id
+        except OSError:
+            return True
+
+    @staticmethod
+    def _stat_id(stat: os.stat_result) -> Tuple[int, int, int]:
+        return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+    def has_host(self, host: str) -> bool:
+        host_set = self._host_set
+        if host_set is None:
+            host_set = self._host_set = frozenset(self.hosts())
+        return host in host_set
+
+    def lookup(self, host: str, path: str) -> Optional[ArchivoMatch]:
+        """Return the longest registered ontology IRI that is a prefix of host + path."""
+        if not self.has_host(host):
+            return None
+        found = self._find_host(host.encode())
+        if found is None:
+            return None
+        first, count = found
+        segments = split_path(path)
+        for depth in range(len(segments), -1, -1):
+            iris = self._find_entries(first, count, "/".join(segments[:depth]).encode())
+            iri = _select(iris, prefer_trailing_slash=depth == len(segments) and path.endswith("/"))
+            if iri is not None:
+                return ArchivoMatch(iri, host, urlparse(iri).path)
+        return None
+
+    def iris(self) -> Iterator[str]:
+        for i in range(self._entry_count):
+            _, _, _, iri_offset, iri_length = _ENTRY.unpack_from(self._mm, self._entries_at + i * _ENTRY.size)
+            yield self._string(iri_offset, iri_length).decode()
+
+    def hosts(self) -> Iterable[str]:
+        hosts = []
+        for i in range(self._host_count):
+            offset, length, _, _ = _HOST.unpack_from(self._mm, self._hosts_at + i * _HOST.size)
+            hosts.append(self._string(offset, length).decode())
+        return hosts
+
+    def __len__(self) -> int:
+        return self._entry_count
+
+    def _string(self, offset: int, length: int) -> bytes:
+        start = self._blob_at + offset
+        return self._mm[start:start + length]
+
+    def _find_host(self, host: bytes) -> Optional[Tuple[int, int]]:
+        lo, hi = 0, self._host_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, first, count = _HOST.unpack_from(self._mm, self._hosts_at + mid * _HOST.size)
+            name = self._string(offset, length)
+            if name < host:
+                lo = mid + 1
+            elif name > host:
+                hi = mid
+            else:
+                return first, count
+        return None
+
+    def _find_entries(self, first: int, count: int, entry_path: bytes) -> Dict[bool, str]:
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, _, _, _ = _ENTRY.unpack_from(self._mm, self._entries_at + mid * _ENTRY.size)
+            if self._string(offset, length) < entry_path:
+                lo = mid + 1
+            else:
+                hi = mid
+        # at most two entries per path, without and with trailing slash
+        iris: Dict[bool, str] = {}
+        for i in range(lo, min(lo + 2, first + count)):
+            offset, length, trailing_slash, iri_offset, iri_length = _ENTRY.unpack_from(
+                self._mm, self._entries_at + i * _ENTRY.size
+            )
+            if self._string(offset, length) != entry_path:
+                break
+            iris[bool(trailing_slash)] = self._string(iri_offset, iri_length).decode()
+        return iris
@@ -1,6 +1,7 @@
 import argparse
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from enum import Enum
+import functools
 import logging
 import os
 from typing import Dict, Any, Type, TypeVar, List
@@ -78,14 +79,19 @@ class ClientConfigViaProxyAuth(EnumValuePrint):
     OPTIONAL = "optional"
 
 
-@dataclass
+class UpstreamClient(EnumValuePrint):
+    REQUESTS = "requests"
+    HTTPX = "httpx"
+
+
+@dataclass(frozen=True)
 class OntoFormatConfig:
     format: OntoFormat = OntoFormat.NTRIPLES
     precedence: OntoPrecedence = OntoPrecedence.ENFORCED_PRIORITY
     patchAcceptUpstream: bool = False
 
 
-@dataclass
+@dataclass(frozen=True)
 class Config:
     logLevelTimeMachine: LogLevel = LogLevel.DEBUG
     logLevelBase: LogLevel = LogLevel.INFO
@@ -98,6 +104,36 @@ class Config:
     timestamp: str = ""
     host: List[str] = field(default_factory=lambda: ["0.0.0.0", "::"])
     port: int = 8898
+    cacheMaxBytes: int = 256 * 1024 * 1024
+    cacheTtl: int = 3600
+    cacheHardTtl: int = 24 * 3600
+    immutableCacheMaxBytes: int = 256 * 1024 * 1024
+    cacheDir: str = ""
+    cacheDirMaxBytes: int = 2 * 1024 * 1024 * 1024
+    negativeCacheTtl: int = 60
+    singleFlightTimeout: float = 10.0
+    fetchPoolSize: int = 16
+    fetchQueueDepth: int = 128
+    failoverHedgeDelay: float = 1.0
+    upstreamTimeoutMin: float = 3.0
+    upstreamTimeoutMax: float = 10.0
+    circuitFailureThreshold: int = 5
+    circuitOpenSeconds: float = 30.0
+    upstreamMaxConcurrent: int = 32
+    upstreamMaxConcurrentPerHost: int = 8
+    upstreamQueueDepth: int = 64
+    upstreamQueueTimeout: float = 5.0
+    admissionMaxInFlight: int = 96
+    admissionMaxQueueWait: float = 2.0
+    admissionMaxLoopLag: float = 0.5
+    upstreamClient: UpstreamClient = UpstreamClient.REQUESTS
+    upstreamHttp2: bool = False
+    upstreamMaxConnections: int = 100
+    upstreamMaxKeepaliveConnections: int = 20
+    upstreamKeepaliveExpiry: float = 30.0
+    upstreamPoolConnections: int = 10
+    upstreamPoolMaxsize: int = 20
+    streamBufferSize: int = 1024 * 1024
     # manifest: Dict[str, Any] = None
 
 
@@ -115,6 +151,81 @@ def enum_parser(enum_class: Type[E], value: str) -> E:
             f"Invalid value '{value}'. Available options are: {valid_options}"
         ) from exc
 
+# options a client can send in the Proxy-Authorization user name, mapped to their type
+CLIENT_CONFIG_CACHE_SIZE = 256
+_ONTO_FORMAT_OPTIONS = {
+    "ontoFormat": "format",
+    "ontoPrecedence": "precedence",
+    "patchAcceptUpstream": "patchAcceptUpstream",
+}
+# the per-request options of parse_arguments(), the others configure the server
+_CLIENT_CONFIG_FIELDS = (
+    "ontoVersion",
+    "restrictedAccess",
+    "httpsInterception",
+    "disableRemovingRedirects",
+)
+_CLIENT_OPTIONS: Dict[str, Any] = {
+    f.name: f.type for f in fields(Config) if f.name in _CLIENT_CONFIG_FIELDS
+}
+_onto_format_types = {f.name: f.type for f in fields(OntoFormatConfig)}
+_CLIENT_OPTIONS.update(
+    {option: _onto_format_types[name] for option, name in _ONTO_FORMAT_OPTIONS.items()}
+)
+
+
+def _parse_option_value(option: str, option_type: Any, value: str) -> Any:
+    try:
+        if isinstance(option_type, type) and issubclass(option_type, Enum):
+            return enum_parser(option_type, value)
+        return option_type(value)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        raise ValueError(f"Invalid value for --{option}: {e}") from e
+
+
+@functools.lru_cache(maxsize=CLIENT_CONFIG_CACHE_SIZE)
+def parse_client_config(config_str: str) -> Config:
+    """Parse a configuration sent by a client via the proxy authentication.
+
+    Accepts the per-request options of parse_arguments(), the ontology format,
+    version, restrictedAccess, httpsInterception and disableRemovingRedirects, as
+    "--option value", "--option=value" or a bare flag for boolean options, and
+    returns a Config with the defaults for all other options. Unlike parse_arguments() no argparse parser
+    is built and the logging configuration is left untouched. Results are cached
+    per string, the Config is frozen so it can be shared between connections.
+    Raises ValueError for unknown or server options and invalid values.
+    """
+    values: Dict[str, Any] = {}
+    onto_format: Dict[str, Any] = {}
+    tokens = config_str.split()
+    position = 0
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if not token.startswith("--"):
+            raise ValueError(f"Unexpected argument '{token}'")
+        option, has_value, value = token[2:].partition("=")
+        if option not in _CLIENT_OPTIONS:
+            raise ValueError(f"Unknown option '--{option}'")
+        option_type = _CLIENT_OPTIONS[option]
+        if option_type is bool:
+            if has_value:
+                raise ValueError(f"Option --{option} does not take a value")
+            parsed = True
+        else:
+            if not has_value:
+                if position >= len(tokens):
+                    raise ValueError(f"Option --{option} expects a value")
+                value = tokens[position]
+                position += 1
+            parsed = _parse_option_value(option, option_type, value)
+        if option in _ONTO_FORMAT_OPTIONS:
+            onto_format[_ONTO_FORMAT_OPTIONS[option]] = parsed
+        else:
+            values[option] = parsed
+    return Config(ontoFormatConf=OntoFormatConfig(**onto_format), **values)
+
+
 def log_level_Enum_to_python_logging(log_level: LogLevel) -> int:
     """
     Translates the custom LogLevel enum into logging module levels.
@@ -248,6 +359,218 @@ def parse_arguments(config_str: str = "") -> Config:
         help=f"Port number to bind the proxy to. {help_suffix_template}",
     )
 
+    # Response cache
+    parser.add_argument(
+        "--cacheMaxBytes",
+        type=int,
+        default=default_cfg.cacheMaxBytes,
+        help=f"Maximum size in bytes of the in-memory response cache for Archivo responses, 0 disables the cache. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--cacheTtl",
+        type=int,
+        default=default_cfg.cacheTtl,
+        help=f"Time to live in seconds of entries in the response cache. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--cacheHardTtl",
+        type=int,
+        default=default_cfg.cacheHardTtl,
+        help=f"Seconds after which a latestArchived cache entry is no longer served while it is refreshed in the background. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--immutableCacheMaxBytes",
+        type=int,
+        default=default_cfg.immutableCacheMaxBytes,
+        help=f"Maximum size in bytes of the in-memory cache for pinned timestampArchived snapshots, which never expire. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--cacheDir",
+        type=str,
+        default=default_cfg.cacheDir,
+        help=f"Directory of the persistent on-disk cache for Archivo responses, empty disables it. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--cacheDirMaxBytes",
+        type=int,
+        default=default_cfg.cacheDirMaxBytes,
+        help=f"Maximum size in bytes of the response bodies kept in the on-disk cache. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--negativeCacheTtl",
+        type=int,
+        default=default_cfg.negativeCacheTtl,
+        help=f"Seconds for which unreachable or unusable origins and Archivo misses are remembered, 0 disables it. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--singleFlightTimeout",
+        type=float,
+        default=default_cfg.singleFlightTimeout,
+        help=f"Seconds a request waits for an identical in-flight Archivo fetch before giving up. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--fetchPoolSize",
+        type=int,
+        default=default_cfg.fetchPoolSize,
+        help=f"Number of threads per proxy worker running upstream fetches. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--fetchQueueDepth",
+        type=int,
+        default=default_cfg.fetchQueueDepth,
+        help=f"Number of upstream fetches that may wait for a free thread before requests are rejected with 503. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--failoverHedgeDelay",
+        type=float,
+        default=default_cfg.failoverHedgeDelay,
+        help=f"Seconds after which originalFailoverLiveLatest also requests Archivo while the original server has not answered, 0 requests both at once and a negative value waits for the original server. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamTimeoutMin",
+        type=float,
+        default=default_cfg.upstreamTimeoutMin,
+        help=f"Lower bound in seconds of the per-host upstream timeout derived from observed response times. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamTimeoutMax",
+        type=float,
+        default=default_cfg.upstreamTimeoutMax,
+        help=f"Upper bound in seconds of the per-host upstream timeout derived from observed response times. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--circuitFailureThreshold",
+        type=int,
+        default=default_cfg.circuitFailureThreshold,
+        help=f"Consecutive failed requests after which an upstream host is no longer contacted for a while. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--circuitOpenSeconds",
+        type=float,
+        default=default_cfg.circuitOpenSeconds,
+        help=f"Seconds a failing upstream host is not contacted before a single probe request is sent. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamMaxConcurrent",
+        type=int,
+        default=default_cfg.upstreamMaxConcurrent,
+        help=f"Maximum number of concurrent upstream requests per proxy worker, 0 disables the limit. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamMaxConcurrentPerHost",
+        type=int,
+        default=default_cfg.upstreamMaxConcurrentPerHost,
+        help=f"Maximum number of concurrent upstream requests per proxy worker to the same host, 0 disables the limit. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamQueueDepth",
+        type=int,
+        default=default_cfg.upstreamQueueDepth,
+        help=f"Number of upstream requests that may wait for a free slot before requests are rejected with 503. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamQueueTimeout",
+        type=float,
+        default=default_cfg.upstreamQueueTimeout,
+        help=f"Seconds an upstream request waits for a free slot before it is rejected with 503. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--admissionMaxInFlight",
+        type=int,
+        default=default_cfg.admissionMaxInFlight,
+        help=f"Requests in flight per proxy worker above which new requests are degraded or shed, 0 disables the limit. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--admissionMaxQueueWait",
+        type=float,
+        default=default_cfg.admissionMaxQueueWait,
+        help=f"Average seconds requests wait for a fetch thread above which new requests are degraded or shed, 0 disables the limit. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--admissionMaxLoopLag",
+        type=float,
+        default=default_cfg.admissionMaxLoopLag,
+        help=f"Average delay in seconds of the worker event loop above which new requests are degraded or shed, 0 disables the limit. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamClient",
+        type=lambda s: enum_parser(UpstreamClient, s),
+        default=default_cfg.upstreamClient,
+        choices=list(UpstreamClient),
+        help=f"HTTP client used for upstream fetches, httpx shares one asyncio client per worker. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamHttp2",
+        action="store_true",
+        default=default_cfg.upstreamHttp2,
+        help=f"Use HTTP/2 for upstream fetches with the httpx client (requires the h2 package). {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamMaxConnections",
+        type=int,
+        default=default_cfg.upstreamMaxConnections,
+        help=f"Maximum number of upstream connections of the httpx client. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamMaxKeepaliveConnections",
+        type=int,
+        default=default_cfg.upstreamMaxKeepaliveConnections,
+        help=f"Maximum number of idle upstream connections kept alive by the httpx client. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamKeepaliveExpiry",
+        type=float,
+        default=default_cfg.upstreamKeepaliveExpiry,
+        help=f"Seconds after which idle upstream connections of both clients are closed. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamPoolConnections",
+        type=int,
+        default=default_cfg.upstreamPoolConnections,
+        help=f"Number of upstream hosts for which the requests client keeps a connection pool. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--upstreamPoolMaxsize",
+        type=int,
+        default=default_cfg.upstreamPoolMaxsize,
+        help=f"Maximum number of kept-alive connections per upstream host of the requests client. {help_suffix_template}",
+    )
+
+    parser.add_argument(
+        "--streamBufferSize",
+        type=int,
+        default=default_cfg.streamBufferSize,
+        help=f"Response bodies larger than this many bytes are streamed to the client instead of being buffered, it also bounds the memory used per streamed response. {help_suffix_template}",
+    )
+
     if config_str:
         args = parser.parse_args(config_str)
     else:
@@ -332,6 +655,36 @@ def parse_arguments(config_str: str = "") -> Config:
         timestamp=args.timestamp if hasattr(args, "timestamp") else "",
         host=args.host,
         port=args.port,
+        cacheMaxBytes=args.cacheMaxBytes,
+        cacheTtl=args.cacheTtl,
+        cacheHardTtl=args.cacheHardTtl,
+        immutableCacheMaxBytes=args.immutableCacheMaxBytes,
+        cacheDir=args.cacheDir,
+        cacheDirMaxBytes=args.cacheDirMaxBytes,
+        negativeCacheTtl=args.negativeCacheTtl,
+        singleFlightTimeout=args.singleFlightTimeout,
+        fetchPoolSize=args.fetchPoolSize,
+        fetchQueueDepth=args.fetchQueueDepth,
+        failoverHedgeDelay=args.failoverHedgeDelay,
+        upstreamTimeoutMin=args.upstreamTimeoutMin,
+        upstreamTimeoutMax=args.upstreamTimeoutMax,
+        circuitFailureThreshold=args.circuitFailureThreshold,
+        circuitOpenSeconds=args.circuitOpenSeconds,
+        upstreamMaxConcurrent=args.upstreamMaxConcurrent,
+        upstreamMaxConcurrentPerHost=args.upstreamMaxConcurrentPerHost,
+        upstreamQueueDepth=args.upstreamQueueDepth,
+        upstreamQueueTimeout=args.upstreamQueueTimeout,
+        admissionMaxInFlight=args.admissionMaxInFlight,
+        admissionMaxQueueWait=args.admissionMaxQueueWait,
+        admissionMaxLoopLag=args.admissionMaxLoopLag,
+        upstreamClient=args.upstreamClient,
+        upstreamHttp2=args.upstreamHttp2,
+        upstreamMaxConnections=args.upstreamMaxConnections,
+        upstreamMaxKeepaliveConnections=args.upstreamMaxKeepaliveConnections,
+        upstreamKeepaliveExpiry=args.upstreamKeepaliveExpiry,
+        upstreamPoolConnections=args.upstreamPoolConnections,
+        upstreamPoolMaxsize=args.upstreamPoolMaxsize,
+        streamBufferSize=args.streamBufferSize,
     )
 
     return config
@@ -0,0 +1,546 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+import requests
+from ontologytimemachine.utils.config import Config, logger
+from ontologytimemachine.utils.utils import content_etag
+
+
+JOURNAL_FILE_NAME = "journal.jsonl"
+LOCK_FILE_NAME = "journal.lock"
+OBJECTS_DIR_NAME = "objects"
+# the journal is compacted once it holds this many records more than live entries
+COMPACT_MIN_RECORDS = 1024
+
+
+class DiskCache:
+    """Persistent content-addressed store for Archivo responses.
+
+    Bodies are stored once per SHA-256 digest under <directory>/objects, so
+    identical snapshots reached through different IRIs share one file. The
+    index maps cache keys to the digest plus status and headers. Once the
+    stored bodies exceed max_bytes the least recently used objects are
+    removed together with every entry pointing to them. Immutable entries
+    never expire and their objects are only evicted after all other objects
+    are gone.
+
+    The proxy workers are separate processes sharing the directory. The
+    index is an append-only journal of put and del records, written under
+    an exclusive lock on journal.lock. Every process applies the records of
+    the others before each lookup, so all of them see the same entries. An
+    object file is only removed while holding the lock and once no entry of
+    the journal refers to it. Recency for eviction is tracked per process.
+    The journal is rewritten from the live entries once it has grown
+    COMPACT_MIN_RECORDS records beyond twice their number.
+
+    As in ResponseCache, with a hard_ttl expired entries are kept as stale
+    copies instead of being removed.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float, hard_ttl: Optional[float] = None) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hard_ttl = hard_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: Dict[str, dict] = {}
+        # digest -> size, last access and the keys of the entries referring to it
+        self._objects: Dict[str, dict] = {}
+        self._bytes = 0
+        self._journal_inode: Optional[int] = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, OBJECTS_DIR_NAME), exist_ok=True)
+        self._lock_file = None
+        self._lock_pid: Optional[int] = None
+        with self._lock, self._journal_lock():
+            self._sync()
+        logger.info(
+            f"Loaded disk cache journal with {len(self._entries)} entries and {len(self._objects)} objects"
+        )
+
+    @property
+    def journal_path(self) -> str:
+        return os.path.join(self.directory, JOURNAL_FILE_NAME)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.directory, OBJECTS_DIR_NAME, digest[:2], digest)
+
+    def get(
+        self, key, max_read_bytes: Optional[int] = None, allow_stale: bool = False
+    ) -> Optional[requests.Response]:
+        """Look up key, bodies larger than max_read_bytes are not read into memory.
+
+        Such responses carry the open object file as response.body_file and its
+        length as response.body_size, the caller has to close the file.
+        """
+        key_str = self._key_to_str(key)
+        now = time.time()
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(key_str)
+            stale = entry is not None and self._is_expired(entry, now)
+            if stale and self.hard_ttl is None:
+                with self._journal_lock():
+                    self._sync()
+                    if self._entries.get(key_str) is entry:
+                        self._append([{"op": "del", "key": key_str}])
+                entry = None
+            elif stale and not (allow_stale and now < entry["stored_at"] + self.hard_ttl):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+        response = self._read(key_str, entry, max_read_bytes, stale)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def get_last_good(self, key, max_read_bytes: Optional[int] = None) -> Optional[requests.Response]:
+        """The entry for key regardless of its age, for use when the upstream fails."""
+        key_str = self._key_to_str(key)
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(key_str)
+        if entry is None:
+            return None
+        return self._read(key_str, entry, max_read_bytes, self._is_expired(entry, time.time()))
+
+    def get_headers(self, key) -> Optional[Dict[str, str]]:
+        """Headers of the entry for key regardless of its age, without reading the body."""
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(self._key_to_str(key))
+        if entry is None:
+            return None
+        return self._response(entry).headers
+
+    def put(
+        self,
+        key,
+        response: requests.Response,
+        headers: Dict[str, str],
+        immutable: bool = False,
+    ) -> bool:
+        content = response.content or b""
+        if len(content) > self.max_bytes:
+            logger.info(f"Response for {key} too large for the disk cache: {len(content)} bytes")
+            return False
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock, self._journal_lock():
+            self._sync()
+            if digest not in self._objects or not os.path.exists(self.object_path(digest)):
+                self._write_object(digest, content)
+            self._add_entry(key, digest, len(content), response, headers, immutable)
+        return True
+
+    def put_stream(
+        self,
+        key,
+        response: requests.Response,
+        headers: Dict[str, str],
+        immutable: bool = False,
+    ) -> Optional[requests.Response]:
+        """Store a streamed response while its body is sent, without holding the body in memory.
+
+        Returns a streamed response whose chunks are written to a temporary
+        file as they are read, the file is stored once the body is complete.
+        A body that is not read to the end or exceeds max_bytes is not
+        stored. Returns None without reading the body if its announced length
+        exceeds max_bytes.
+        """
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            logger.info(f"Response for {key} too large for the disk cache: {content_length} bytes")
+            return None
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.join(self.directory, OBJECTS_DIR_NAME), prefix=".tmp-"
+        )
+        writer = _StreamWriter(self, key, response, headers, immutable, os.fdopen(fd, "wb"), temp_path)
+        stored = requests.Response()
+        stored.status_code = response.status_code
+        stored.url = response.url
+        stored.headers.update(response.headers)
+        stored.raw = writer
+        stored.body_chunks = iter(writer)
+        return stored
+
+    def size(self) -> int:
+        return self._bytes
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._sync()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "objects": len(self._objects),
+                "bytes": self._bytes,
+            }
+
+    def _commit_object(
+        self,
+        key,
+        temp_path: str,
+        digest: str,
+        size: int,
+        response: requests.Response,
+        headers: Dict[str, str],
+        immutable: bool,
+    ) -> None:
+        """Move a fully written temp file of at most max_bytes into the store and add its entry."""
+        with self._lock, self._journal_lock():
+            self._sync()
+            if digest not in self._objects or not os.path.exists(self.object_path(digest)):
+                path = self.object_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+            elif os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._add_entry(key, digest, size, response, headers, immutable)
+
+    def _add_entry(
+        self,
+        key,
+        digest: str,
+        size: int,
+        response: requests.Response,
+        headers: Dict[str, str],
+        immutable: bool,
+    ) -> dict:
+        """Journal a new entry for key, called with the journal lock held and the object written."""
+        now = time.time()
+        previous = self._entries.get(self._key_to_str(key))
+        if previous is not None and previous["sha256"] == digest and "Last-Modified" in previous["headers"]:
+            # the same body stored again is not a modification
+            headers = {name: value for name, value in headers.items() if name.lower() != "last-modified"}
+            headers["Last-Modified"] = previous["headers"]["Last-Modified"]
+        entry = {
+            "sha256": digest,
+            "status_code": response.status_code,
+            "headers": headers,
+            "url": response.url,
+            "stored_at": now,
+            "expires_at": None if immutable else now + self.ttl,
+        }
+        self._append([{"op": "put", "key": self._key_to_str(key), "size": size, "entry": entry}])
+        self._evict()
+        return entry
+
+    def _read(
+        self, key_str: str, entry: dict, max_read_bytes: Optional[int], stale: bool
+    ) -> Optional[requests.Response]:
+        digest = entry["sha256"]
+        with self._lock:
+            obj = self._objects.get(digest)
+            if obj is None:
+                return None
+            obj["last_access"] = time.time()
+            size = obj["size"]
+        try:
+            body_file = open(self.object_path(digest), "rb")
+            if max_read_bytes is None or size <= max_read_bytes:
+                with body_file:
+                    content = body_file.read()
+                body_file = None
+        except OSError as e:
+            logger.error(f"Cached object {digest} could not be read: {e}")
+            self._drop_missing(key_str, digest)
+            return None
+        if body_file is not None:
+            response = self._file_response(entry, body_file, size)
+        else:
+            response = self._response(entry)
+            response._content = content
+        response.stale = stale
+        return response
+
+    def _drop_missing(self, key_str: str, digest: str) -> None:
+        """Remove the entry of an object file that is gone, unless another process replaced it meanwhile."""
+        with self._lock, self._journal_lock():
+            self._sync()
+            entry = self._entries.get(key_str)
+            if entry is not None and entry["sha256"] == digest and not os.path.exists(self.object_path(digest)):
+                self._append([{"op": "del", "key": key_str}])
+
+    @staticmethod
+    def _response(entry: dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.url = entry["url"]
+        response.headers.update(entry["headers"])
+        response.headers["ETag"] = content_etag(entry["sha256"])
+        response.stored_at = entry.get("stored_at")
+        return response
+
+    def _file_response(self, entry: dict, body_file, size: int) -> requests.Response:
+        response = self._response(entry)
+        response.body_file = body_file
+        response.body_size = size
+        return response
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return entry["expires_at"] is not None and now >= entry["expires_at"]
+
+    def _is_immutable(self, obj: dict) -> bool:
+        return any(self._entries[key_str]["expires_at"] is None for key_str in obj["keys"])
+
+    def _evict(self) -> None:
+        """Remove least recently used objects, called with the journal lock held."""
+        if self._bytes <= self.max_bytes:
+            return
+        eviction_order = sorted(
+            self._objects.items(),
+            key=lambda item: (self._is_immutable(item[1]), item[1]["last_access"]),
+        )
+        total = self._bytes
+        records = []
+        for digest, obj in eviction_order:
+            if total <= self.max_bytes:
+                break
+            total -= obj["size"]
+            records.extend({"op": "del", "key": key_str} for key_str in obj["keys"])
+            self.evictions += 1
+        self._append(records)
+
+    # journal
+
+    @contextmanager
+    def _journal_lock(self):
+        """Exclusive lock on the journal across processes, threads are serialized by self._lock.
+
+        A flock belongs to the open file, which forked workers share with
+        the process that opened the cache, so every process opens its own.
+        """
+        if self._lock_pid != os.getpid():
+            if self._lock_file is not None:
+                self._lock_file.close()
+            self._lock_file = open(os.path.join(self.directory, LOCK_FILE_NAME), "a+b")
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        """Apply the records other processes appended since the last call."""
+        try:
+            journal = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            return
+        with journal:
+            stat = os.fstat(journal.fileno())
+            if stat.st_ino != self._journal_inode:
+                # compacted by another process, start over from the new file
+                self._entries = {}
+                self._objects = {}
+                self._bytes = 0
+                self._journal_inode = stat.st_ino
+                self._journal_offset = 0
+                self._journal_records = 0
+            if stat.st_size <= self._journal_offset:
+                return
+            journal.seek(self._journal_offset)
+            data = journal.read(stat.st_size - self._journal_offset)
+        # a record still being written by another process is picked up next time
+        complete = data[: data.rfind(b"\n") + 1]
+        self._journal_offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                logger.error(f"Skipping unreadable disk cache journal record: {e}")
+                continue
+            self._apply(record)
+
+    def _append(self, records: Iterable[dict]) -> None:
+        """Write records to the journal and apply them, called with the journal lock held after _sync()."""
+        records = list(records)
+        if not records:
+            return
+        data = b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records)
+        with open(self.journal_path, "ab") as journal:
+            journal.write(data)
+            inode = os.fstat(journal.fileno()).st_ino
+        if self._journal_inode is None:
+            self._journal_inode = inode
+        affected = {self._entries[record["key"]]["sha256"] for record in records if record["key"] in self._entries}
+        for record in records:
+            self._apply(record)
+        self._journal_offset += len(data)
+        # the lock is held, so no other process can refer to these objects anymore
+        for digest in affected - self._objects.keys():
+            self._unlink_object(digest)
+        if self._journal_records > 2 * len(self._entries) + COMPACT_MIN_RECORDS:
+            self._compact()
+
+    def _apply(self, record: dict) -> None:
+        self._journal_records += 1
+        key_str = record["key"]
+        previous = self._entries.pop(key_str, None)
+        if previous is not None:
+            obj = self._objects[previous["sha256"]]
+            obj["keys"].discard(key_str)
+            if not obj["keys"]:
+                del self._objects[previous["sha256"]]
+                self._bytes -= obj["size"]
+        if record["op"] != "put":
+            return
+        entry = record["entry"]
+        self._entries[key_str] = entry
+        obj = self._objects.get(entry["sha256"])
+        if obj is None:
+            obj = {"size": record["size"], "last_access": entry["stored_at"], "keys": set()}
+            self._objects[entry["sha256"]] = obj
+            self._bytes += record["size"]
+        obj["keys"].add(key_str)
+
+    def _compact(self) -> None:
+        """Rewrite the journal from the live entries and remove unreferenced object files."""
+        records = [
+            {"op": "put", "key": key_str, "size": self._objects[entry["sha256"]]["size"], "entry": entry}
+            for key_str, entry in self._entries.items()
+        ]
+        data = b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records)
+        self._atomic_write(self.journal_path, data)
+        self._journal_inode = os.stat(self.journal_path).st_ino
+        self._journal_offset = len(data)
+        self._journal_records = len(records)
+        objects_dir = os.path.join(self.directory, OBJECTS_DIR_NAME)
+        for root, _, files in os.walk(objects_dir):
+            for name in files:
+                # temp files belong to stores in progress
+                if not name.startswith(".tmp-") and name not in self._objects:
+                    self._unlink_object(name)
+        logger.info(f"Compacted disk cache journal to {len(records)} entries")
+
+    def _unlink_object(self, digest: str) -> None:
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _write_object(self, digest: str, content: bytes) -> None:
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._atomic_write(path, content)
+
+    def _atomic_write(self, path: str, content: bytes) -> None:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def _key_to_str(key: Tuple) -> str:
+        return "\t".join(str(part) for part in key)
+
+
+class _StreamWriter:
+    # stands in for the raw stream of a response put_stream() returns, Response.close() closes it
+
+    def __init__(
+        self,
+        cache: DiskCache,
+        key,
+        response: requests.Response,
+        headers: Dict[str, str],
+        immutable: bool,
+        temp_file,
+        temp_path: str,
+    ) -> None:
+        self._cache = cache
+        self._key = key
+        self._response = response
+        self._headers = headers
+        self._immutable = immutable
+        self._temp_file = temp_file
+        self._temp_path = temp_path
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+        self._closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            for chunk in self._response.body_chunks:
+                self._write(chunk)
+                yield chunk
+            self._commit()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._discard()
+            self._response.close()
+
+    def _write(self, chunk: bytes) -> None:
+        if self._temp_file is None:
+            return
+        if self._size + len(chunk) > self._cache.max_bytes:
+            logger.info(f"Response for {self._key} too large for the disk cache: over {self._size} bytes")
+            self._discard()
+            return
+        self._temp_file.write(chunk)
+        self._sha256.update(chunk)
+        self._size += len(chunk)
+
+    def _commit(self) -> None:
+        if self._temp_file is None:
+            return
+        self._temp_file.close()
+        self._temp_file = None
+        self._cache._commit_object(
+            self._key,
+            self._temp_path,
+            self._sha256.hexdigest(),
+            self._size,
+            self._response,
+            self._headers,
+            self._immutable,
+        )
+
+    def _discard(self) -> None:
+        if self._temp_file is not None:
+            self._temp_file.close()
+            self._temp_file = None
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+DISK_CACHE: Optional[DiskCache] = None
+
+
+def configure_disk_cache(config: Config) -> None:
+    """Open the disk cache in the configured directory, an empty cacheDir disables it."""
+    global DISK_CACHE
+    if not config.cacheDir:
+        DISK_CACHE = None
+        return
+    logger.info(
+        f"Configuring disk cache in {config.cacheDir}: max bytes {config.cacheDirMaxBytes}"
+    )
+    DISK_CACHE = DiskCache(
+        config.cacheDir, config.cacheDirMaxBytes, config.cacheTtl, config.cacheHardTtl
+    )
@@ -1,132 +1,307 @@
 import os
-import hashlib
+import io
+import fcntl
+import json
 import requests
-import schedule
+import tempfile
+import threading
 import time
 import csv
 from datetime import datetime, timedelta
-from urllib.parse import urlparse
-from typing import Set, Tuple
+from typing import NamedTuple, Set, Union
+from ontologytimemachine.utils.archivo_index import (
+    ArchivoIndex,
+    MappedArchivoIndex,
+    write_snapshot,
+)
 from ontologytimemachine.utils.config import logger
 
 
-ARCHIVO_PARSED_URLS: Set[Tuple[str, str]] = set()
+ARCHIVO_INDEX: Union[ArchivoIndex, MappedArchivoIndex] = ArchivoIndex()
 
 
 ARCHIVO_FILE_PATH = "ontologytimemachine/utils/archivo_ontologies_download.txt"
+# compiled from ARCHIVO_FILE_PATH after each download, memory mapped by all workers
+ARCHIVO_SNAPSHOT_PATH = "ontologytimemachine/utils/archivo_ontologies_download.idx"
+# shipped with the package, used until a first download succeeded
+ARCHIVO_BUNDLED_FILE_PATH = "ontologytimemachine/utils/archivo_ontologies.txt"
 ARCHIVO_URL = "https://databus.dbpedia.org/ontologies/archivo-indices/ontologies/2024.07.26-220000/ontologies_type=official.csv"
-HASH_FILE_PATH = "ontologytimemachine/utils/archivo_ontologies_hash.txt"
+# ETag and Last-Modified of the last download, for conditional requests
+ARCHIVO_META_PATH = "ontologytimemachine/utils/archivo_ontologies_download.json"
+# held by the one proxy worker that downloads, the others only map its snapshot
+ARCHIVO_LOCK_PATH = "ontologytimemachine/utils/archivo_ontologies_download.lock"
 
 
 LAST_DOWNLOAD_TIMESTAMP = None
 DOWNLOAD_INTERVAL = timedelta(days=1)  # 1 day interval for checking the download
+RETRY_INITIAL_DELAY = timedelta(minutes=1)  # first retry after a failed download, doubled on every failure
+REMAP_INTERVAL = timedelta(minutes=1)  # how often workers that do not download look for a new snapshot
 
+_refresher_thread = None
+_refresher_lock = threading.Lock()
 
-def schedule_daily_download():
-    """Schedule the download to run at 3 AM every day."""
-    schedule.every().day.at("03:00").do(download_archivo_urls)
 
+def start_refresher():
+    """Start the background thread keeping the archivo index up to date, once per process."""
+    global _refresher_thread
+    # called for every request, the thread is never stopped
+    if _refresher_thread is not None:
+        return
+    with _refresher_lock:
+        if _refresher_thread is not None:
+            return
+        logger.info("Starting the background refresher for the archivo ontology index.")
+        _refresher_thread = threading.Thread(
+            target=_refresh_loop, name="otm-archivo-refresher", daemon=True
+        )
+        _refresher_thread.start()
+
+
+def _refresh_loop():
+    # only one worker downloads, the others take over when it exits
+    lock_file = acquire_download_lock(ARCHIVO_LOCK_PATH)
+    while lock_file is None:
+        time.sleep(REMAP_INTERVAL.total_seconds())
+        remap_archivo_index()
+        lock_file = acquire_download_lock(ARCHIVO_LOCK_PATH)
+    logger.info("This worker downloads the archivo ontology index.")
+    delay = _initial_refresh_delay()
+    failures = 0
     while True:
-        schedule.run_pending()
-        time.sleep(60)  # Check every minute if there’s a scheduled task
+        time.sleep(delay)
+        if refresh_archivo_index():
+            failures = 0
+            delay = DOWNLOAD_INTERVAL.total_seconds()
+        else:
+            failures += 1
+            delay = min(
+                RETRY_INITIAL_DELAY.total_seconds() * 2 ** (failures - 1),
+                DOWNLOAD_INTERVAL.total_seconds(),
+            )
+            logger.info(f"Retrying the archivo ontology download in {delay:.0f}s")
+
+
+def acquire_download_lock(path):
+    """The locked lock file if no other process holds it, otherwise None.
+
+    The lock is held while the file stays open and released by the operating
+    system when the process exits."""
+    try:
+        lock_file = open(path, "a")
+    except OSError as e:
+        logger.error(f"Error opening the archivo download lock: {e}")
+        return None
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def remap_archivo_index():
+    """Map the snapshot if the downloading worker replaced it."""
+    global ARCHIVO_INDEX
+    live_index = ARCHIVO_INDEX
+    if isinstance(live_index, MappedArchivoIndex):
+        if live_index.is_current():
+            return
+    elif not os.path.exists(ARCHIVO_SNAPSHOT_PATH):
+        return
+    new_index = open_archivo_snapshot(ARCHIVO_SNAPSHOT_PATH)
+    if new_index is not None:
+        ARCHIVO_INDEX = new_index
+        logger.info(f"Mapped new archivo index snapshot with {len(new_index)} ontology URLs.")
 
 
-# Start the scheduler in the background
-def start_scheduler():
-    logger.info("Starting the scheduler for daily archivo ontology download.")
-    schedule_daily_download()
+def _initial_refresh_delay():
+    # a download from a previous run that is recent enough does not need to be repeated
+    try:
+        age = time.time() - os.path.getmtime(ARCHIVO_FILE_PATH)
+    except OSError:
+        return 0
+    return max(0, DOWNLOAD_INTERVAL.total_seconds() - age)
+
+
+class ArchivoChanges(NamedTuple):
+    added: Set[str]
+    removed: Set[str]
 
 
-# Function to calculate hash of the downloaded file
-def calculate_file_hash(file_path):
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+def refresh_archivo_index():
+    """Download the archivo ontologies and swap in an index with the changes.
+
+    The live index is never modified, requests see either the old or the new
+    one. Returns False if the download failed."""
+    global ARCHIVO_INDEX
+    changes = download_archivo_urls()
+    if changes is None:
+        return False
+    live_index = ARCHIVO_INDEX
+    if (
+        not (changes.added or changes.removed)
+        and isinstance(live_index, MappedArchivoIndex)
+        and live_index.is_current()
+    ):
+        return True
+    # an unchanged list can still be newer than the live index, e.g. the
+    # bundled list while another worker already wrote the snapshot
+    new_index = open_archivo_snapshot(ARCHIVO_SNAPSHOT_PATH)
+    if new_index is None:
+        if not (changes.added or changes.removed):
+            return True
+        new_index = ArchivoIndex.from_iris(
+            sorted((set(live_index.iris()) - changes.removed) | changes.added)
+        )
+    ARCHIVO_INDEX = new_index
+    logger.info(f"Swapped in archivo index with {len(new_index)} ontology URLs.")
+    return True
+
+
+def read_download_metadata():
+    try:
+        with open(ARCHIVO_META_PATH, "r") as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
 
 
 # Function to download and update archivo URLs file
 def download_archivo_urls():
-    """Download the archivo ontologies file, extract the first column, and save to a text file if a new version is available."""
+    """Download the archivo ontologies file and save its first column to a text file if the ontologies changed.
+
+    The download is conditional on the ETag and Last-Modified of the previous
+    one. The new ontology URLs are compared with the live index and only
+    rewritten, together with the snapshot, if URLs were added or removed.
+    Returns the changes, which are empty if nothing changed, and None if the
+    download failed."""
     try:
         logger.info("Checking for new version of archivo ontologies")
 
-        # Download the latest archivo ontologies CSV
-        response = requests.get(ARCHIVO_URL)
-        response.raise_for_status()  # Ensure the request was successful
+        headers = {}
+        if os.path.exists(ARCHIVO_FILE_PATH) and os.path.exists(ARCHIVO_SNAPSHOT_PATH):
+            metadata = read_download_metadata()
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
 
-        # Save the file temporarily to calculate the hash
-        temp_file_path = "temp_ontology_indices.csv"
-        with open(temp_file_path, "wb") as temp_file:
-            temp_file.write(response.content)
+        # Download the latest archivo ontologies CSV
+        response = requests.get(ARCHIVO_URL, headers=headers, timeout=60)
+        if response.status_code == 304:
+            changes = ArchivoChanges(set(), set())
+        else:
+            response.raise_for_status()  # Ensure the request was successful
+            # Only the first column (URL) is of interest
+            new_iris = {
+                row[0].strip()
+                for row in csv.reader(io.StringIO(response.text), delimiter=",")
+                if row and row[0].strip()
+            }
+            current_iris = set(ARCHIVO_INDEX.iris())
+            changes = ArchivoChanges(new_iris - current_iris, current_iris - new_iris)
 
-        # Calculate the hash of the new file
-        new_file_hash = calculate_file_hash(temp_file_path)
+            if (
+                changes.added
+                or changes.removed
+                or not os.path.exists(ARCHIVO_FILE_PATH)
+                or not os.path.exists(ARCHIVO_SNAPSHOT_PATH)
+            ):
+                write_archivo_urls(sorted(new_iris))
+                compile_archivo_snapshot()
+            metadata = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            atomic_write_text(ARCHIVO_META_PATH, json.dumps(metadata))
 
-        # Compare with the existing hash if available
-        if os.path.exists(HASH_FILE_PATH):
-            with open(HASH_FILE_PATH, "r") as hash_file:
-                old_file_hash = hash_file.read().strip()
-        else:
-            old_file_hash = None
-
-        if new_file_hash != old_file_hash:
-            # New version detected, extract the first column and save to the text file
-            with open(temp_file_path, "r", newline="", encoding="utf-8") as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=",")
-                with open(ARCHIVO_FILE_PATH, "w") as txt_file:
-                    for row in csv_reader:
-                        if row:
-                            txt_file.write(
-                                row[0].strip() + "\n"
-                            )  # Write only the first column (URL) to the text file
-
-            # Save the new hash
-            with open(HASH_FILE_PATH, "w") as hash_file:
-                hash_file.write(new_file_hash)
-
-            logger.info("New version of archivo ontologies downloaded and saved.")
+        if changes.added or changes.removed:
+            logger.info(
+                f"New version of archivo ontologies downloaded and saved: "
+                f"{len(changes.added)} added, {len(changes.removed)} removed."
+            )
         else:
-            # No new version, remove the temporary file
-            os.remove(temp_file_path)
+            # No new version, only touch the file to record the successful check
+            os.utime(ARCHIVO_FILE_PATH)
             logger.info("No new version of archivo ontologies detected.")
 
         # Update the last download timestamp
         global LAST_DOWNLOAD_TIMESTAMP
         LAST_DOWNLOAD_TIMESTAMP = datetime.now()
+        return changes
 
-    except requests.RequestException as e:
+    except (requests.RequestException, OSError) as e:
         logger.error(f"Failed to download archivo ontologies: {e}")
+        return None
+
+
+def write_archivo_urls(iris):
+    atomic_write_text(ARCHIVO_FILE_PATH, "".join(iri + "\n" for iri in iris))
+
+
+def atomic_write_text(path, text):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def compile_archivo_snapshot():
+    with open(ARCHIVO_FILE_PATH, "r") as file:
+        entries = write_snapshot(file, ARCHIVO_SNAPSHOT_PATH)
+    logger.info(f"Compiled archivo index snapshot with {entries} ontology URLs.")
+
+
+def open_archivo_snapshot(file_path):
+    try:
+        return MappedArchivoIndex(file_path)
+    except FileNotFoundError:
+        logger.info(f"No archivo index snapshot at {file_path}")
+    except (OSError, ValueError) as e:
+        logger.error(f"Error opening archivo index snapshot: {e}")
+    return None
+
+
+def read_archivo_index(file_path):
+    try:
+        with open(file_path, "r") as file:
+            return ArchivoIndex.from_iris(file)
+    except FileNotFoundError:
+        logger.error(f"Archivo ontology file not found: {file_path}")
+    except Exception as e:
+        logger.error(f"Error loading archivo ontology URLs: {e}")
+    return None
 
 
 def load_archivo_urls():
-    """Load the archivo URLs into the global variable if not already loaded or if a day has passed since the last download."""
-    global ARCHIVO_PARSED_URLS
-    global LAST_DOWNLOAD_TIMESTAMP
-
-    # Check if ARCHIVO_PARSED_URLS is empty or the last download was over a day ago
-    if not ARCHIVO_PARSED_URLS or (
-        LAST_DOWNLOAD_TIMESTAMP is None
-        or datetime.now() - LAST_DOWNLOAD_TIMESTAMP > DOWNLOAD_INTERVAL
-    ):
-        logger.info(
-            "ARCHIVO_PARSED_URLS is empty or more than a day has passed since the last download."
-        )
-        download_archivo_urls()
-
-    # Load archivo URLs after downloading or if already present
-    if not ARCHIVO_PARSED_URLS:  # Load only if the set is empty
-        logger.info("Loading archivo ontologies from file")
-        try:
-            with open(ARCHIVO_FILE_PATH, "r") as file:
-                ARCHIVO_PARSED_URLS = {
-                    (urlparse(line.strip()).netloc, urlparse(line.strip()).path)
-                    for line in file
-                }
-            logger.info(f"Loaded {len(ARCHIVO_PARSED_URLS)} ontology URLs.")
-
-        except FileNotFoundError:
-            logger.error("Archivo ontology file not found.")
-        except Exception as e:
-            logger.error(f"Error loading archivo ontology URLs: {e}")
+    """Return the current archivo index, requests never wait for a download.
+
+    On first use the snapshot compiled from the last download is mapped, or if
+    there is none the bundled list is parsed, and the background refresher is
+    started."""
+    global ARCHIVO_INDEX
+
+    if not ARCHIVO_INDEX:
+        with _refresher_lock:
+            if not ARCHIVO_INDEX:
+                logger.info("Loading archivo ontologies from file")
+                index = open_archivo_snapshot(ARCHIVO_SNAPSHOT_PATH)
+                if index:
+                    ARCHIVO_INDEX = index
+                    logger.info(f"Mapped {len(ARCHIVO_INDEX)} ontology URLs from {ARCHIVO_SNAPSHOT_PATH}.")
+                else:
+                    for file_path in (ARCHIVO_FILE_PATH, ARCHIVO_BUNDLED_FILE_PATH):
+                        if os.path.exists(file_path):
+                            index = read_archivo_index(file_path)
+                            if index:
+                                ARCHIVO_INDEX = index
+                                logger.info(f"Loaded {len(ARCHIVO_INDEX)} ontology URLs from {file_path}.")
+                                break
+
+    start_refresher()
+    return ARCHIVO_INDEX
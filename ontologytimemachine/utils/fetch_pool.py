@@ -0,0 +1,96 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from ontologytimemachine.utils.config import Config, logger
+
+
+class FetchPoolFull(Exception):
+    pass
+
+
+class FetchPool:
+    """Bounded thread pool for the blocking upstream fetches of the proxy.
+
+    At most max_workers fetches run at the same time and at most max_queue
+    further fetches wait for a free worker, submitting more raises
+    FetchPoolFull. The executor is created on first use so that it is
+    started inside the proxy worker process and not before forking.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, thread_name_prefix: str = "otm-fetch") -> None:
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.thread_name_prefix = thread_name_prefix
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise FetchPoolFull(
+                f"{self.max_workers} fetches running and {self.max_queue} waiting"
+            )
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix
+                )
+            return self._executor
+
+
+def run_or_submit(pool: FetchPool, fn: Callable[..., Any], *args: Any) -> Future:
+    """Submit fn to pool, if the pool is full run it in the calling thread instead."""
+    try:
+        return pool.submit(fn, *args)
+    except FetchPoolFull:
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+_default_cfg = Config()
+FETCH_POOL = FetchPool(_default_cfg.fetchPoolSize, _default_cfg.fetchQueueDepth)
+# the racing fetches of a hedged request, each request on the fetch pool runs up to two
+HEDGE_POOL = FetchPool(
+    2 * _default_cfg.fetchPoolSize, _default_cfg.fetchQueueDepth, thread_name_prefix="otm-hedge"
+)
+# the racing scheme forms of an Archivo download, requested from fetch and hedge
+# threads, a separate pool so that a hedge thread never waits for its own pool
+RACE_POOL = FetchPool(
+    2 * _default_cfg.fetchPoolSize, _default_cfg.fetchQueueDepth, thread_name_prefix="otm-race"
+)
+
+
+def configure_fetch_pool(config: Config) -> None:
+    global FETCH_POOL, HEDGE_POOL, RACE_POOL
+    logger.info(
+        f"Configuring fetch pool: {config.fetchPoolSize} workers, queue depth {config.fetchQueueDepth}"
+    )
+    FETCH_POOL.shutdown()
+    FETCH_POOL = FetchPool(config.fetchPoolSize, config.fetchQueueDepth)
+    HEDGE_POOL.shutdown()
+    HEDGE_POOL = FetchPool(
+        2 * config.fetchPoolSize, config.fetchQueueDepth, thread_name_prefix="otm-hedge"
+    )
+    RACE_POOL.shutdown()
+    RACE_POOL = FetchPool(
+        2 * config.fetchPoolSize, config.fetchQueueDepth, thread_name_prefix="otm-race"
+    )
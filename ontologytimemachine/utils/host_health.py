@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+from ontologytimemachine.utils.config import Config, logger
+
+
+HOST_HEALTH_MAX_HOSTS = 10000
+# timeout of a host without latency samples, the former fixed timeout
+INITIAL_TIMEOUT = 3.0
+LATENCY_WINDOW = 64
+LATENCY_PERCENTILE = 0.95
+# the timeout leaves this much headroom over the latency percentile
+TIMEOUT_FACTOR = 4.0
+EWMA_ALPHA = 0.2
+# a host failing this share of its recent requests is cut off as well
+ERROR_RATE_THRESHOLD = 0.5
+ERROR_RATE_MIN_REQUESTS = 10
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class HostState:
+    """Latency and error statistics and circuit state of one upstream host."""
+
+    def __init__(self) -> None:
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.circuit = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+
+
+class HostHealth:
+    """Tracks the health of upstream hosts and derives their timeouts.
+
+    Each host gets a timeout of TIMEOUT_FACTOR times the 95th percentile of
+    its recent response times, clamped to [min_timeout, max_timeout]. After
+    failure_threshold consecutive failures, or when most recent requests
+    failed, the circuit of the host opens and allow() refuses requests for
+    open_seconds. Then a single probe request is let through (half-open), its
+    success closes the circuit again and its failure reopens it. At most
+    max_hosts hosts are tracked, the least recently used ones are dropped.
+    """
+
+    def __init__(
+        self,
+        min_timeout: float,
+        max_timeout: float,
+        failure_threshold: int,
+        open_seconds: float,
+        max_hosts: int = HOST_HEALTH_MAX_HOSTS,
+    ) -> None:
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_hosts = max_hosts
+        self.rejected = 0
+        self._hosts: "OrderedDict[str, HostState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def timeout(self, host: str) -> float:
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or not state.latencies:
+                return min(max(INITIAL_TIMEOUT, self.min_timeout), self.max_timeout)
+            latencies = sorted(state.latencies)
+        percentile = latencies[min(int(len(latencies) * LATENCY_PERCENTILE), len(latencies) - 1)]
+        return min(max(percentile * TIMEOUT_FACTOR, self.min_timeout), self.max_timeout)
+
+    def allow(self, host: str) -> bool:
+        """Whether a request to host may be sent, claims the probe of a half-open circuit."""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state.circuit == CLOSED:
+                return True
+            if state.circuit == OPEN and time.monotonic() >= state.opened_at + self.open_seconds:
+                logger.info(f"Circuit for {host} is half-open, sending a probe request")
+                state.circuit = HALF_OPEN
+            if state.circuit == HALF_OPEN and not state.probing:
+                state.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, host: str, latency: float) -> None:
+        with self._lock:
+            state = self._state(host)
+            state.latencies.append(latency)
+            if state.latency_ewma is None:
+                state.latency_ewma = latency
+            else:
+                state.latency_ewma += EWMA_ALPHA * (latency - state.latency_ewma)
+            self._record(state, failed=False)
+            if state.circuit != CLOSED:
+                logger.info(f"Circuit for {host} is closed again")
+                state.circuit = CLOSED
+
+    def record_failure(self, host: str) -> None:
+        with self._lock:
+            state = self._state(host)
+            self._record(state, failed=True)
+            if state.circuit == HALF_OPEN or (
+                state.circuit == CLOSED
+                and (
+                    state.consecutive_failures >= self.failure_threshold
+                    or (
+                        state.requests >= ERROR_RATE_MIN_REQUESTS
+                        and state.error_rate >= ERROR_RATE_THRESHOLD
+                    )
+                )
+            ):
+                logger.warning(
+                    f"Circuit for {host} is open for {self.open_seconds}s after "
+                    f"{state.consecutive_failures} consecutive failures, error rate {state.error_rate:.2f}"
+                )
+                state.circuit = OPEN
+                state.opened_at = time.monotonic()
+
+    def circuit(self, host: str) -> str:
+        with self._lock:
+            state = self._hosts.get(host)
+            return CLOSED if state is None else state.circuit
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                host: {
+                    "circuit": state.circuit,
+                    "latency_ewma": state.latency_ewma,
+                    "error_rate": state.error_rate,
+                    "requests": state.requests,
+                }
+                for host, state in self._hosts.items()
+            }
+
+    def __len__(self) -> int:
+        return len(self._hosts)
+
+    def _state(self, host: str) -> HostState:
+        state = self._hosts.pop(host, None)
+        if state is None:
+            state = HostState()
+        self._hosts[host] = state
+        while len(self._hosts) > self.max_hosts:
+            self._hosts.popitem(last=False)
+        return state
+
+    @staticmethod
+    def _record(state: HostState, failed: bool) -> None:
+        state.requests += 1
+        state.probing = False
+        state.consecutive_failures = state.consecutive_failures + 1 if failed else 0
+        state.error_rate += EWMA_ALPHA * (float(failed) - state.error_rate)
+
+
+_default_cfg = Config()
+HOST_HEALTH = HostHealth(
+    _default_cfg.upstreamTimeoutMin,
+    _default_cfg.upstreamTimeoutMax,
+    _default_cfg.circuitFailureThreshold,
+    _default_cfg.circuitOpenSeconds,
+)
+
+
+def configure_host_health(config: Config) -> None:
+    global HOST_HEALTH
+    logger.info(
+        f"Configuring host health: timeouts {config.upstreamTimeoutMin}-{config.upstreamTimeoutMax}s, "
+        f"circuit opens after {config.circuitFailureThreshold} failures for {config.circuitOpenSeconds}s"
+    )
+    HOST_HEALTH = HostHealth(
+        config.upstreamTimeoutMin,
+        config.upstreamTimeoutMax,
+        config.circuitFailureThreshold,
+        config.circuitOpenSeconds,
+    )
@@ -1,11 +1,15 @@
 import requests
 
+# all responses built here are answered by the proxy itself, they carry
+# proxy_generated to tell them apart from answers of an upstream server
+
 
 def mock_response_200():
     mock_response = requests.Response()
     mock_response.status_code = 200
     mock_response.url = 'https://example.com/success'
     mock_response.headers['Content-Type'] = 'text/html'
+    mock_response.proxy_generated = True
     mock_response._content = b'<html><body><h1>To be implemented</h1></body></html>'
     return mock_response
 
@@ -15,6 +19,7 @@ def mock_response_403():
     mock_response.status_code = 403
     mock_response.url = 'https://example.com/forbidden'
     mock_response.headers['Content-Type'] = 'text/html'
+    mock_response.proxy_generated = True
     mock_response._content = b'<html><body><h1>403 Forbidden</h1></body></html>'
     return mock_response
 
@@ -25,6 +30,7 @@ def mock_response_404():
     mock_response.status_code = 404
     mock_response.url = 'https://example.com/resource-not-found'
     mock_response.headers['Content-Type'] = 'text/html'
+    mock_response.proxy_generated = True
     mock_response._content = b'<html><body><h1>404 Not Found</h1></body></html>'
     return mock_response
 
@@ -34,5 +40,17 @@ def mock_response_500():
     mock_response.status_code = 500
     mock_response.url = 'https://example.com/internal-server-error'
     mock_response.headers['Content-Type'] = 'text/html'
+    mock_response.proxy_generated = True
     mock_response._content = b'<html><body><h1>500 Internal Server Error</h1></body></html>'
-    return mock_response
\ No newline at end of file
+    return mock_response
+
+def mock_response_503(retry_after=None):
+    mock_response = requests.Response()
+    mock_response.status_code = 503
+    mock_response.url = 'https://example.com/service-unavailable'
+    mock_response.headers['Content-Type'] = 'text/html'
+    mock_response.proxy_generated = True
+    if retry_after is not None:
+        mock_response.headers['Retry-After'] = str(retry_after)
+    mock_response._content = b'<html><body><h1>503 Service Unavailable</h1></body></html>'
+    return mock_response
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from ontologytimemachine.utils.config import Config, logger
+
+
+NEGATIVE_CACHE_MAX_ENTRIES = 10000
+
+
+class NegativeCache:
+    """Remembers failed upstream lookups for a short time.
+
+    A value, usually the reason of the failure, is stored per key and
+    returned until ttl seconds have passed, so that requests for the same
+    dead or unknown resource skip the upstream round trip and go straight to
+    their fallback. At most max_entries keys are kept, the least recently
+    stored ones are dropped first. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = NEGATIVE_CACHE_MAX_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if now >= expires_at:
+                del self._entries[key]
+                return None
+            self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "entries": len(self._entries)}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+NEGATIVE_CACHE = NegativeCache(Config().negativeCacheTtl)
+
+
+def configure_negative_cache(config: Config) -> None:
+    global NEGATIVE_CACHE
+    logger.info(f"Configuring negative cache: ttl {config.negativeCacheTtl}s")
+    NEGATIVE_CACHE = NegativeCache(config.negativeCacheTtl)
@@ -1,23 +1,47 @@
-import requests
-from ontologytimemachine.utils.config import parse_arguments
-from ontologytimemachine.proxy_wrapper import AbstractRequestWrapper
+import threading
+import time
+from urllib.parse import urlsplit
+from concurrent.futures import FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
+from ontologytimemachine.utils.config import parse_client_config
+from ontologytimemachine.proxy_wrapper import AbstractRequestWrapper, RequestSnapshot
 from ontologytimemachine.utils.config import Config, HttpsInterception
-from ontologytimemachine.utils.utils import (
-    set_onto_format_headers,
-    get_format_from_accept_header,
-)
+from ontologytimemachine.utils.utils import set_onto_format_headers
 from ontologytimemachine.utils.download_archivo_urls import load_archivo_urls
 from ontologytimemachine.utils.utils import (
-    parse_accept_header_with_priority,
     archivo_api,
+    host_failure_status_codes,
     passthrough_status_codes,
+    served_proxy_status_codes,
+    strip_conditional_headers,
+)
+from ontologytimemachine.utils.response_cache import (
+    archivo_cache_key,
+    conditional_response,
+    copy_response,
+    get_cached_response,
+    get_last_good_response,
+    is_stale,
+    store_cached_response,
 )
+from ontologytimemachine.utils import (
+    admission,
+    fetch_pool,
+    host_health,
+    negative_cache,
+    scheme_preference,
+    single_flight,
+    upstream_limits,
+)
+from ontologytimemachine.utils.fetch_pool import FetchPoolFull, run_or_submit
+from ontologytimemachine.utils.single_flight import SingleFlightTimeout
+from ontologytimemachine.utils.upstream import upstream_request
+from ontologytimemachine.utils.streaming import SharedBody, close_response, is_streamed
 from ontologytimemachine.utils.mock_responses import (
     mock_response_403,
     mock_response_404,
     mock_response_500,
+    mock_response_503,
 )
-from typing import Set, Tuple
 from ontologytimemachine.utils.config import (
     OntoFormat,
     OntoFormatConfig,
@@ -51,12 +75,37 @@ def get_response_from_request(wrapped_request, config):
         logger.warning(
             "Request denied: not an ontology request and only ontologies mode is enabled"
         )
-        return mock_response_403
+        return mock_response_403()
 
     response = proxy_logic(wrapped_request, config)
     return response
 
 
+def get_response_from_intercepted_request(wrapped_request, config):
+    # inside an intercepted TLS tunnel, requests without a response or with an
+    # upstream error are passed on to the original server, answers of the
+    # proxy itself like the 403 of restrictedAccess are sent as they are
+    response = get_response_from_request(wrapped_request, config)
+    if response is not None and (
+        response.ok
+        or (
+            getattr(response, "proxy_generated", False)
+            and response.status_code in served_proxy_status_codes
+        )
+    ):
+        return response
+    if response is not None:
+        close_response(response)
+    logger.info("No usable response from proxy logic, passing request through to the original server")
+    ontology, _, _ = wrapped_request.get_request_url_host_path()
+    return request_ontology(
+        wrapped_request,
+        ontology,
+        wrapped_request.get_request_headers(),
+        disableRemovingRedirects=True,
+    )
+
+
 # curl -U "--ca-key-file+ca-key.pem+--ca-cert-file+ca-cert.pem+--ca-signing-key-file+ca-signing-key.pem+--hostname+0.0.0.0+--port+%24PORT+--plugins+ontologytimemachine.custom_proxy.OntologyTimeMachinePlugin+http%3A%2F%2Fweb.de%2F%3Ffoo%3Dbar%26bar%3Dfoo%23whateversssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssssss:pas" -kvvvx http://localhost:8899 https:///www.example.org
 # decode auth username (is in www-form encoding not to beconfused with url encoding!)
 # parameters parsed into config object
@@ -67,11 +116,13 @@ def evaluate_configuration(wrapped_request, config):
     logger.info(f'Evaluate configuration, auth str: {authentication_str}')
     if authentication_str:
         logger.info("Authentication parameters provided, parsing the configuration.")
-        username, password = authentication_str.split(":")
+        username, _, password = authentication_str.partition(":")
         logger.info(username)
-        config_list = username.split(" ")
-        config = parse_arguments(config_list)
-        return config
+        try:
+            return parse_client_config(username)
+        except ValueError as e:
+            logger.error(f"Invalid configuration in the proxy authentication: {e}")
+            return None
     else:
         if config.clientConfigViaProxyAuth == ClientConfigViaProxyAuth.OPTIONAL:
             logger.info(
@@ -87,93 +138,140 @@ def evaluate_configuration(wrapped_request, config):
 
 def is_archivo_ontology_request(wrapped_request):
     """Check if the requested ontology is in the archivo."""
+    # Extract the request's host and path
+    request_host = wrapped_request.get_request_host()
+    request_path = wrapped_request.get_request_path()
+
+    # Every call site of one request shares the classification made first
+    previous = wrapped_request.archivo_classification
+    if previous is not None and previous[:2] == (request_host, request_path):
+        return previous[2]
+
     logger.info("Check if the requested ontology is in archivo")
 
     # Ensure the archivo URLs are loaded
-    load_archivo_urls()
-    from ontologytimemachine.utils.download_archivo_urls import ARCHIVO_PARSED_URLS
+    archivo_index = load_archivo_urls()
 
-    # Extract the request's host and path
-    request_host = wrapped_request.get_request_host()
-    request_path = wrapped_request.get_request_path()
-    
-    if not request_path:
-        return any(request_host == url_host for url_host, _ in ARCHIVO_PARSED_URLS)
+    # Most traffic is not for an ontology host, reject it without a path lookup
+    if not archivo_index.has_host(request_host):
+        logger.info(f"Requested host: {request_host} has no ontology in Archivo")
+        wrapped_request.archivo_classification = (request_host, request_path, False)
+        return False
 
-    if (request_host, request_path) in ARCHIVO_PARSED_URLS:
-        logger.info(f"Requested URL: {request_host+request_path} is in Archivo")
+    if not request_path:
+        wrapped_request.archivo_classification = (request_host, request_path, True)
         return True
 
-    # Remove last hash and check again
-    if request_path.endswith("/"):
-        request_path = request_path.rstrip("/")
-    if (request_host, request_path) in ARCHIVO_PARSED_URLS:
-        wrapped_request.set_request_path(request_path)
-        logger.info(f"Requested URL: {request_host+request_path} is in Archivo")
-        return True
+    # Longest ontology IRI registered in Archivo that is a prefix of the requested URL
+    match = archivo_index.classify(request_host, request_path)
+    if match is None:
+        logger.info(f"Requested URL: {request_host+request_path} is NOT in Archivo")
+        wrapped_request.archivo_classification = (request_host, request_path, False)
+        return False
 
-    # Cut the last part of the path
+    if match.path != request_path:
+        wrapped_request.set_request_path(match.path)
+    logger.info(f"Requested URL: {request_host+match.path} is in Archivo")
+    wrapped_request.archivo_classification = (request_host, match.path, True)
+    wrapped_request.archivo_iri = match.iri
+    return True
 
-    path_parts = request_path.split("/")
-    new_path = "/".join(path_parts[:-1])
 
-    if (request_host, new_path) in ARCHIVO_PARSED_URLS:
-        wrapped_request.set_request_path(new_path)
-        logger.info(f"Requested URL: {request_host+new_path} is in Archivo")
-        return True
+def request_ontology(wrapped_request, url, headers, disableRemovingRedirects=False, timeout=None):
+    allow_redirects = not disableRemovingRedirects
+    method = "HEAD" if wrapped_request.is_head_request() else "GET"
+    host = urlsplit(url).netloc
+    limiter = upstream_limits.UPSTREAM_LIMITER
+    if not limiter.acquire(host):
+        return upstream_busy_response(limiter.retry_after)
+    try:
+        health = host_health.HOST_HEALTH
+        if not health.allow(host):
+            # fail fast into the failover or cached path
+            logger.info(f"Not requesting {url}, the circuit for {host} is open")
+            return None
+        if timeout is None:
+            timeout = health.timeout(host)
+        logger.info(f'Request parameters: url - {url}, headers - {headers}, allow_redirects - {allow_redirects}, timeout - {timeout:.2f}')
+        start = time.monotonic()
+        try:
+            # large GET bodies are streamed to the client instead of being buffered
+            response = upstream_request(
+                method, url, headers, allow_redirects, timeout, stream=method == "GET"
+            )
+        except Exception as e:
+            health.record_failure(host)
+            logger.error(f"Error fetching original ontology: {e}")
+            return None
+    finally:
+        # a streamed body is read after the slot is released, bounded by the fetch pool
+        limiter.release(host)
+    if response.status_code in host_failure_status_codes:
+        health.record_failure(host)
+    else:
+        health.record_success(host, time.monotonic() - start)
+    logger.info(f"Successfully fetched ontology - status_code: {response.status_code}")
+    return response
 
-    new_path = new_path + "/"
-    if (request_host, new_path) in ARCHIVO_PARSED_URLS:
-        wrapped_request.set_request_path(new_path)
-        logger.info(f"Requested URL: {request_host+new_path} is in Archivo")
-        return True
 
-    new_path = "/".join(path_parts[:-2])
-    if (request_host, new_path) in ARCHIVO_PARSED_URLS:
-        wrapped_request.set_request_path(new_path)
-        logger.info(f"Requested URL: {request_host+new_path} is in Archivo")
-        return True
+def upstream_busy_response(retry_after):
+    """The 503 answer for a request refused by the upstream limits, it says nothing about the upstream host."""
+    response = mock_response_503(retry_after)
+    response.upstream_busy = True
+    return response
 
-    new_path = new_path + "/"
-    if (request_host, new_path) in ARCHIVO_PARSED_URLS:
-        wrapped_request.set_request_path(new_path)
-        logger.info(f"Requested URL: {request_host+new_path} is in Archivo")
-        return True
 
-    logger.info(f"Requested URL: {request_host+request_path} is NOT in Archivo")
-    return False
+def is_upstream_busy(response):
+    return getattr(response, "upstream_busy", False)
 
 
-def request_ontology(wrapped_request, url, headers, disableRemovingRedirects=False, timeout=3):
-    allow_redirects = not disableRemovingRedirects
-    logger.info(f'Request parameters: url - {url}, headers - {headers}, allow_redirects - {allow_redirects}')
+def request_archivo(wrapped_request, url, headers):
+    # concurrent requests for the same Archivo resource share one upstream fetch
+    method = "HEAD" if wrapped_request.is_head_request() else "GET"
+    # conditional requests are answered by the proxy after the fetch
+    headers = strip_conditional_headers(headers)
+    key = (method, url, headers.get("Accept", ""))
     try:
-        if wrapped_request.is_head_request():
-            response = requests.head(url=url, headers=headers, allow_redirects=allow_redirects, timeout=timeout)
-        else:
-            response = requests.get(url=url, headers=headers, allow_redirects=allow_redirects, timeout=timeout)
-        logger.info(f"Successfully fetched ontology - status_code: {response.status_code}")
-        return response
-    except Exception as e:
-        logger.error(f"Error fetching original ontology: {e}")
+        response, _ = single_flight.UPSTREAM_FLIGHTS.do(
+            key, lambda: request_ontology(wrapped_request, url, headers), share_response
+        )
+    except SingleFlightTimeout as e:
+        logger.error(f"Error fetching ontology from Archivo: {e}")
         return None
+    return response
+
+
+def share_response(response, callers):
+    """One copy of an upstream response per request waiting for it."""
+    if response is None or callers == 1:
+        return [response] * callers
+    if is_streamed(response):
+        # the body is read from the upstream once, every request gets its own reader
+        return SharedBody(response, callers).responses()
+    return [response] + [copy_response(response) for _ in range(callers - 1)]
 
 
 # change the function definition and pass only the config
 def proxy_logic(wrapped_request, config):
     logger.info("Proxy starting to analyze request")
 
-    response = mock_response_500 #default if we somehow forget to set the response
-    set_onto_format_headers(wrapped_request, config)
+    response = mock_response_500() #default if we somehow forget to set the response
+    # negotiated once, the result is carried through the fetch functions
+    negotiation = set_onto_format_headers(wrapped_request, config)
 
     headers = wrapped_request.get_request_headers()
 
     # if the requested format is not in Archivo and the ontoVersion is not original
     # we can stop because the archivo request will not go through
-    format = get_format_from_accept_header(headers)
-    if not format and config.ontoVersion != OntoVersion.ORIGINAL:
+    if not negotiation.format and config.ontoVersion != OntoVersion.ORIGINAL:
         logger.info(f"No format can be used from Archivo")
-        return mock_response_500
+        return mock_response_500()
+
+    if wrapped_request.degraded and config.ontoVersion in (
+        OntoVersion.ORIGINAL_FAILOVER_LIVE_LATEST,
+        OntoVersion.LATEST_ARCHIVED,
+    ):
+        return fetch_degraded(wrapped_request, headers, config, negotiation)
 
     if config.ontoVersion == OntoVersion.ORIGINAL:
         logger.info('OntoVersion ORIGINAL')
@@ -182,14 +280,18 @@ def proxy_logic(wrapped_request, config):
     elif config.ontoVersion == OntoVersion.ORIGINAL_FAILOVER_LIVE_LATEST:
         logger.info('OntoVersion ORIGINAL_FAILOVER_LIVE_LATEST')
         response = fetch_failover(
-            wrapped_request, headers, config.disableRemovingRedirects
+            wrapped_request,
+            headers,
+            config.disableRemovingRedirects,
+            negotiation,
+            config.failoverHedgeDelay,
         )
     elif config.ontoVersion == OntoVersion.LATEST_ARCHIVED:
         logger.info('OntoVersion LATEST_ARCHIVED')
-        response = fetch_latest_archived(wrapped_request, headers)
+        response = fetch_latest_archived(wrapped_request, headers, negotiation)
     elif config.ontoVersion == OntoVersion.TIMESTAMP_ARCHIVED:
         logger.info('OntoVersion TIMESTAMP_ARCHIVED')
-        response = fetch_timestamp_archived(wrapped_request, headers, config)
+        response = fetch_timestamp_archived(wrapped_request, headers, config, negotiation)
     # Commenting the manifest related part because it is not supported in the current version
     # elif ontoVersion == 'dependencyManifest':
     #     response = fetch_dependency_manifest(ontology, headers, manifest)
@@ -205,77 +307,334 @@ def fetch_original(wrapped_request, ontology, headers, config):
     )
 
 
+# Overloaded worker, no Archivo lookup
+def fetch_degraded(wrapped_request, headers, config, negotiation):
+    """Answer without asking Archivo while the admission control degrades requests.
+
+    Failover passes the request through to the original server, latestArchived
+    serves a cached copy of any age and answers 503 without one.
+    """
+    ontology, _, _ = wrapped_request.get_request_url_host_path()
+    if config.ontoVersion == OntoVersion.ORIGINAL_FAILOVER_LIVE_LATEST:
+        logger.info(f"Degraded: fetching original ontology {ontology} without failover")
+        return fetch_original(wrapped_request, ontology, headers, config)
+    if not is_archivo_ontology_request(wrapped_request):
+        return mock_response_404()
+    # the path may have been rewritten to the one in the Archivo index
+    ontology, _, _ = wrapped_request.get_request_url_host_path()
+    cache_key = archivo_cache_key(ontology, negotiation.format, OntoVersion.LATEST_ARCHIVED)
+    response = get_cached_response(wrapped_request, cache_key, allow_stale=True)
+    if response is None:
+        response = get_last_good_response(wrapped_request, cache_key)
+    if response is None:
+        logger.info(f"Degraded: no cached copy of {ontology}")
+        return mock_response_503(admission.RETRY_AFTER)
+    return conditional_response(wrapped_request, response)
+
+
 # Failover mode
-def fetch_failover(wrapped_request, headers, disableRemovingRedirects):
+def fetch_failover(wrapped_request, headers, disableRemovingRedirects, negotiation, hedgeDelay=-1):
     ontology, _, _ = wrapped_request.get_request_url_host_path()
-    logger.info(f"Fetching original ontology with failover from URL: {ontology}")
-    original_response = request_ontology(
-        wrapped_request, ontology, headers, disableRemovingRedirects
+    requested_mimetypes = negotiation.requested_mimetypes
+    # origins that failed recently are not waited for again
+    unreachable_key = ("origin", ontology)
+    unusable_key = ("origin", ontology, requested_mimetypes)
+    reason = negative_cache.NEGATIVE_CACHE.get(unreachable_key) or negative_cache.NEGATIVE_CACHE.get(
+        unusable_key
     )
-    logger.info(f'Original response: {original_response}')
-    if original_response:
-        logger.info('Got an original response')
-        if original_response.status_code in passthrough_status_codes:
-            requested_mimetypes_with_priority = parse_accept_header_with_priority(
-                headers["Accept"]
+    if reason is not None:
+        logger.info(f"Skipping original ontology {ontology}, recently {reason}")
+        return fetch_latest_archived(wrapped_request, headers, negotiation)
+    logger.info(f"Fetching original ontology with failover from URL: {ontology}")
+    original_args = (wrapped_request, ontology, headers, disableRemovingRedirects)
+    archived_future = None
+    if hedgeDelay < 0:
+        original_response = request_ontology(*original_args)
+    else:
+        # hedging: Archivo is requested as well if the original server is slow to answer
+        # the fetches run on after a lost race or a missed deadline, without the request
+        snapshot = RequestSnapshot(wrapped_request)
+        original_args = (snapshot, ontology, headers, disableRemovingRedirects)
+        original_deadline = time.monotonic() + upstream_deadline()
+        original_future = run_or_submit(fetch_pool.HEDGE_POOL, request_ontology, *original_args)
+        wait([original_future], timeout=hedgeDelay)
+        if not original_future.done():
+            logger.info(f"No original response after {hedgeDelay}s, requesting Archivo in parallel")
+            # both scheme forms may be requested one after the other
+            archived_deadline = time.monotonic() + 2 * upstream_deadline()
+            archived_future = run_or_submit(
+                fetch_pool.HEDGE_POOL, fetch_latest_archived, snapshot, headers, negotiation
+            )
+            wait(
+                [original_future, archived_future],
+                timeout=max(archived_deadline - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED,
             )
-            requested_mimetypes = [x[0] for x in requested_mimetypes_with_priority]
-            response_mime_type = original_response.headers.get("Content-Type", ";").split(
-                ";"
-            )[0]
-            logger.info(f"Requested mimetypes: {requested_mimetypes}")
-            logger.info(f"Response mimetype: {response_mime_type}")
-            if response_mime_type in requested_mimetypes:
-                return original_response
-            else:
-                logger.info(f"The returned type is not the same as the requested one")
-                return fetch_latest_archived(wrapped_request, headers)
-        else:
-            logger.info(f"The returend status code is not accepted: {original_response.status_code}")
-            return fetch_latest_archived(wrapped_request, headers)
+            if not original_future.done() and archived_future.done():
+                archived_response = archived_future.result()
+                if archived_response is not None and archived_response.ok:
+                    logger.info("Archivo answered before the original server")
+                    discard_response(original_future)
+                    return archived_response
+        original_response = result_before(original_future, original_deadline)
+    logger.info(f'Original response: {original_response}')
+    reason = unusable_original_reason(original_response, requested_mimetypes)
+    if reason is None:
+        if archived_future is not None:
+            discard_response(archived_future)
+        return original_response
+    logger.info(f"Original ontology {ontology} {reason}")
+    if original_response is None:
+        negative_cache.NEGATIVE_CACHE.put(unreachable_key, reason)
     else:
-        logger.info("No original response")
-        return fetch_latest_archived(wrapped_request, headers)
+        # a refusal by the upstream limits says nothing about the origin
+        if not is_upstream_busy(original_response):
+            negative_cache.NEGATIVE_CACHE.put(unusable_key, reason)
+        close_response(original_response)
+    if archived_future is not None:
+        return result_before(archived_future, archived_deadline)
+    return fetch_latest_archived(wrapped_request, headers, negotiation)
+
+
+def upstream_deadline():
+    """Seconds after which a single upstream fetch has finished or failed.
+
+    The fetch waits up to the queue timeout for a slot of the upstream limits,
+    then for the connection and the first byte, each up to the host timeout.
+    """
+    return (
+        upstream_limits.UPSTREAM_LIMITER.queue_timeout
+        + 2 * host_health.HOST_HEALTH.max_timeout
+    )
+
+
+def result_before(future, deadline):
+    """The response of a fetch future, None if it is not done by the monotonic deadline."""
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except FutureTimeoutError:
+        logger.warning("Giving up on a fetch that did not finish in time")
+        discard_response(future)
+        return None
+
+
+def unusable_original_reason(original_response, requested_mimetypes):
+    """Why the response of the original server can not be served, None if it can."""
+    if original_response is None:
+        return "unreachable"
+    if original_response.status_code not in passthrough_status_codes:
+        return f"returned status {original_response.status_code}"
+    response_mime_type = original_response.headers.get("Content-Type", ";").split(";")[0]
+    logger.info(f"Requested mimetypes: {requested_mimetypes}")
+    logger.info(f"Response mimetype: {response_mime_type}")
+    if response_mime_type not in requested_mimetypes:
+        return f"returned mimetype {response_mime_type}"
+    return None
+
+
+def discard_response(future):
+    """Cancel the losing fetch of a hedged request.
+
+    A fetch that is already running can not be interrupted, its response is
+    closed as soon as it arrives so that the upstream connection is released.
+    """
+    if future.cancel():
+        return
+
+    def close(done_future):
+        if done_future.exception() is None and done_future.result() is not None:
+            close_response(done_future.result())
+
+    future.add_done_callback(close)
 
 
 # Fetch the lates version from archivo (no timestamp defined)
-def fetch_latest_archived(wrapped_request, headers):
+def fetch_latest_archived(wrapped_request, headers, negotiation):
     if not is_archivo_ontology_request(wrapped_request):
         logger.info(
             "Data needs to be fetched from Archivo, but ontology is not available on Archivo."
         )
         return mock_response_404()
     logger.info("Fetch latest archived")
-    format = get_format_from_accept_header(headers)
+    format = negotiation.format
     ontology, _, _ = wrapped_request.get_request_url_host_path()
+    cache_key = archivo_cache_key(ontology, format, OntoVersion.LATEST_ARCHIVED)
+    # between the soft and the hard ttl the stale copy is served right away
+    cached_response = get_cached_response(wrapped_request, cache_key, allow_stale=True)
+    if cached_response is not None:
+        if is_stale(cached_response):
+            refresh_latest_archived(wrapped_request, headers, ontology, format, cache_key)
+        return conditional_response(wrapped_request, cached_response)
+    response = request_latest_archived(wrapped_request, headers, ontology, format, cache_key)
+    if response is None or response.status_code >= 500:
+        last_good_response = get_last_good_response(wrapped_request, cache_key)
+        if last_good_response is not None:
+            logger.warning(f"Archivo failed for {ontology}, serving the last cached copy")
+            if response is not None:
+                close_response(response)
+            response = last_good_response
+    return conditional_response(wrapped_request, response)
+
+
+def request_latest_archived(wrapped_request, headers, ontology, format, cache_key):
+    """Request the latest version from Archivo under the scheme Archivo knows the ontology by.
+
+    The scheme learned from earlier responses or given by the Archivo index is
+    tried first, the other one only if that fails. Without any knowledge both
+    forms are requested at once.
+    """
+    _, rest = scheme_preference.split_scheme(ontology)
+    preferred = scheme_preference.SCHEME_PREFERENCES.get(ontology)
+    if preferred is None and wrapped_request.archivo_iri is not None:
+        preferred, _ = scheme_preference.split_scheme(wrapped_request.archivo_iri)
+    if preferred in ("http", "https"):
+        other = "http" if preferred == "https" else "https"
+        forms = [f"{preferred}://{rest}", f"{other}://{rest}"]
+        response = None
+        for form in forms:
+            if response is not None:
+                close_response(response)
+            response = request_archivo_download(wrapped_request, headers, form, format)
+            if response is not None and response.status_code != 500:
+                break
+    else:
+        form, response = race_archivo_downloads(
+            wrapped_request, headers, [f"http://{rest}", f"https://{rest}"], format
+        )
+    if response is not None and response.status_code == 200:
+        scheme_preference.SCHEME_PREFERENCES.learn(form)
+    return store_cached_response(wrapped_request, cache_key, response)
+
+
+def race_archivo_downloads(wrapped_request, headers, forms, format):
+    """Request all scheme forms of an ontology at once.
+
+    Returns the form and response of the first success, otherwise the most
+    useful failure, a 404 before a 500 before no response at all.
+    """
+    # the losing fetches run on after the response was sent, without the request
+    snapshot = RequestSnapshot(wrapped_request)
+    futures = {
+        run_or_submit(
+            fetch_pool.RACE_POOL, request_archivo_download, snapshot, headers, form, format
+        ): form
+        for form in forms
+    }
+    deadline = time.monotonic() + upstream_deadline()
+    best_form, best_response = forms[0], None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(
+            pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED
+        )
+        if not done:
+            logger.warning(f"No Archivo response within {upstream_deadline():.1f}s for {forms}")
+            for other in pending:
+                discard_response(other)
+            break
+        for future in done:
+            response = future.result()
+            if response is not None and response.status_code == 200:
+                for other in pending:
+                    discard_response(other)
+                if best_response is not None:
+                    close_response(best_response)
+                return futures[future], response
+            if archivo_failure_rank(response) > archivo_failure_rank(best_response):
+                if best_response is not None:
+                    close_response(best_response)
+                best_form, best_response = futures[future], response
+            elif response is not None:
+                close_response(response)
+    return best_form, best_response
+
+
+def archivo_failure_rank(response):
+    if response is None:
+        return 0
+    return 1 if response.status_code == 500 else 2
+
+
+def request_archivo_download(wrapped_request, headers, ontology, format, version=None):
+    """Request an ontology from the Archivo download API, 404 and 500 answers are remembered for a while."""
     dbpedia_url = f"{archivo_api}?o={ontology}&f={format}"
-    logger.info(f"Fetching from DBpedia Archivo API: {dbpedia_url}")
-    response = request_ontology(wrapped_request, dbpedia_url, headers)
-    if response.status_code != 500:
+    if version is not None:
+        dbpedia_url += f"&v={version}"
+    key = ("archivo", dbpedia_url)
+    status_code = negative_cache.NEGATIVE_CACHE.get(key)
+    if status_code is not None:
+        logger.info(f"Archivo recently answered {status_code} for {dbpedia_url}, skipping the request")
+        response = mock_response_404() if status_code == 404 else mock_response_500()
+        # stands in for the answer of Archivo
+        response.proxy_generated = False
         return response
-    ontology = ontology.replace('http://', 'https://')
-    logger.info(f'HTTPS ontology: {ontology}')
-    dbpedia_url = f"{archivo_api}?o={ontology}&f={format}"
-    logger.info(f"Fetching from DBpedia Archivo API - https: {dbpedia_url}")
-    return request_ontology(wrapped_request, dbpedia_url, headers)
+    logger.info(f"Fetching from DBpedia Archivo API: {dbpedia_url}")
+    response = request_archivo(wrapped_request, dbpedia_url, headers)
+    if response is not None and response.status_code in (404, 500):
+        negative_cache.NEGATIVE_CACHE.put(key, response.status_code)
+    return response
+
+
+# cache keys with a background refresh in progress
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_latest_archived(wrapped_request, headers, ontology, format, cache_key):
+    """Refresh a stale cache entry on the fetch pool, at most once at a time per entry."""
+    with _refreshing_lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+    # the refresh runs after the response was sent and the request parser reused
+    snapshot = RequestSnapshot(wrapped_request)
+    headers = dict(headers)
+
+    def refresh():
+        try:
+            response = request_latest_archived(snapshot, headers, ontology, format, cache_key)
+            # a failed refresh keeps the stale copy, it is retried by the next request
+            if response is not None:
+                close_response(response)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(cache_key)
+
+    logger.info(f"Refreshing stale cache entry for {ontology} in the background")
+    try:
+        fetch_pool.FETCH_POOL.submit(refresh)
+    except FetchPoolFull as e:
+        logger.warning(f"Skipping background refresh, fetch pool is full: {e}")
+        with _refreshing_lock:
+            _refreshing.discard(cache_key)
+
 
-def fetch_timestamp_archived(wrapped_request, headers, config):
+def fetch_timestamp_archived(wrapped_request, headers, config, negotiation):
     if not is_archivo_ontology_request(wrapped_request):
         logger.info(
             "Data needs to be fetched from Archivo, but ontology is not available on Archivo."
         )
         return mock_response_404()
     logger.info("Fetch archivo timestamp")
-    format = get_format_from_accept_header(headers)
+    format = negotiation.format
     ontology, _, _ = wrapped_request.get_request_url_host_path()
-    dbpedia_url = f"{archivo_api}?o={ontology}&f={format}&v={config.timestamp}"
-    logger.info(f"Fetching from DBpedia Archivo API: {dbpedia_url}")
-    return request_ontology(wrapped_request, dbpedia_url, headers)
+    cache_key = archivo_cache_key(
+        ontology, format, OntoVersion.TIMESTAMP_ARCHIVED, config.timestamp
+    )
+    # a pinned snapshot can never change, it is cached without expiry or revalidation
+    cached_response = get_cached_response(wrapped_request, cache_key, immutable=True)
+    if cached_response is not None:
+        return conditional_response(wrapped_request, cached_response)
+    response = request_archivo_download(
+        wrapped_request, headers, ontology, format, version=config.timestamp
+    )
+    response = store_cached_response(wrapped_request, cache_key, response, immutable=True)
+    return conditional_response(wrapped_request, response)
 
 
 def fetch_dependency_manifest(ontology, headers, manifest):
     logger.info(f"The dependency manifest is currently not supported")
-    return mock_response_500
+    return mock_response_500()
     # # Parse RDF data from the dependencies file
     # manifest_g = rdflib.Graph()
     # manifest_g.parse(manifest, format="turtle")
@@ -0,0 +1,313 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate
+from typing import Dict, Hashable, Optional
+import requests
+from ontologytimemachine.utils import disk_cache
+from ontologytimemachine.utils.config import Config, logger
+from ontologytimemachine.utils import streaming
+from ontologytimemachine.utils.streaming import close_response, is_file_backed, is_streamed
+from ontologytimemachine.utils.utils import (
+    content_etag,
+    is_not_modified,
+    strip_transfer_headers,
+)
+
+
+# headers a 304 repeats from the response it stands for
+NOT_MODIFIED_HEADERS = ("ETag", "Last-Modified", "Cache-Control", "Expires", "Vary", "Content-Location")
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: Dict[str, str]
+    content: bytes
+    url: str
+    stored_at: float
+    expires_at: Optional[float]
+
+    @property
+    def size(self) -> int:
+        return len(self.content)
+
+    def is_expired(self, now: float) -> bool:
+        return self.expires_at is not None and now >= self.expires_at
+
+    def to_response(self, stale: bool = False) -> requests.Response:
+        # build a fresh response object for every hit, callers may modify headers
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.url = self.url
+        response.headers.update(self.headers)
+        response._content = self.content
+        response.stored_at = self.stored_at
+        response.stale = stale
+        return response
+
+
+class ResponseCache:
+    """Bounded in-memory LRU cache for upstream responses.
+
+    Entries are evicted in least recently used order once the sum of the
+    cached bodies exceeds max_bytes. Every entry expires after ttl seconds,
+    with a ttl of None entries never expire and only capacity evicts them.
+
+    With a hard_ttl expired entries are kept as stale copies: until hard_ttl
+    they can still be served while they are refreshed, afterwards only as the
+    last good copy when the upstream fails. Only capacity evicts them.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float], hard_ttl: Optional[float] = None) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hard_ttl = hard_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, allow_stale: bool = False) -> Optional[requests.Response]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            stale = entry is not None and entry.is_expired(now)
+            if stale and self.hard_ttl is None:
+                self._remove(key)
+                entry = None
+            elif stale and not (allow_stale and now < entry.stored_at + self.hard_ttl):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry.to_response(stale)
+
+    def get_last_good(self, key: Hashable) -> Optional[requests.Response]:
+        """The entry for key regardless of its age, for use when the upstream fails."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry.to_response(entry.is_expired(now))
+
+    def put(self, key: Hashable, response: requests.Response, stored_at: Optional[float] = None) -> bool:
+        content = response.content or b""
+        if len(content) > self.max_bytes:
+            logger.info(f"Response for {key} too large for the cache: {len(content)} bytes")
+            return False
+        # entries copied from the disk cache keep their age
+        now = time.time() if stored_at is None else stored_at
+        entry = CachedResponse(
+            status_code=response.status_code,
+            headers=strip_transfer_headers(response.headers),
+            content=content,
+            url=response.url,
+            stored_at=now,
+            expires_at=now + self.ttl if self.ttl is not None else None,
+        )
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+
+_default_cfg = Config()
+RESPONSE_CACHE = ResponseCache(
+    _default_cfg.cacheMaxBytes,
+    _default_cfg.cacheTtl,
+    max(_default_cfg.cacheHardTtl, _default_cfg.cacheTtl),
+)
+# pinned Archivo snapshots (v=<timestamp>) never change, so they are kept without ttl
+IMMUTABLE_CACHE = ResponseCache(_default_cfg.immutableCacheMaxBytes, None)
+
+
+def configure_response_cache(config: Config) -> None:
+    """Replace the process wide response caches according to the startup configuration."""
+    global RESPONSE_CACHE, IMMUTABLE_CACHE
+    logger.info(
+        f"Configuring response cache: max bytes {config.cacheMaxBytes}, ttl {config.cacheTtl}s, "
+        f"hard ttl {config.cacheHardTtl}s, immutable max bytes {config.immutableCacheMaxBytes}"
+    )
+    RESPONSE_CACHE = ResponseCache(
+        config.cacheMaxBytes, config.cacheTtl, max(config.cacheHardTtl, config.cacheTtl)
+    )
+    IMMUTABLE_CACHE = ResponseCache(config.immutableCacheMaxBytes, None)
+
+
+def copy_response(response: requests.Response) -> requests.Response:
+    copied = requests.Response()
+    copied.status_code = response.status_code
+    copied.url = response.url
+    copied.headers.update(response.headers)
+    copied._content = response.content
+    return copied
+
+
+def archivo_cache_key(ontology: str, format: str, ontoVersion, timestamp: str = ""):
+    return (ontology, format, str(ontoVersion), timestamp)
+
+
+def is_stale(response) -> bool:
+    return getattr(response, "stale", False)
+
+
+def set_age_headers(response, warning: str = '110 - "Response is Stale"') -> None:
+    if getattr(response, "stored_at", None) is not None:
+        response.headers["Age"] = str(max(0, int(time.time() - response.stored_at)))
+    if is_stale(response):
+        response.headers["Warning"] = warning
+
+
+def get_cached_response(wrapped_request, key, immutable=False, allow_stale=False) -> Optional[requests.Response]:
+    """Look up a cached response, with allow_stale also expired entries within their hard ttl.
+
+    Stale responses have response.stale set and are sent with a Warning header.
+    """
+    # HEAD responses carry no body, so they neither read from nor populate the cache
+    if not wrapped_request.is_get_request():
+        return None
+    memory_cache = IMMUTABLE_CACHE if immutable else RESPONSE_CACHE
+    response = memory_cache.get(key, allow_stale) if memory_cache.max_bytes > 0 else None
+    if response is not None:
+        logger.info(f"Serving response from cache for {key}")
+    elif disk_cache.DISK_CACHE is not None:
+        # large bodies stay in the file and are sent from there by the proxy
+        response = disk_cache.DISK_CACHE.get(
+            key, max_read_bytes=streaming.STREAM_BUFFER_SIZE, allow_stale=allow_stale
+        )
+        if response is not None:
+            logger.info(f"Serving response from disk cache for {key}")
+            if memory_cache.max_bytes > 0 and not is_file_backed(response):
+                memory_cache.put(key, response, stored_at=response.stored_at)
+    if response is not None:
+        set_age_headers(response)
+    return response
+
+
+def get_last_good_response(wrapped_request, key) -> Optional[requests.Response]:
+    """The last cached copy of a latestArchived response regardless of its age."""
+    if not wrapped_request.is_get_request():
+        return None
+    response = RESPONSE_CACHE.get_last_good(key) if RESPONSE_CACHE.max_bytes > 0 else None
+    if response is None and disk_cache.DISK_CACHE is not None:
+        response = disk_cache.DISK_CACHE.get_last_good(
+            key, max_read_bytes=streaming.STREAM_BUFFER_SIZE
+        )
+    if response is not None:
+        set_age_headers(response, warning='111 - "Revalidation Failed"')
+    return response
+
+
+def store_cached_response(wrapped_request, key, response, immutable=False):
+    """Cache a fresh upstream response and return the response to send to the client.
+
+    A streamed body is written to the disk cache while it is streamed to the
+    client, without a disk cache it is streamed uncached.
+    """
+    if (
+        response is None
+        or response.status_code != 200
+        or not wrapped_request.is_get_request()
+    ):
+        return response
+    if is_streamed(response) and disk_cache.DISK_CACHE is None:
+        return response
+    # validators of the proxy, conditional requests are answered from them locally
+    if is_streamed(response):
+        # the digest is known only after the body was sent, the disk cache
+        # keeps the previous Last-Modified if the body turns out unchanged
+        if "Last-Modified" not in response.headers:
+            response.headers["Last-Modified"] = formatdate(usegmt=True)
+        stored = disk_cache.DISK_CACHE.put_stream(
+            key, response, strip_transfer_headers(response.headers), immutable=immutable
+        )
+        return stored if stored is not None else response
+    response.headers["ETag"] = content_etag(hashlib.sha256(response.content or b"").hexdigest())
+    if "Last-Modified" not in response.headers:
+        # a refresh with the same body is not a modification
+        response.headers["Last-Modified"] = (
+            previous_last_modified(key, response.headers["ETag"], immutable)
+            or formatdate(usegmt=True)
+        )
+    memory_cache = IMMUTABLE_CACHE if immutable else RESPONSE_CACHE
+    if memory_cache.max_bytes > 0:
+        memory_cache.put(key, response)
+    if disk_cache.DISK_CACHE is not None:
+        disk_cache.DISK_CACHE.put(
+            key, response, strip_transfer_headers(response.headers), immutable=immutable
+        )
+    return response
+
+
+def previous_last_modified(key, etag, immutable=False) -> Optional[str]:
+    """Last-Modified of the cached copy of key if it has the given ETag, regardless of its age."""
+    memory_cache = IMMUTABLE_CACHE if immutable else RESPONSE_CACHE
+    previous = memory_cache.get_last_good(key) if memory_cache.max_bytes > 0 else None
+    headers = previous.headers if previous is not None else None
+    if headers is None and disk_cache.DISK_CACHE is not None:
+        headers = disk_cache.DISK_CACHE.get_headers(key)
+    if headers is None or headers.get("ETag") != etag:
+        return None
+    return headers.get("Last-Modified")
+
+
+def conditional_response(wrapped_request, response):
+    """Answer a GET with a matching If-None-Match or If-Modified-Since with a local 304."""
+    if (
+        response is None
+        or response.status_code != 200
+        or not wrapped_request.is_get_request()
+        or not is_not_modified(wrapped_request.get_request_headers(), response.headers)
+    ):
+        return response
+    logger.info(f"Answering conditional request for {response.url} with 304")
+    not_modified = requests.Response()
+    not_modified.status_code = 304
+    not_modified.url = response.url
+    for header in NOT_MODIFIED_HEADERS:
+        if header in response.headers:
+            not_modified.headers[header] = response.headers[header]
+    not_modified._content = b""
+    close_response(response)
+    return not_modified
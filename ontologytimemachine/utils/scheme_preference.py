@@ -0,0 +1,163 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+from ontologytimemachine.utils.config import Config, logger
+
+
+SCHEME_PREFERENCES_FILE_NAME = "archivo_schemes.json"
+SCHEME_PREFERENCES_MAX_ENTRIES = 100000
+# seconds the preferences learned after a change are collected before the file is written
+SCHEME_PREFERENCES_SAVE_DELAY = 5.0
+
+
+def split_scheme(iri: str):
+    """Split an IRI into its scheme and the rest, e.g. ("http", "example.org/onto")."""
+    scheme, separator, rest = iri.partition("://")
+    if not separator:
+        return "", iri
+    return scheme.lower(), rest
+
+
+class SchemePreferences:
+    """Remembers under which scheme, http or https, Archivo knows an ontology.
+
+    Preferences are keyed by the IRI without its scheme. With a path they are
+    loaded from and written back to a JSON file, so that they survive
+    restarts. At most max_entries are kept, the oldest ones are dropped first.
+
+    The file is written by a background thread, save_delay seconds after the
+    first change so that the changes in between are written at once. The
+    proxy workers share the file: under an exclusive lock on <path>.lock the
+    thread merges the changes into the current file, and takes over the
+    preferences the other workers saved.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = SCHEME_PREFERENCES_MAX_ENTRIES,
+        save_delay: float = SCHEME_PREFERENCES_SAVE_DELAY,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.save_delay = save_delay
+        self._schemes: Dict[str, str] = {}
+        # learned since the last save, in the order they were learned
+        self._changes: Dict[str, str] = {}
+        self._changed = threading.Event()
+        self._saver: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if path is not None:
+            self._schemes = self._read()
+            logger.info(f"Loaded {len(self._schemes)} Archivo scheme preferences")
+
+    def get(self, iri: str) -> Optional[str]:
+        _, rest = split_scheme(iri)
+        with self._lock:
+            return self._schemes.get(rest)
+
+    def learn(self, iri: str) -> None:
+        scheme, rest = split_scheme(iri)
+        with self._lock:
+            if self._schemes.get(rest) == scheme:
+                return
+            self._set(self._schemes, rest, scheme)
+            if self.path is None:
+                return
+            self._set(self._changes, rest, scheme)
+        self._changed.set()
+        self._start_saver()
+
+    def save(self) -> None:
+        """Merge the changes into the file and take over the preferences saved by other workers."""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return
+        try:
+            with open(f"{self.path}.lock", "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                schemes = self._read()
+                for rest, scheme in changes.items():
+                    self._set(schemes, rest, scheme)
+                self._write(schemes)
+        except OSError as e:
+            logger.error(f"Archivo scheme preferences could not be saved: {e}")
+            with self._lock:
+                # written with the next change
+                for rest, scheme in self._changes.items():
+                    self._set(changes, rest, scheme)
+                self._changes = changes
+            return
+        with self._lock:
+            # changes learned during the save are kept for the next one
+            for rest, scheme in self._changes.items():
+                self._set(schemes, rest, scheme)
+            self._schemes = schemes
+
+    def __len__(self) -> int:
+        return len(self._schemes)
+
+    def _set(self, schemes: Dict[str, str], rest: str, scheme: str) -> None:
+        # the insertion order is the age, the oldest preferences are dropped first
+        schemes.pop(rest, None)
+        schemes[rest] = scheme
+        while len(schemes) > self.max_entries:
+            del schemes[next(iter(schemes))]
+
+    def _start_saver(self) -> None:
+        # started on first use, inside the proxy worker process
+        if self._saver is not None:
+            return
+        with self._lock:
+            if self._saver is not None:
+                return
+            self._saver = threading.Thread(target=self._save_loop, name="otm-scheme-saver", daemon=True)
+            self._saver.start()
+
+    def _save_loop(self) -> None:
+        while True:
+            self._changed.wait()
+            time.sleep(self.save_delay)
+            self._changed.clear()
+            self.save()
+
+    def _read(self) -> Dict[str, str]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as preferences_file:
+                return json.load(preferences_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Archivo scheme preferences could not be loaded, starting empty: {e}")
+            return {}
+
+    def _write(self, schemes: Dict[str, str]) -> None:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as temp_file:
+                json.dump(schemes, temp_file)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+SCHEME_PREFERENCES = SchemePreferences()
+
+
+def configure_scheme_preferences(config: Config) -> None:
+    """Persist the learned preferences next to the disk cache, without cacheDir they are kept in memory."""
+    global SCHEME_PREFERENCES
+    if not config.cacheDir:
+        SCHEME_PREFERENCES = SchemePreferences()
+        return
+    os.makedirs(config.cacheDir, exist_ok=True)
+    path = os.path.join(config.cacheDir, SCHEME_PREFERENCES_FILE_NAME)
+    logger.info(f"Configuring Archivo scheme preferences in {path}")
+    SCHEME_PREFERENCES = SchemePreferences(path)
@@ -0,0 +1,103 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+from ontologytimemachine.utils.config import Config, logger
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.results: Optional[List[Any]] = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls with the same key.
+
+    The first caller for a key runs the function, every caller arriving while
+    it is in flight waits for and receives the same result. If the function
+    raises, the exception is raised in every waiting caller as well.
+
+    Results that can be used only once, like a streamed body, are handed out
+    through a share function, see do().
+    """
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Any],
+        share: Optional[Callable[[Any, int], List[Any]]] = None,
+    ) -> Tuple[Any, bool]:
+        """Run fn once for all concurrent callers of key.
+
+        Returns the result and whether it is shared with the caller that ran fn.
+        With share, the caller that ran fn calls share(result, callers) and
+        every caller receives one item of the returned list instead.
+        Raises SingleFlightTimeout if a waiting caller gives up after timeout seconds.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if is_leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                    # no caller joins or leaves anymore
+                    callers = call.waiters + 1
+                try:
+                    if share is not None and call.error is None:
+                        call.results = share(call.result, callers)
+                except BaseException as e:
+                    call.error = e
+                call.done.set()
+            if call.waiters:
+                logger.info(f"Shared result for {key} with {call.waiters} waiting requests")
+        elif not call.done.wait(self.timeout):
+            with self._lock:
+                counted = self._calls.get(key) is not call
+                if not counted:
+                    call.waiters -= 1
+            if not counted:
+                raise SingleFlightTimeout(f"Waited more than {self.timeout}s for {key}")
+            # the result is being shared out right now
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        if call.results is not None:
+            with self._lock:
+                return call.results.pop(), not is_leader
+        return call.result, not is_leader
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+UPSTREAM_FLIGHTS = SingleFlight(Config().singleFlightTimeout)
+
+
+def configure_single_flight(config: Config) -> None:
+    global UPSTREAM_FLIGHTS
+    logger.info(f"Configuring single flight upstream fetches: timeout {config.singleFlightTimeout}s")
+    UPSTREAM_FLIGHTS = SingleFlight(config.singleFlightTimeout)
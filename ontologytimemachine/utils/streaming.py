@@ -0,0 +1,218 @@
+import os
+import queue
+import tempfile
+import threading
+from itertools import chain
+from typing import Any, Callable, Iterator, List, Optional
+import requests
+from ontologytimemachine.utils.config import Config, logger
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+END_OF_STREAM = object()
+
+STREAM_BUFFER_SIZE = Config().streamBufferSize
+
+
+def is_streamed(response) -> bool:
+    return getattr(response, "body_chunks", None) is not None
+
+
+def is_file_backed(response) -> bool:
+    return getattr(response, "body_file", None) is not None
+
+
+def close_response(response) -> None:
+    # buffered responses released their connection already
+    if is_streamed(response):
+        response.close()
+    elif is_file_backed(response):
+        response.body_file.close()
+
+
+def buffer_or_stream(response: requests.Response, limit: int) -> requests.Response:
+    """Read the body of a response opened with stream=True if it fits into limit bytes.
+
+    Larger bodies are left streaming, the chunks read so far followed by the rest
+    of the body are available as response.body_chunks and response.content must
+    not be used.
+    """
+    try:
+        chunks = response.iter_content(STREAM_CHUNK_SIZE)
+        prefix = []
+        size = 0
+        for chunk in chunks:
+            prefix.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                response.body_chunks = chain(prefix, chunks)
+                return response
+    except BaseException:
+        response.close()
+        raise
+    response._content = b"".join(prefix)
+    return response
+
+
+class ResponseStream:
+    """Hands the body of a streamed response from a fetch pool thread to the proxy event loop.
+
+    At most max_chunks chunks wait in the queue, the reading thread blocks while
+    the client is behind, so the memory used per request is bounded by the
+    buffer size and not by the size of the body. wakeup is called whenever a
+    chunk or the end of the body becomes available.
+    """
+
+    def __init__(self, response: requests.Response, max_chunks: int, wakeup: Callable[[], None]) -> None:
+        self.response = response
+        self.wakeup = wakeup
+        self.error: Optional[BaseException] = None
+        self._chunks: "queue.Queue[Any]" = queue.Queue(max(1, max_chunks))
+        self._closed = threading.Event()
+
+    def pump(self) -> None:
+        """Read the body into the queue, runs on a fetch pool thread."""
+        try:
+            for chunk in self.response.body_chunks:
+                if chunk and not self._put(chunk):
+                    return
+        except Exception as e:
+            logger.error(f"Error while streaming the response body: {e}")
+            self.error = e
+        finally:
+            self.response.close()
+        self._put(END_OF_STREAM)
+
+    def get(self) -> Any:
+        """Next chunk, END_OF_STREAM after the last one or None if no chunk is ready yet."""
+        try:
+            return self._chunks.get_nowait()
+        except queue.Empty:
+            return None
+
+    def has_chunks(self) -> bool:
+        return not self._chunks.empty()
+
+    def close(self) -> None:
+        """Stop reading, the pumping thread exits within a second."""
+        self._closed.set()
+
+    def _put(self, item: Any) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            self.wakeup()
+            return True
+        return False
+
+
+class SharedBody:
+    """Lets several responses read the streamed body of one upstream response.
+
+    The body is read from the upstream once, by whichever reader is ahead,
+    and spooled to an unlinked temporary file the other readers read it from
+    at their own pace. The upstream response is closed when its body has been
+    read or when all readers are closed.
+    """
+
+    def __init__(self, response: requests.Response, readers: int) -> None:
+        self._response = response
+        self._chunks = response.body_chunks
+        self._file = tempfile.TemporaryFile()
+        self._size = 0
+        self._reading = False
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._readers = readers
+        self._condition = threading.Condition()
+
+    def responses(self) -> List[requests.Response]:
+        """One streamed response per reader, closing a response closes its reader."""
+        responses = []
+        for _ in range(self._readers):
+            reader = _SharedBodyReader(self)
+            shared = requests.Response()
+            shared.status_code = self._response.status_code
+            shared.url = self._response.url
+            shared.headers.update(self._response.headers)
+            shared.raw = reader
+            shared.body_chunks = iter(reader)
+            responses.append(shared)
+        return responses
+
+    def read(self, offset: int) -> Optional[bytes]:
+        """The chunk at offset, None after the end of the body."""
+        while True:
+            with self._condition:
+                while offset >= self._size and self._reading:
+                    self._condition.wait()
+                if offset < self._size:
+                    length = min(self._size - offset, STREAM_CHUNK_SIZE)
+                elif self._done:
+                    if self._error is not None:
+                        raise IOError(f"Reading the shared response body failed: {self._error}")
+                    return None
+                else:
+                    self._reading = True
+                    length = 0
+            if length:
+                return os.pread(self._file.fileno(), length, offset)
+            self._read_upstream()
+
+    def release(self) -> None:
+        with self._condition:
+            self._readers -= 1
+            if self._readers > 0:
+                return
+        self._response.close()
+        self._file.close()
+
+    def _read_upstream(self) -> None:
+        error = None
+        try:
+            chunk = next(self._chunks, None)
+            if chunk:
+                os.pwrite(self._file.fileno(), chunk, self._size)
+        except Exception as e:
+            logger.error(f"Error while reading the shared response body: {e}")
+            chunk, error = None, e
+        with self._condition:
+            self._reading = False
+            if chunk is None:
+                self._done = True
+                self._error = error
+            else:
+                self._size += len(chunk)
+            self._condition.notify_all()
+        if chunk is None:
+            self._response.close()
+
+
+class _SharedBodyReader:
+    # stands in for the raw stream of a shared response, Response.close() closes it
+
+    def __init__(self, body: SharedBody) -> None:
+        self._body = body
+        self._offset = 0
+        self._closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        while not self._closed:
+            chunk = self._body.read(self._offset)
+            if chunk is None:
+                return
+            self._offset += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._body.release()
+
+
+def configure_streaming(config: Config) -> None:
+    global STREAM_BUFFER_SIZE
+    logger.info(f"Configuring response streaming: buffer size {config.streamBufferSize} bytes")
+    STREAM_BUFFER_SIZE = config.streamBufferSize
@@ -0,0 +1,339 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import parse_url
+from ontologytimemachine.utils.config import Config, UpstreamClient, logger
+from ontologytimemachine.utils import streaming
+
+
+class SessionUpstream:
+    """Process wide requests.Session with pooled keep-alive connections.
+
+    The HTTPAdapter keeps up to pool_maxsize connections per host for up to
+    pool_connections hosts, so consecutive fetches from Archivo reuse an
+    established TLS connection. Pools of hosts that have not been used for
+    keepalive_expiry seconds are closed on the next request.
+    """
+
+    def __init__(self, pool_connections: int, pool_maxsize: int, keepalive_expiry: float) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_expiry = keepalive_expiry
+        self._session: Optional[requests.Session] = None
+        self._adapter: Optional[HTTPAdapter] = None
+        self._last_used: Dict[str, float] = {}
+        self._last_reap = time.monotonic()
+        self._lock = threading.Lock()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        allow_redirects: bool,
+        timeout: float,
+        stream: bool = False,
+    ) -> requests.Response:
+        session = self._get_session()
+        self.reap_idle_connections()
+        self._mark_used(url)
+        response = session.request(
+            method,
+            url,
+            headers=headers,
+            allow_redirects=allow_redirects,
+            timeout=timeout,
+            stream=stream,
+        )
+        if response.url != url:
+            self._mark_used(response.url)
+        return response
+
+    def reap_idle_connections(self, force: bool = False) -> int:
+        """Close the connection pools of hosts idle for longer than keepalive_expiry."""
+        now = time.monotonic()
+        with self._lock:
+            if self._adapter is None:
+                return 0
+            if not force and now - self._last_reap < self.keepalive_expiry / 2:
+                return 0
+            self._last_reap = now
+            pools = self._adapter.poolmanager.pools
+            reaped = 0
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                origin = self._origin(pool.scheme, pool.host, pool.port)
+                if force or now - self._last_used.get(origin, 0) > self.keepalive_expiry:
+                    # removing the pool from the pool manager closes its connections
+                    del pools[key]
+                    self._last_used.pop(origin, None)
+                    reaped += 1
+        if reaped:
+            logger.info(f"Closed {reaped} idle upstream connection pools")
+        return reaped
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            if self._adapter is None:
+                return {}
+            pools = self._adapter.poolmanager.pools
+            stats = {}
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats[self._origin(pool.scheme, pool.host, pool.port)] = {
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    # the pool queue is pre-filled with None placeholders
+                    "idle_connections": sum(
+                        1 for conn in list(pool.pool.queue) if conn is not None
+                    ) if pool.pool is not None else 0,
+                }
+            return stats
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._adapter = None
+            self._last_used.clear()
+
+    def _mark_used(self, url: str) -> None:
+        parsed = parse_url(url)
+        origin = self._origin(parsed.scheme, parsed.host, parsed.port)
+        with self._lock:
+            self._last_used[origin] = time.monotonic()
+
+    @staticmethod
+    def _origin(scheme, host, port) -> str:
+        scheme = scheme or "http"
+        port = port or (443 if scheme == "https" else 80)
+        return f"{scheme}://{host}:{port}"
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._adapter = adapter
+                self._session = session
+            return self._session
+
+
+class AsyncUpstream:
+    """Shared httpx.AsyncClient running on a dedicated event loop thread.
+
+    All fetches of a worker process go through one client, so connections to
+    Archivo and other upstream servers are kept alive and, if enabled,
+    multiplexed over HTTP/2. The loop thread and the client are created on
+    first use, inside the proxy worker process.
+    """
+
+    def __init__(
+        self,
+        http2: bool,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+    ) -> None:
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    async def fetch(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        allow_redirects: bool,
+        timeout: float,
+    ) -> requests.Response:
+        response = await self._client.request(
+            method,
+            url,
+            headers=headers,
+            follow_redirects=allow_redirects,
+            timeout=timeout,
+        )
+        return to_requests_response(response)
+
+    async def open_stream(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        allow_redirects: bool,
+        timeout: float,
+    ) -> httpx.Response:
+        request = self._client.build_request(method, url, headers=headers, timeout=timeout)
+        return await self._client.send(request, stream=True, follow_redirects=allow_redirects)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        allow_redirects: bool,
+        timeout: float,
+        stream: bool = False,
+    ) -> requests.Response:
+        """Blocking entry point for the fetch pool threads."""
+        loop = self._get_loop()
+        if stream:
+            response = asyncio.run_coroutine_threadsafe(
+                self.open_stream(method, url, headers, allow_redirects, timeout), loop
+            ).result()
+            return to_requests_response(response, _AsyncBodyReader(response, loop))
+        future = asyncio.run_coroutine_threadsafe(
+            self.fetch(method, url, headers, allow_redirects, timeout), loop
+        )
+        return future.result()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+            self._client = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="otm-upstream", daemon=True
+                ).start()
+                self._client = asyncio.run_coroutine_threadsafe(
+                    self._create_client(), loop
+                ).result()
+                self._loop = loop
+            return self._loop
+
+    async def _create_client(self) -> httpx.AsyncClient:
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("HTTP/2 requested but the h2 package is not installed, using HTTP/1.1")
+                http2 = False
+        return httpx.AsyncClient(http2=http2, limits=self.limits)
+
+
+class _AsyncBodyReader:
+    """Raw body of a streamed httpx response, read from a fetch pool thread
+    through requests.Response.iter_content()."""
+
+    def __init__(self, response: httpx.Response, loop: asyncio.AbstractEventLoop) -> None:
+        self._response = response
+        self._loop = loop
+
+    def stream(self, chunk_size: int, decode_content: bool = True):
+        chunks = self._response.aiter_bytes(chunk_size)
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(_next_chunk(chunks), self._loop).result()
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._response.aclose(), self._loop).result()
+
+
+async def _next_chunk(chunks) -> Optional[bytes]:
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+def to_requests_response(response: httpx.Response, raw: Optional[_AsyncBodyReader] = None) -> requests.Response:
+    converted = requests.Response()
+    converted.status_code = response.status_code
+    converted.reason = response.reason_phrase
+    converted.url = str(response.url)
+    converted.headers.update(response.headers)
+    if raw is None:
+        converted._content = response.content
+    else:
+        converted.raw = raw
+    return converted
+
+
+_default_cfg = Config()
+UPSTREAM_CLIENT: UpstreamClient = _default_cfg.upstreamClient
+SESSION_UPSTREAM = SessionUpstream(
+    _default_cfg.upstreamPoolConnections,
+    _default_cfg.upstreamPoolMaxsize,
+    _default_cfg.upstreamKeepaliveExpiry,
+)
+ASYNC_UPSTREAM = AsyncUpstream(
+    _default_cfg.upstreamHttp2,
+    _default_cfg.upstreamMaxConnections,
+    _default_cfg.upstreamMaxKeepaliveConnections,
+    _default_cfg.upstreamKeepaliveExpiry,
+)
+
+
+def configure_upstream(config: Config) -> None:
+    global UPSTREAM_CLIENT, SESSION_UPSTREAM, ASYNC_UPSTREAM
+    logger.info(
+        f"Configuring upstream client: {config.upstreamClient}, http2 {config.upstreamHttp2}, "
+        f"max connections {config.upstreamMaxConnections}, "
+        f"pool per host {config.upstreamPoolMaxsize}"
+    )
+    UPSTREAM_CLIENT = config.upstreamClient
+    SESSION_UPSTREAM.close()
+    SESSION_UPSTREAM = SessionUpstream(
+        config.upstreamPoolConnections,
+        config.upstreamPoolMaxsize,
+        config.upstreamKeepaliveExpiry,
+    )
+    ASYNC_UPSTREAM.close()
+    ASYNC_UPSTREAM = AsyncUpstream(
+        config.upstreamHttp2,
+        config.upstreamMaxConnections,
+        config.upstreamMaxKeepaliveConnections,
+        config.upstreamKeepaliveExpiry,
+    )
+
+
+def upstream_request(method, url, headers, allow_redirects, timeout, stream=False) -> requests.Response:
+    """Fetch url with the configured client.
+
+    With stream, bodies larger than the stream buffer size are not read into
+    memory but left streaming, see streaming.buffer_or_stream()."""
+    if UPSTREAM_CLIENT == UpstreamClient.HTTPX:
+        response = ASYNC_UPSTREAM.request(method, url, headers, allow_redirects, timeout, stream)
+    else:
+        response = SESSION_UPSTREAM.request(method, url, headers, allow_redirects, timeout, stream)
+    if stream:
+        return streaming.buffer_or_stream(response, streaming.STREAM_BUFFER_SIZE)
+    return response
+
+
+def upstream_stats() -> Dict[str, dict]:
+    if UPSTREAM_CLIENT == UpstreamClient.HTTPX:
+        return {}
+    return SESSION_UPSTREAM.stats()
@@ -0,0 +1,97 @@
+import math
+import threading
+from typing import Dict
+from ontologytimemachine.utils.config import Config, logger
+
+
+class UpstreamLimiter:
+    """Bounds the number of concurrent upstream requests of a proxy worker.
+
+    At most max_concurrent requests run at the same time, at most
+    max_per_host of them to the same host, 0 disables a limit. Requests over
+    a limit wait up to queue_timeout seconds for a free slot, but only
+    max_queue of them at once, acquire() refuses the others right away.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_host: int, max_queue: int, queue_timeout: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rejected = 0
+        self._active = 0
+        self._active_per_host: Dict[str, int] = {}
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    @property
+    def retry_after(self) -> int:
+        """Seconds a refused client is asked to wait, for the Retry-After header."""
+        return max(1, math.ceil(self.queue_timeout))
+
+    def acquire(self, host: str) -> bool:
+        """Take a slot for a request to host, False if the request has to be refused."""
+        with self._condition:
+            if not self._has_slot(host):
+                if self._waiting >= self.max_queue:
+                    self.rejected += 1
+                    logger.warning(f"Refusing request to {host}, {self._waiting} upstream requests waiting")
+                    return False
+                self._waiting += 1
+                try:
+                    admitted = self._condition.wait_for(lambda: self._has_slot(host), self.queue_timeout)
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    self.rejected += 1
+                    logger.warning(f"Refusing request to {host}, no upstream slot after {self.queue_timeout}s")
+                    return False
+            self._active += 1
+            self._active_per_host[host] = self._active_per_host.get(host, 0) + 1
+            return True
+
+    def release(self, host: str) -> None:
+        with self._condition:
+            self._active -= 1
+            if self._active_per_host[host] == 1:
+                del self._active_per_host[host]
+            else:
+                self._active_per_host[host] -= 1
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {
+                "active": self._active,
+                "waiting": self._waiting,
+                "rejected": self.rejected,
+                "hosts": len(self._active_per_host),
+            }
+
+    def _has_slot(self, host: str) -> bool:
+        if self.max_concurrent > 0 and self._active >= self.max_concurrent:
+            return False
+        return self.max_per_host <= 0 or self._active_per_host.get(host, 0) < self.max_per_host
+
+
+_default_cfg = Config()
+UPSTREAM_LIMITER = UpstreamLimiter(
+    _default_cfg.upstreamMaxConcurrent,
+    _default_cfg.upstreamMaxConcurrentPerHost,
+    _default_cfg.upstreamQueueDepth,
+    _default_cfg.upstreamQueueTimeout,
+)
+
+
+def configure_upstream_limits(config: Config) -> None:
+    global UPSTREAM_LIMITER
+    logger.info(
+        f"Configuring upstream limits: {config.upstreamMaxConcurrent} concurrent requests, "
+        f"{config.upstreamMaxConcurrentPerHost} per host, queue depth {config.upstreamQueueDepth}"
+    )
+    UPSTREAM_LIMITER = UpstreamLimiter(
+        config.upstreamMaxConcurrent,
+        config.upstreamMaxConcurrentPerHost,
+        config.upstreamQueueDepth,
+        config.upstreamQueueTimeout,
+    )
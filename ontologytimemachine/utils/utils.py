@@ -1,13 +1,19 @@
+import functools
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple, Optional, Tuple
+from requests.structures import CaseInsensitiveDict
 from werkzeug.http import parse_accept_header
 from ontologytimemachine.utils.config import (
     OntoVersion,
     OntoFormat,
+    OntoFormatConfig,
     OntoPrecedence,
     logger,
 )
 
 
 archivo_api = "https://archivo.dbpedia.org/download"
+ACCEPT_NEGOTIATION_CACHE_SIZE = 1024
 archivo_mimetypes = [
     "application/rdf+xml",
     "application/owl+xml",
@@ -31,6 +37,75 @@ passthrough_status_codes = [
     451,
 ]
 
+# answers of the proxy itself that are not replaced by the original server inside intercepted HTTPS
+served_proxy_status_codes = {403, 404, 503}
+
+# answers of an overloaded or unreachable host, they count against its health like errors
+host_failure_status_codes = {502, 503, 504}
+
+# response bodies are handled as decoded content, so headers describing the transfer are dropped
+transfer_headers = {
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+}
+
+# validators of the client refer to the responses of the proxy, not to those of Archivo
+conditional_headers = {
+    "if-match",
+    "if-none-match",
+    "if-modified-since",
+    "if-unmodified-since",
+    "if-range",
+}
+
+
+def strip_transfer_headers(headers):
+    return {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in transfer_headers
+    }
+
+
+def strip_conditional_headers(headers):
+    return {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in conditional_headers
+    }
+
+
+def content_etag(digest: str) -> str:
+    """Strong ETag of a response body, derived from its SHA-256 digest."""
+    return f'"{digest}"'
+
+
+def is_not_modified(request_headers, response_headers) -> bool:
+    """Evaluate If-None-Match and If-Modified-Since of a GET request against a response.
+
+    As in RFC 9110 If-Modified-Since is ignored when If-None-Match is present.
+    """
+    request_headers = CaseInsensitiveDict(request_headers)
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        etag = response_headers.get("ETag")
+        if etag is None:
+            return False
+        # If-None-Match uses the weak comparison
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request_headers.get("If-Modified-Since")
+    last_modified = response_headers.get("Last-Modified")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
 
 def get_mime_type(format="turtle"):
     # Define a mapping of formats to MIME types
@@ -57,47 +132,87 @@ def map_mime_to_format(mime_type):
     return mime_to_format.get(mime_type, None)
 
 
-def set_onto_format_headers(wrapped_request, config):
-    logger.info(
-        f"Setting headers based on ontoFormat: {config.ontoFormatConf} and ontoVersion: {config.ontoVersion}"
-    )
+class AcceptNegotiation(NamedTuple):
+    # Accept header of the request after applying the ontoFormat configuration
+    accept_header: str
+    # Archivo format of the preferred mimetype supported by Archivo, None if there is none
+    format: Optional[str]
+    requested_mimetypes: Tuple[str, ...]
+
 
+def patch_accept_header(accept_header, onto_format_conf, onto_version):
     # if ontoVersion is original and patchAcceptUpstream is False nothing to do here
     if (
-        config.ontoVersion == OntoVersion.ORIGINAL
-        and not config.ontoFormatConf.patchAcceptUpstream
+        onto_version == OntoVersion.ORIGINAL
+        and not onto_format_conf.patchAcceptUpstream
     ):
-        return
+        return accept_header
 
     # Determine the correct MIME type for the format
-    mime_type = get_mime_type(config.ontoFormatConf.format.value)
+    mime_type = get_mime_type(onto_format_conf.format.value)
     logger.info(f"Requested mimetype by proxy: {mime_type}")
 
     # Define conditions for modifying the accept header
-    request_accept_header = wrapped_request.get_request_accept_header()
-    logger.info(f"Accept header by request: {request_accept_header}")
-    req_headers_with_priority = parse_accept_header_with_priority(request_accept_header)
+    req_headers_with_priority = parse_accept_header_with_priority(accept_header)
     req_headers = [x[0] for x in req_headers_with_priority]
-    if not req_headers and config.ontoFormat.precedence in [
+    if not req_headers and onto_format_conf.precedence in [
         OntoPrecedence.DEFAULT,
         OntoPrecedence.ENFORCED_PRIORITY,
     ]:
-        wrapped_request.set_request_accept_header(mime_type)
+        return mime_type
     elif (
         len(req_headers) == 1
         and req_headers[0] == "*/*"
-        and config.ontoFormatConf.precedence
+        and onto_format_conf.precedence
         in [OntoPrecedence.DEFAULT, OntoPrecedence.ENFORCED_PRIORITY]
     ):
-        wrapped_request.set_request_accept_header(mime_type)
+        return mime_type
     elif (
         len(req_headers) > 1
         and mime_type in req_headers
-        and config.ontoFormatConf.precedence == OntoPrecedence.ENFORCED_PRIORITY
+        and onto_format_conf.precedence == OntoPrecedence.ENFORCED_PRIORITY
     ):
-        wrapped_request.set_request_accept_header(mime_type)
-    elif config.ontoFormatConf.precedence == OntoPrecedence.ALWAYS:
-        wrapped_request.set_request_accept_header(mime_type)
+        return mime_type
+    elif onto_format_conf.precedence == OntoPrecedence.ALWAYS:
+        return mime_type
+    return accept_header
+
+
+@functools.lru_cache(maxsize=ACCEPT_NEGOTIATION_CACHE_SIZE)
+def negotiate_accept_header(
+    accept_header: str, onto_format_conf: OntoFormatConfig, onto_version: OntoVersion
+) -> AcceptNegotiation:
+    """Patch the Accept header and select the Archivo format, memoized per input.
+
+    Clients send only a few distinct Accept headers, so the header is parsed and
+    the q-values are sorted once per header and configuration."""
+    logger.info(f"Negotiating Accept header: {accept_header}")
+    accept_header = patch_accept_header(accept_header, onto_format_conf, onto_version)
+    mimetypes_with_priority = parse_accept_header_with_priority(accept_header)
+    format = None
+    if mimetypes_with_priority:
+        selected_mimetype = select_highest_priority_mime_from_archivo(mimetypes_with_priority)
+        if selected_mimetype:
+            format = map_mime_to_format(selected_mimetype)
+        else:
+            logger.info(f"The requested mimetype is not supported by DBpedia Archivo")
+    return AcceptNegotiation(
+        accept_header, format, tuple(mime for mime, _ in mimetypes_with_priority)
+    )
+
+
+def set_onto_format_headers(wrapped_request, config):
+    logger.info(
+        f"Setting headers based on ontoFormat: {config.ontoFormatConf} and ontoVersion: {config.ontoVersion}"
+    )
+    request_accept_header = wrapped_request.get_request_accept_header()
+    logger.info(f"Accept header by request: {request_accept_header}")
+    negotiation = negotiate_accept_header(
+        request_accept_header, config.ontoFormatConf, config.ontoVersion
+    )
+    if negotiation.accept_header != request_accept_header:
+        wrapped_request.set_request_accept_header(negotiation.accept_header)
+    return negotiation
 
 
 def select_highest_priority_mime_from_archivo(mime_list):
@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import patch
+
+from ontologytimemachine.utils.admission import (
+    ADMIT,
+    ARCHIVO,
+    DEGRADE,
+    PASSTHROUGH,
+    PINNED,
+    REJECT,
+    AdmissionController,
+    DecayingAverage,
+    request_priority,
+)
+from ontologytimemachine.utils.config import Config, OntoVersion
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = AdmissionController(max_in_flight=4, max_queue_wait=1.0, max_loop_lag=0.5)
+
+    def test_requests_are_admitted_below_the_limits(self):
+        for priority in (PASSTHROUGH, ARCHIVO, PINNED):
+            self.assertEqual(self.controller.admit(priority), ADMIT)
+        self.assertEqual(self.controller.stats()["in_flight"], 3)
+        self.controller.done()
+        self.assertEqual(self.controller.stats()["in_flight"], 2)
+
+    def test_best_effort_traffic_is_shed_first(self):
+        for _ in range(4):
+            self.controller.admit(PINNED)
+        self.assertEqual(self.controller.admit(PASSTHROUGH), REJECT)
+        self.assertEqual(self.controller.admit(ARCHIVO), DEGRADE)
+        self.assertEqual(self.controller.admit(PINNED), ADMIT)
+        for _ in range(2):
+            self.controller.admit(PINNED)
+        # twice the limit in flight
+        self.assertEqual(self.controller.admit(ARCHIVO), REJECT)
+        self.assertEqual(self.controller.admit(PINNED), ADMIT)
+        self.assertEqual(self.controller.stats()["rejected"], 2)
+        self.assertEqual(self.controller.stats()["degraded"], 1)
+
+    def test_loop_lag_raises_pressure(self):
+        for _ in range(10):
+            self.controller.record_loop_lag(0.8)
+        self.assertGreater(self.controller.pressure(), 1)
+        self.assertEqual(self.controller.admit(ARCHIVO), DEGRADE)
+
+    def test_queue_wait_is_recorded(self):
+        with patch("ontologytimemachine.utils.admission.time.monotonic", return_value=100.0):
+            self.assertEqual(self.controller.run(lambda x: x * 2, 97.0, 21), 42)
+            self.assertAlmostEqual(self.controller.stats()["queue_wait"], 0.9)
+
+    def test_zero_limits_are_ignored(self):
+        controller = AdmissionController(max_in_flight=0, max_queue_wait=0, max_loop_lag=0)
+        controller.record_loop_lag(10)
+        self.assertEqual(controller.pressure(), 0)
+        self.assertEqual(controller.admit(PASSTHROUGH), ADMIT)
+
+
+class TestDecayingAverage(unittest.TestCase):
+
+    def test_value_fades_without_samples(self):
+        average = DecayingAverage()
+        average.add(1.0, now=10.0)
+        self.assertAlmostEqual(average.value(10.0), 0.3)
+        self.assertAlmostEqual(average.value(12.0), 0.075)
+
+
+class TestRequestPriority(unittest.TestCase):
+
+    def test_pinned_timestamps_have_the_highest_priority(self):
+        self.assertEqual(request_priority(Config(ontoVersion=OntoVersion.TIMESTAMP_ARCHIVED)), PINNED)
+        self.assertEqual(request_priority(Config(ontoVersion=OntoVersion.LATEST_ARCHIVED)), ARCHIVO)
+        self.assertEqual(request_priority(Config(ontoVersion=OntoVersion.ORIGINAL)), PASSTHROUGH)
+
+
+if __name__ == "__main__":
+    unittest.main()
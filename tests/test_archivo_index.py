@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+
+from ontologytimemachine.utils.archivo_index import (
+    ArchivoIndex,
+    MappedArchivoIndex,
+    write_snapshot,
+)
+
+
+IRIS = [
+    "http://bblfish.net/work/atom-owl/2006-06-06/",
+    "http://bag.basisregistraties.overheid.nl/def/bag",
+    "http://viaf.org/",
+    "http://edamontology.org",
+    "https://w3id.org/example/ontology",
+    "http://w3id.org/example/ontology/",
+]
+
+
+class TestArchivoIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ArchivoIndex.from_iris(IRIS)
+
+    def test_has_host(self):
+        self.assertTrue(self.index.has_host("viaf.org"))
+        self.assertFalse(self.index.has_host("pypi.org"))
+
+    def test_exact_match(self):
+        match = self.index.lookup("bag.basisregistraties.overheid.nl", "/def/bag")
+        self.assertEqual(match.iri, "http://bag.basisregistraties.overheid.nl/def/bag")
+        self.assertEqual(match.path, "/def/bag")
+
+    def test_trailing_slash_is_normalized_to_registered_form(self):
+        match = self.index.lookup("bag.basisregistraties.overheid.nl", "/def/bag/")
+        self.assertEqual(match.path, "/def/bag")
+        match = self.index.lookup("bblfish.net", "/work/atom-owl/2006-06-06")
+        self.assertEqual(match.path, "/work/atom-owl/2006-06-06/")
+
+    def test_both_forms_registered_prefers_requested_form(self):
+        self.assertEqual(self.index.lookup("w3id.org", "/example/ontology/").path, "/example/ontology/")
+        self.assertEqual(self.index.lookup("w3id.org", "/example/ontology").path, "/example/ontology")
+
+    def test_longest_prefix_for_terms(self):
+        match = self.index.lookup("bblfish.net", "/work/atom-owl/2006-06-06/Entry")
+        self.assertEqual(match.path, "/work/atom-owl/2006-06-06/")
+        match = self.index.lookup("viaf.org", "/viaf/some/deep/path")
+        self.assertEqual(match.path, "/")
+        match = self.index.lookup("edamontology.org", "/format_1915")
+        self.assertEqual(match.path, "")
+
+    def test_no_match(self):
+        self.assertIsNone(self.index.lookup("bblfish.net", "/work/other"))
+        self.assertIsNone(self.index.lookup("pypi.org", "/simple/"))
+
+    def test_classify_memoizes_and_is_cleared_on_change(self):
+        self.assertIsNone(self.index.classify("purl.org", "/dc/terms/"))
+        self.index.add("http://purl.org/dc/terms/")
+        match = self.index.classify("purl.org", "/dc/terms/title")
+        self.assertEqual(match.path, "/dc/terms/")
+
+    def test_classify_memo_is_bounded(self):
+        index = ArchivoIndex.from_iris(IRIS)
+        index.memo_size = 2
+        for path in ("/a", "/b", "/c"):
+            index.classify("viaf.org", path)
+        self.assertEqual(list(index._memo), [("viaf.org", "/b"), ("viaf.org", "/c")])
+
+
+class TestMappedArchivoIndex(TestArchivoIndex):
+    """Runs the lookup tests above against a memory mapped snapshot."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "index.idx")
+        self.assertEqual(write_snapshot(IRIS + ["", "http://viaf.org/"], self.path), len(IRIS))
+        self.index = MappedArchivoIndex(self.path)
+
+    def test_classify_memoizes_and_is_cleared_on_change(self):
+        self.assertIsNone(self.index.classify("purl.org", "/dc/terms/"))
+        self.assertEqual(list(self.index._memo), [("purl.org", "/dc/terms/")])
+        self.index.clear_memo()
+        self.assertEqual(list(self.index._memo), [])
+
+    def test_classify_memo_is_bounded(self):
+        self.index.memo_size = 2
+        for path in ("/a", "/b", "/c"):
+            self.index.classify("viaf.org", path)
+        self.assertEqual(list(self.index._memo), [("viaf.org", "/b"), ("viaf.org", "/c")])
+
+    def test_same_content_as_trie(self):
+        trie = ArchivoIndex.from_iris(IRIS)
+        self.assertEqual(len(self.index), len(trie))
+        self.assertEqual(sorted(self.index.iris()), sorted(trie.iris()))
+        self.assertEqual(sorted(self.index.hosts()), sorted(trie.hosts()))
+
+    def test_host_filter_is_built_on_first_use(self):
+        self.assertIsNone(self.index._host_set)
+        self.assertIsNone(self.index.lookup("pypi.org", "/simple/"))
+        self.assertIn("viaf.org", self.index._host_set)
+
+    def test_rejects_other_files(self):
+        with open(self.path, "r+b") as f:
+            f.write(b"NOTINDEX")
+        with self.assertRaises(ValueError):
+            MappedArchivoIndex(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
+import dataclasses
+import logging
 import unittest
-from ontologytimemachine.utils.config import parse_arguments, Config
+from ontologytimemachine.utils.config import parse_arguments, parse_client_config, Config
 import sys
-from ontologytimemachine.utils.config import OntoVersion, HttpsInterception
+from ontologytimemachine.utils.config import OntoFormat, OntoVersion, HttpsInterception, logger
 
 
 class TestConfig(unittest.TestCase):
@@ -24,6 +26,40 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(config.restrictedAccess, False)
         self.assertEqual(config.httpsInterception, HttpsInterception.NONE)
 
+    def test_parse_client_config_matches_parse_arguments(self):
+        config_str = (
+            "--ontoFormat turtle --ontoPrecedence always --patchAcceptUpstream --ontoVersion original "
+            "--restrictedAccess --httpsInterception none --disableRemovingRedirects"
+        )
+        # --logLevelBase is a server option, matched here to the Config default
+        sys.argv = ["test"] + config_str.split() + ["--logLevelBase", "info"]
+        self.assertEqual(parse_client_config(config_str), parse_arguments())
+
+    def test_parse_client_config_is_cached_and_frozen(self):
+        config = parse_client_config("--ontoFormat=rdfxml --httpsInterception archivo")
+        self.assertIs(parse_client_config("--ontoFormat=rdfxml --httpsInterception archivo"), config)
+        self.assertEqual(config.ontoFormatConf.format, OntoFormat.RDFXML)
+        self.assertEqual(config.httpsInterception, HttpsInterception.ARCHIVO)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            config.ontoVersion = OntoVersion.ORIGINAL
+
+    def test_parse_client_config_rejects_server_options(self):
+        for config_str in (
+            "--logLevelTimeMachine critical",
+            "--port 8080",
+            "--timestamp 20240101",
+            "--cacheDir /tmp",
+            "--fetchPoolSize 1",
+            "--upstreamClient httpx",
+        ):
+            with self.assertRaises(ValueError):
+                parse_client_config(config_str)
+
+    def test_parse_client_config_rejects_invalid(self):
+        for config_str in ("--port", "--unknown 1", "--ontoVersion nope", "turtle", "--restrictedAccess=yes"):
+            with self.assertRaises(ValueError):
+                parse_client_config(config_str)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,224 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import requests
+
+from ontologytimemachine.utils.disk_cache import DiskCache
+
+
+def make_response(content, url="https://archivo.dbpedia.org/download"):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers["Content-Type"] = "text/turtle"
+    response._content = content
+    return response
+
+
+def make_streamed_response(chunks, url="https://archivo.dbpedia.org/download"):
+    response = make_response(None, url)
+    response._content = False
+    response.raw = io.BytesIO()
+    response.body_chunks = iter(chunks)
+    return response
+
+
+def write_entries(cache, worker, count):
+    # runs in a forked process, errors of the cache fail it through the exit code
+    with patch("ontologytimemachine.utils.disk_cache.logger") as logger:
+        for index in range(count):
+            cache.put((worker, index), make_response(f"{worker}-{index}".encode() * 100), {})
+            cache.get(((worker + 1) % 4, index))
+    os._exit(1 if logger.error.called else 0)
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_entries_survive_reload(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        cache.put(("a", "ttl"), make_response(b"foo"), {"Content-Type": "text/turtle"})
+
+        reloaded = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        response = reloaded.get(("a", "ttl"))
+        self.assertEqual(response.content, b"foo")
+        self.assertEqual(response.headers["Content-Type"], "text/turtle")
+
+    def test_identical_content_is_stored_once(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        cache.put(("a", "ttl"), make_response(b"same"), {})
+        cache.put(("b", "ttl"), make_response(b"same"), {})
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["objects"], 1)
+        self.assertEqual(stats["bytes"], 4)
+
+    def test_size_based_eviction(self):
+        cache = DiskCache(self.directory, max_bytes=8, ttl=60)
+        cache.put(("a", "ttl"), make_response(b"aaaa"), {})
+        cache.put(("b", "ttl"), make_response(b"bbbb"), {})
+        cache.get(("a", "ttl"))
+        cache.put(("c", "ttl"), make_response(b"cccc"), {})
+        self.assertIsNone(cache.get(("b", "ttl")))
+        self.assertIsNotNone(cache.get(("a", "ttl")))
+        self.assertIsNotNone(cache.get(("c", "ttl")))
+        objects_dir = os.path.join(self.directory, "objects")
+        stored = [name for _, _, files in os.walk(objects_dir) for name in files]
+        self.assertEqual(len(stored), 2)
+
+    def test_expired_entry_is_dropped(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=0)
+        cache.put(("a", "ttl"), make_response(b"foo"), {})
+        self.assertIsNone(cache.get(("a", "ttl")))
+        self.assertEqual(cache.stats()["objects"], 0)
+
+    def test_stale_entries_are_kept_with_hard_ttl(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=0, hard_ttl=60)
+        cache.put(("a", "ttl"), make_response(b"foo"), {})
+        self.assertIsNone(cache.get(("a", "ttl")))
+        response = cache.get(("a", "ttl"), allow_stale=True)
+        self.assertTrue(response.stale)
+        self.assertEqual(response.content, b"foo")
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=0, hard_ttl=0)
+        self.assertIsNone(cache.get(("a", "ttl"), allow_stale=True))
+        self.assertEqual(cache.get_last_good(("a", "ttl")).content, b"foo")
+        self.assertEqual(cache.stats()["objects"], 1)
+
+    def test_immutable_entries_never_expire_and_are_evicted_last(self):
+        cache = DiskCache(self.directory, max_bytes=8, ttl=0)
+        cache.put(("pinned", "ttl"), make_response(b"pppp"), {}, immutable=True)
+        cache.put(("latest", "ttl"), make_response(b"llll"), {})
+        cache.get(("pinned", "ttl"))
+        cache.put(("other", "ttl"), make_response(b"oooo"), {}, immutable=True)
+        self.assertIsNotNone(cache.get(("pinned", "ttl")))
+        self.assertIsNotNone(cache.get(("other", "ttl")))
+        self.assertIsNone(cache.get(("latest", "ttl")))
+
+    def test_large_bodies_are_returned_as_open_file(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        cache.put(("a", "ttl"), make_response(b"foobar"), {"Content-Type": "text/turtle"})
+        response = cache.get(("a", "ttl"), max_read_bytes=4)
+        with response.body_file:
+            self.assertEqual(response.body_size, 6)
+            self.assertEqual(response.body_file.read(), b"foobar")
+        self.assertEqual(response.headers["Content-Type"], "text/turtle")
+        self.assertEqual(
+            response.headers["ETag"],
+            '"c3ab8ff13720e8ad9047dd39466b3c8974e592c2fa383d4a3960714caef0c4f2"',
+        )
+        self.assertEqual(cache.get(("a", "ttl"), max_read_bytes=6).content, b"foobar")
+
+    def test_streamed_body_is_stored_while_it_is_sent(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        response = cache.put_stream(("a", "ttl"), make_streamed_response([b"foo", b"bar"]), {})
+        self.assertEqual(next(response.body_chunks), b"foo")
+        # the entry is added once the body is complete
+        self.assertIsNone(cache.get(("a", "ttl")))
+        self.assertEqual(b"".join(response.body_chunks), b"bar")
+        self.assertEqual(cache.get(("a", "ttl")).content, b"foobar")
+        cache.put(("b", "ttl"), make_response(b"foobar"), {})
+        self.assertEqual(cache.stats()["objects"], 1)
+
+    def test_streamed_body_too_large_is_served_but_not_stored(self):
+        cache = DiskCache(self.directory, max_bytes=4, ttl=60)
+        response = cache.put_stream(("a", "ttl"), make_streamed_response([b"foo", b"bar"]), {})
+        self.assertEqual(b"".join(response.body_chunks), b"foobar")
+        self.assertIsNone(cache.get(("a", "ttl")))
+        objects_dir = os.path.join(self.directory, "objects")
+        self.assertEqual([name for _, _, files in os.walk(objects_dir) for name in files], [])
+
+    def test_same_body_keeps_last_modified(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        cache.put(("a", "ttl"), make_response(b"foobar"), {"Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+        response = cache.put_stream(
+            ("a", "ttl"), make_streamed_response([b"foo", b"bar"]), {"Last-Modified": "Tue, 02 Jan 2024 00:00:00 GMT"}
+        )
+        b"".join(response.body_chunks)
+        self.assertEqual(cache.get_headers(("a", "ttl"))["Last-Modified"], "Mon, 01 Jan 2024 00:00:00 GMT")
+        cache.put(("a", "ttl"), make_response(b"changed"), {"Last-Modified": "Wed, 03 Jan 2024 00:00:00 GMT"})
+        self.assertEqual(cache.get_headers(("a", "ttl"))["Last-Modified"], "Wed, 03 Jan 2024 00:00:00 GMT")
+
+    def test_abandoned_stream_is_not_stored(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        streamed = make_streamed_response([b"foo", b"bar"])
+        response = cache.put_stream(("a", "ttl"), streamed, {})
+        self.assertEqual(next(response.body_chunks), b"foo")
+        response.close()
+        self.assertTrue(streamed.raw.closed)
+        self.assertIsNone(cache.get(("a", "ttl")))
+        objects_dir = os.path.join(self.directory, "objects")
+        self.assertEqual([name for _, _, files in os.walk(objects_dir) for name in files], [])
+
+    def test_announced_length_too_large_is_not_read(self):
+        cache = DiskCache(self.directory, max_bytes=4, ttl=60)
+        streamed = make_streamed_response([b"foo", b"bar"])
+        streamed.headers["Content-Length"] = "6"
+        self.assertIsNone(cache.put_stream(("a", "ttl"), streamed, {}))
+        self.assertEqual(next(streamed.body_chunks), b"foo")
+
+    def test_workers_share_entries(self):
+        # each proxy worker process opens its own instance on the same directory
+        first = DiskCache(self.directory, max_bytes=8, ttl=60)
+        second = DiskCache(self.directory, max_bytes=8, ttl=60)
+        first.put(("a", "ttl"), make_response(b"aaaa"), {})
+        second.put(("b", "ttl"), make_response(b"bbbb"), {})
+        self.assertEqual(second.get(("a", "ttl")).content, b"aaaa")
+        self.assertEqual(first.get(("b", "ttl")).content, b"bbbb")
+        second.put(("c", "ttl"), make_response(b"cccc"), {})
+        # evicted by the second worker, which read a more recently
+        self.assertIsNone(first.get(("b", "ttl")))
+        self.assertEqual(first.get(("a", "ttl")).content, b"aaaa")
+        self.assertEqual(first.get(("c", "ttl")).content, b"cccc")
+        self.assertEqual(first.stats()["entries"], 2)
+
+    def test_forked_workers_share_entries(self):
+        # proxy.py forks its workers after the cache was opened in the parent
+        cache = DiskCache(self.directory, max_bytes=1024 * 1024, ttl=60)
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=write_entries, args=(cache, worker, 50)) for worker in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([worker.exitcode for worker in workers], [0] * 4)
+        with patch("ontologytimemachine.utils.disk_cache.logger") as logger:
+            reloaded = DiskCache(self.directory, max_bytes=1024 * 1024, ttl=60)
+        logger.error.assert_not_called()
+        self.assertEqual(reloaded.stats()["entries"], 200)
+        for worker in range(4):
+            for index in range(50):
+                self.assertEqual(reloaded.get((worker, index)).content, f"{worker}-{index}".encode() * 100)
+
+    def test_object_shared_with_another_key_is_kept(self):
+        first = DiskCache(self.directory, max_bytes=1024, ttl=0)
+        second = DiskCache(self.directory, max_bytes=1024, ttl=0)
+        first.put(("a", "ttl"), make_response(b"same"), {})
+        second.put(("b", "ttl"), make_response(b"same"), {}, immutable=True)
+        self.assertIsNone(first.get(("a", "ttl")))
+        self.assertEqual(first.get(("b", "ttl")).content, b"same")
+
+    def test_journal_is_compacted(self):
+        cache = DiskCache(self.directory, max_bytes=1024, ttl=60)
+        with patch("ontologytimemachine.utils.disk_cache.COMPACT_MIN_RECORDS", 4):
+            for i in range(10):
+                cache.put(("a", "ttl"), make_response(b"%d" % i), {})
+        with open(cache.journal_path, "rb") as journal:
+            self.assertLess(len(journal.readlines()), 10)
+        objects_dir = os.path.join(self.directory, "objects")
+        self.assertEqual(len([name for _, _, files in os.walk(objects_dir) for name in files]), 1)
+        self.assertEqual(DiskCache(self.directory, max_bytes=1024, ttl=60).get(("a", "ttl")).content, b"9")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ontologytimemachine.utils import download_archivo_urls as dl
+from ontologytimemachine.utils.archivo_index import ArchivoIndex, MappedArchivoIndex
+
+
+class TestArchivoIndexRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.download_path = os.path.join(self.tmpdir.name, "download.txt")
+        self.snapshot_path = os.path.join(self.tmpdir.name, "download.idx")
+        self.bundled_path = os.path.join(self.tmpdir.name, "bundled.txt")
+        with open(self.bundled_path, "w") as f:
+            f.write("http://viaf.org/\n")
+        patches = [
+            mock.patch.object(dl, "ARCHIVO_FILE_PATH", self.download_path),
+            mock.patch.object(dl, "ARCHIVO_SNAPSHOT_PATH", self.snapshot_path),
+            mock.patch.object(dl, "ARCHIVO_BUNDLED_FILE_PATH", self.bundled_path),
+            mock.patch.object(dl, "ARCHIVO_INDEX", ArchivoIndex()),
+            mock.patch.object(dl, "start_refresher"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_load_uses_bundled_list_without_downloading(self):
+        with mock.patch.object(dl, "download_archivo_urls") as download:
+            index = dl.load_archivo_urls()
+        download.assert_not_called()
+        dl.start_refresher.assert_called_once()
+        self.assertTrue(index.has_host("viaf.org"))
+
+    def test_load_prefers_downloaded_list(self):
+        with open(self.download_path, "w") as f:
+            f.write("http://edamontology.org\n")
+        index = dl.load_archivo_urls()
+        self.assertTrue(index.has_host("edamontology.org"))
+        self.assertFalse(index.has_host("viaf.org"))
+
+    def test_load_maps_compiled_snapshot(self):
+        with open(self.download_path, "w") as f:
+            f.write("http://edamontology.org\n")
+        dl.compile_archivo_snapshot()
+        index = dl.load_archivo_urls()
+        self.assertIsInstance(index, MappedArchivoIndex)
+        self.assertTrue(index.has_host("edamontology.org"))
+
+    def test_refresh_replaces_in_memory_index(self):
+        old_index = dl.load_archivo_urls()
+        changes = dl.ArchivoChanges({"http://edamontology.org"}, {"http://viaf.org/"})
+        with mock.patch.object(dl, "download_archivo_urls", return_value=changes):
+            self.assertTrue(dl.refresh_archivo_index())
+        new_index = dl.load_archivo_urls()
+        self.assertIsNot(new_index, old_index)
+        self.assertTrue(new_index.has_host("edamontology.org"))
+        self.assertFalse(new_index.has_host("viaf.org"))
+        # the old index is left untouched for requests still using it
+        self.assertTrue(old_index.has_host("viaf.org"))
+
+    def test_not_modified_maps_snapshot_of_other_worker(self):
+        # the bundled list is live while another worker wrote the snapshot
+        old_index = dl.load_archivo_urls()
+        with open(self.download_path, "w") as f:
+            f.write("http://edamontology.org\n")
+        dl.compile_archivo_snapshot()
+        with mock.patch.object(dl, "download_archivo_urls", return_value=dl.ArchivoChanges(set(), set())):
+            self.assertTrue(dl.refresh_archivo_index())
+        self.assertIsNot(dl.load_archivo_urls(), old_index)
+        self.assertIsInstance(dl.load_archivo_urls(), MappedArchivoIndex)
+        self.assertTrue(dl.load_archivo_urls().has_host("edamontology.org"))
+
+    def test_refresh_swaps_in_new_snapshot(self):
+        with open(self.download_path, "w") as f:
+            f.write("http://viaf.org/\n")
+        dl.compile_archivo_snapshot()
+        old_index = dl.load_archivo_urls()
+
+        def download():
+            with open(self.download_path, "w") as f:
+                f.write("http://edamontology.org\n")
+            dl.compile_archivo_snapshot()
+            return dl.ArchivoChanges({"http://edamontology.org"}, {"http://viaf.org/"})
+
+        with mock.patch.object(dl, "download_archivo_urls", side_effect=download):
+            self.assertTrue(dl.refresh_archivo_index())
+        self.assertIsNot(dl.load_archivo_urls(), old_index)
+        self.assertTrue(dl.load_archivo_urls().has_host("edamontology.org"))
+        # the old index is left untouched for requests still using it
+        self.assertTrue(old_index.has_host("viaf.org"))
+
+    def test_refresh_picks_up_snapshot_of_other_worker(self):
+        with open(self.download_path, "w") as f:
+            f.write("http://viaf.org/\n")
+        dl.compile_archivo_snapshot()
+        old_index = dl.load_archivo_urls()
+        with open(self.download_path, "w") as f:
+            f.write("http://edamontology.org\n")
+        dl.compile_archivo_snapshot()
+        with mock.patch.object(dl, "download_archivo_urls", return_value=dl.ArchivoChanges(set(), set())):
+            self.assertTrue(dl.refresh_archivo_index())
+        self.assertIsNot(dl.load_archivo_urls(), old_index)
+
+    def test_remap_picks_up_new_snapshot(self):
+        old_index = dl.load_archivo_urls()
+        dl.remap_archivo_index()
+        self.assertIs(dl.load_archivo_urls(), old_index)
+        with open(self.download_path, "w") as f:
+            f.write("http://edamontology.org\n")
+        dl.compile_archivo_snapshot()
+        dl.remap_archivo_index()
+        mapped_index = dl.load_archivo_urls()
+        self.assertIsInstance(mapped_index, MappedArchivoIndex)
+        self.assertTrue(mapped_index.has_host("edamontology.org"))
+        dl.remap_archivo_index()
+        self.assertIs(dl.load_archivo_urls(), mapped_index)
+
+    def test_only_one_process_downloads(self):
+        lock_path = os.path.join(self.tmpdir.name, "download.lock")
+        lock_file = dl.acquire_download_lock(lock_path)
+        self.assertIsNotNone(lock_file)
+        self.assertIsNone(dl.acquire_download_lock(lock_path))
+        lock_file.close()
+        lock_file = dl.acquire_download_lock(lock_path)
+        self.assertIsNotNone(lock_file)
+        lock_file.close()
+
+    def test_failed_refresh_keeps_current_index(self):
+        old_index = dl.load_archivo_urls()
+        with mock.patch.object(dl, "download_archivo_urls", return_value=None):
+            self.assertFalse(dl.refresh_archivo_index())
+        self.assertIs(dl.load_archivo_urls(), old_index)
+
+
+class TestDownloadArchivoUrls(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.download_path = os.path.join(self.tmpdir.name, "download.txt")
+        self.snapshot_path = os.path.join(self.tmpdir.name, "download.idx")
+        patches = [
+            mock.patch.object(dl, "ARCHIVO_FILE_PATH", self.download_path),
+            mock.patch.object(dl, "ARCHIVO_SNAPSHOT_PATH", self.snapshot_path),
+            mock.patch.object(dl, "ARCHIVO_META_PATH", os.path.join(self.tmpdir.name, "download.json")),
+            mock.patch.object(dl, "ARCHIVO_INDEX", ArchivoIndex.from_iris(["http://viaf.org/"])),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def mock_get(self, status_code, text="", headers=None):
+        response = mock.Mock(status_code=status_code, text=text, headers=headers or {})
+        return mock.patch.object(dl.requests, "get", return_value=response)
+
+    def test_download_diffs_against_live_index(self):
+        csv = "http://viaf.org/,2024.07.26\nhttp://edamontology.org,2024.07.26\n"
+        with self.mock_get(200, csv, {"ETag": '"v1"'}) as get:
+            changes = dl.download_archivo_urls()
+        self.assertEqual(get.call_args.kwargs["headers"], {})
+        self.assertEqual(changes, dl.ArchivoChanges({"http://edamontology.org"}, set()))
+        with open(self.download_path) as f:
+            self.assertEqual(f.read().split(), ["http://edamontology.org", "http://viaf.org/"])
+        self.assertEqual(len(MappedArchivoIndex(self.snapshot_path)), 2)
+
+    def test_not_modified_is_conditional(self):
+        with self.mock_get(200, "http://viaf.org/,2024.07.26\n", {"ETag": '"v1"', "Last-Modified": "Fri"}):
+            dl.download_archivo_urls()
+        with self.mock_get(304) as get:
+            changes = dl.download_archivo_urls()
+        self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"v1"', "If-Modified-Since": "Fri"})
+        self.assertEqual(changes, dl.ArchivoChanges(set(), set()))
+
+    def test_unchanged_urls_do_not_rewrite_snapshot(self):
+        with self.mock_get(200, "http://viaf.org/,2024.07.26\n"):
+            dl.download_archivo_urls()
+        snapshot_inode = os.stat(self.snapshot_path).st_ino
+        with self.mock_get(200, "http://viaf.org/,2024.08.01\n"):
+            changes = dl.download_archivo_urls()
+        self.assertEqual(changes, dl.ArchivoChanges(set(), set()))
+        self.assertEqual(os.stat(self.snapshot_path).st_ino, snapshot_inode)
+
+    def test_failed_download(self):
+        with mock.patch.object(dl.requests, "get", side_effect=dl.requests.ConnectionError("down")):
+            self.assertIsNone(dl.download_archivo_urls())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import threading
+import unittest
+
+from ontologytimemachine.utils.fetch_pool import FetchPool, FetchPoolFull
+
+
+class TestFetchPool(unittest.TestCase):
+
+    def test_rejects_when_workers_and_queue_are_busy(self):
+        pool = FetchPool(max_workers=1, max_queue=1)
+        release = threading.Event()
+        running = pool.submit(release.wait)
+        queued = pool.submit(release.wait)
+        with self.assertRaises(FetchPoolFull):
+            pool.submit(release.wait)
+        release.set()
+        running.result(timeout=5)
+        queued.result(timeout=5)
+        self.assertEqual(pool.submit(lambda: "done").result(timeout=5), "done")
+        pool.shutdown()
+
+    def test_exceptions_are_returned_through_the_future(self):
+        pool = FetchPool(max_workers=1, max_queue=0)
+
+        def fail():
+            raise ValueError("upstream failed")
+
+        with self.assertRaises(ValueError):
+            pool.submit(fail).result(timeout=5)
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import patch
+
+from ontologytimemachine.utils.host_health import CLOSED, HALF_OPEN, OPEN, HostHealth
+
+
+class TestHostHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.health = HostHealth(
+            min_timeout=0.5, max_timeout=10, failure_threshold=3, open_seconds=30
+        )
+
+    def test_unknown_host_gets_initial_timeout(self):
+        self.assertEqual(self.health.timeout("example.org"), 3.0)
+
+    def test_timeout_is_derived_from_latency_percentile(self):
+        for _ in range(19):
+            self.health.record_success("example.org", 0.2)
+        self.health.record_success("example.org", 1.0)
+        self.assertAlmostEqual(self.health.timeout("example.org"), 4.0)
+        for _ in range(40):
+            self.health.record_success("fast.example.org", 0.01)
+        self.assertEqual(self.health.timeout("fast.example.org"), 0.5)
+        self.health.record_success("slow.example.org", 30)
+        self.assertEqual(self.health.timeout("slow.example.org"), 10)
+
+    def test_consecutive_failures_open_the_circuit(self):
+        self.health.record_failure("example.org")
+        self.health.record_failure("example.org")
+        self.health.record_success("example.org", 0.1)
+        self.health.record_failure("example.org")
+        self.health.record_failure("example.org")
+        self.assertEqual(self.health.circuit("example.org"), CLOSED)
+        self.health.record_failure("example.org")
+        self.assertEqual(self.health.circuit("example.org"), OPEN)
+        self.assertFalse(self.health.allow("example.org"))
+        self.assertTrue(self.health.allow("other.example.org"))
+        self.assertEqual(self.health.rejected, 1)
+
+    def test_high_error_rate_opens_the_circuit(self):
+        for _ in range(6):
+            self.health.record_success("example.org", 0.1)
+            self.health.record_failure("example.org")
+            self.health.record_failure("example.org")
+        self.assertEqual(self.health.circuit("example.org"), OPEN)
+
+    def test_half_open_circuit_lets_one_probe_through(self):
+        with patch("ontologytimemachine.utils.host_health.time.monotonic", return_value=100):
+            for _ in range(3):
+                self.health.record_failure("example.org")
+        with patch("ontologytimemachine.utils.host_health.time.monotonic", return_value=120):
+            self.assertFalse(self.health.allow("example.org"))
+        with patch("ontologytimemachine.utils.host_health.time.monotonic", return_value=130):
+            self.assertTrue(self.health.allow("example.org"))
+            self.assertEqual(self.health.circuit("example.org"), HALF_OPEN)
+            self.assertFalse(self.health.allow("example.org"))
+            self.health.record_failure("example.org")
+            self.assertEqual(self.health.circuit("example.org"), OPEN)
+        with patch("ontologytimemachine.utils.host_health.time.monotonic", return_value=160):
+            self.assertTrue(self.health.allow("example.org"))
+            self.health.record_success("example.org", 0.1)
+        self.assertEqual(self.health.circuit("example.org"), CLOSED)
+        self.assertTrue(self.health.allow("example.org"))
+
+    def test_least_recently_used_hosts_are_dropped(self):
+        health = HostHealth(0.5, 10, 3, 30, max_hosts=2)
+        health.record_success("a", 0.1)
+        health.record_success("b", 0.1)
+        health.record_success("c", 0.1)
+        self.assertEqual(sorted(health.stats()), ["b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,7 @@ from ontologytimemachine.utils.mock_responses import (
     mock_response_403,
     mock_response_404,
     mock_response_500,
+    mock_response_503,
 )
 
 # Configure logger
@@ -36,6 +37,16 @@ class TestMockResponses(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertIn("500 Internal Server Error", response.text)
 
+    def test_mock_response_503(self):
+        response = mock_response_503()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("503 Service Unavailable", response.text)
+        self.assertNotIn("Retry-After", response.headers)
+
+    def test_mock_response_503_with_retry_after(self):
+        response = mock_response_503(retry_after=5)
+        self.assertEqual(response.headers["Retry-After"], "5")
+
 
 if __name__ == "__main__":
     unittest.main()
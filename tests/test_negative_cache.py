@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import patch
+
+from ontologytimemachine.utils.negative_cache import NegativeCache
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def test_entries_expire_after_ttl(self):
+        cache = NegativeCache(ttl=10)
+        with patch("ontologytimemachine.utils.negative_cache.time.time", return_value=100):
+            cache.put(("origin", "http://example.org/onto"), "unreachable")
+        with patch("ontologytimemachine.utils.negative_cache.time.time", return_value=105):
+            self.assertEqual(cache.get(("origin", "http://example.org/onto")), "unreachable")
+        with patch("ontologytimemachine.utils.negative_cache.time.time", return_value=110):
+            self.assertIsNone(cache.get(("origin", "http://example.org/onto")))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_oldest_entries_are_dropped(self):
+        cache = NegativeCache(ttl=60, max_entries=2)
+        cache.put("a", 404)
+        cache.put("b", 500)
+        cache.put("a", 404)
+        cache.put("c", 500)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 404)
+        self.assertEqual(cache.get("c"), 500)
+
+    def test_zero_ttl_disables_cache(self):
+        cache = NegativeCache(ttl=0)
+        cache.put("a", 404)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,346 @@
+import time
+import unittest
+from unittest.mock import Mock, patch
+import requests
+
+from ontologytimemachine.utils import (
+    fetch_pool,
+    host_health,
+    negative_cache,
+    proxy_logic,
+    response_cache,
+    scheme_preference,
+    upstream_limits,
+)
+from ontologytimemachine.proxy_wrapper import RequestSnapshot
+from ontologytimemachine.utils.archivo_index import ArchivoIndex
+from ontologytimemachine.utils.fetch_pool import FetchPool
+from ontologytimemachine.utils.host_health import HostHealth
+from ontologytimemachine.utils.upstream_limits import UpstreamLimiter
+from ontologytimemachine.utils.negative_cache import NegativeCache
+from ontologytimemachine.utils.response_cache import ResponseCache
+from ontologytimemachine.utils.scheme_preference import SchemePreferences
+from ontologytimemachine.utils.config import OntoVersion
+from ontologytimemachine.utils.utils import AcceptNegotiation
+
+
+def make_response(content, status_code=200, content_type="text/turtle"):
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = "http://example.org/onto"
+    response.headers["Content-Type"] = content_type
+    response._content = content
+    return response
+
+
+def delayed(seconds, response):
+    def fetch(*args):
+        time.sleep(seconds)
+        return response
+    return fetch
+
+
+class TestFetchFailover(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapped_request = Mock()
+        self.wrapped_request.get_request_url_host_path.return_value = (
+            "http://example.org/onto", "example.org", "/onto"
+        )
+        self.wrapped_request.get_request_headers.return_value = {}
+        self.negotiation = AcceptNegotiation("text/turtle", "ttl", ("text/turtle",))
+        patcher = patch.object(negative_cache, "NEGATIVE_CACHE", NegativeCache(ttl=60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_failover(self, original, archived, hedge_delay):
+        with patch.object(proxy_logic, "request_ontology", side_effect=original) as request_ontology, \
+                patch.object(proxy_logic, "fetch_latest_archived", side_effect=archived) as fetch_latest_archived:
+            response = proxy_logic.fetch_failover(
+                self.wrapped_request, {}, False, self.negotiation, hedge_delay
+            )
+        return response, request_ontology.call_count, fetch_latest_archived.call_count
+
+    def test_fast_original_is_served_without_archivo(self):
+        response, _, archived_calls = self.fetch_failover(
+            delayed(0, make_response(b"original")), delayed(0, make_response(b"archived")), 1
+        )
+        self.assertEqual(response.content, b"original")
+        self.assertEqual(archived_calls, 0)
+
+    def test_slow_original_loses_against_archivo(self):
+        start = time.time()
+        response, _, archived_calls = self.fetch_failover(
+            delayed(1, make_response(b"original")), delayed(0, make_response(b"archived")), 0.1
+        )
+        self.assertEqual(response.content, b"archived")
+        self.assertEqual(archived_calls, 1)
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_hedged_fetches_do_not_use_the_request(self):
+        # the losing fetch runs on after proxy.py reused the request parser
+        with patch.object(proxy_logic, "request_ontology", side_effect=delayed(0.5, make_response(b"original"))) as original, \
+                patch.object(proxy_logic, "fetch_latest_archived", side_effect=delayed(0, make_response(b"archived"))) as archived:
+            response = proxy_logic.fetch_failover(self.wrapped_request, {}, False, self.negotiation, 0.1)
+        self.assertEqual(response.content, b"archived")
+        self.assertIsInstance(original.call_args.args[0], RequestSnapshot)
+        self.assertIsInstance(archived.call_args.args[0], RequestSnapshot)
+
+    def test_original_preferred_when_both_are_requested(self):
+        response, _, archived_calls = self.fetch_failover(
+            delayed(0.1, make_response(b"original")), delayed(0.3, make_response(b"archived")), 0
+        )
+        self.assertEqual(response.content, b"original")
+        self.assertEqual(archived_calls, 1)
+
+    def test_archivo_failure_waits_for_original(self):
+        response, _, _ = self.fetch_failover(
+            delayed(0.3, make_response(b"original")), delayed(0, make_response(b"", 500)), 0
+        )
+        self.assertEqual(response.content, b"original")
+
+    def test_unusable_original_is_remembered(self):
+        original = delayed(0, make_response(b"<html/>", content_type="text/html"))
+        response, _, _ = self.fetch_failover(original, delayed(0, make_response(b"archived")), -1)
+        self.assertEqual(response.content, b"archived")
+        response, original_calls, _ = self.fetch_failover(
+            original, delayed(0, make_response(b"archived")), -1
+        )
+        self.assertEqual(response.content, b"archived")
+        self.assertEqual(original_calls, 0)
+
+    def test_busy_proxy_does_not_blame_the_original(self):
+        original = delayed(0, proxy_logic.upstream_busy_response(5))
+        self.fetch_failover(original, delayed(0, make_response(b"archived")), -1)
+        _, original_calls, _ = self.fetch_failover(original, delayed(0, make_response(b"archived")), -1)
+        self.assertEqual(original_calls, 1)
+
+
+class TestRequestSnapshot(unittest.TestCase):
+
+    def test_archivo_classification_rewrites_the_snapshot(self):
+        wrapped_request = Mock()
+        wrapped_request.get_request_host.return_value = "example.org"
+        wrapped_request.get_request_path.return_value = "/onto/Class"
+        wrapped_request.get_request_url_host_path.return_value = (
+            "http://example.org/onto/Class", "example.org", "/onto/Class"
+        )
+        wrapped_request.get_request_headers.return_value = {"Accept": "text/turtle"}
+        wrapped_request.archivo_classification = None
+        snapshot = RequestSnapshot(wrapped_request)
+        index = ArchivoIndex.from_iris(["http://example.org/onto"])
+        with patch.object(proxy_logic, "load_archivo_urls", return_value=index):
+            self.assertTrue(proxy_logic.is_archivo_ontology_request(snapshot))
+        self.assertEqual(snapshot.get_request_url_host_path(), ("http://example.org/onto", "example.org", "/onto"))
+        self.assertEqual(snapshot.archivo_iri, "http://example.org/onto")
+        wrapped_request.set_request_path.assert_not_called()
+
+
+class TestRequestLatestArchived(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapped_request = Mock()
+        self.wrapped_request.is_get_request.return_value = True
+        self.wrapped_request.get_request_headers.return_value = {}
+        self.wrapped_request.archivo_iri = None
+        patches = [
+            patch.object(negative_cache, "NEGATIVE_CACHE", NegativeCache(ttl=60)),
+            patch.object(scheme_preference, "SCHEME_PREFERENCES", SchemePreferences()),
+            patch.object(response_cache, "RESPONSE_CACHE", ResponseCache(max_bytes=1024, ttl=60)),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.requested_urls = []
+
+    def archivo(self, known_scheme):
+        def request_archivo(wrapped_request, url, headers):
+            self.requested_urls.append(url)
+            if f"o={known_scheme}://" in url:
+                return make_response(b"archived")
+            return make_response(b"", 500)
+        return patch.object(proxy_logic, "request_archivo", side_effect=request_archivo)
+
+    def request(self):
+        return proxy_logic.request_latest_archived(
+            self.wrapped_request, {}, "http://example.org/onto", "ttl", ("key",)
+        )
+
+    def test_unknown_ontology_races_both_schemes_and_learns(self):
+        with self.archivo("https"):
+            self.assertEqual(self.request().content, b"archived")
+        self.assertEqual(len(self.requested_urls), 2)
+        self.assertEqual(scheme_preference.SCHEME_PREFERENCES.get("http://example.org/onto"), "https")
+
+    def test_race_on_a_busy_hedge_pool(self):
+        # the race of a hedged Archivo request must not wait for its own pool
+        with patch.object(fetch_pool, "HEDGE_POOL", FetchPool(1, 4)), self.archivo("https"):
+            response = fetch_pool.HEDGE_POOL.submit(self.request).result(timeout=5)
+        self.assertEqual(response.content, b"archived")
+
+    def test_race_gives_up_at_the_deadline(self):
+        with patch.object(proxy_logic, "upstream_deadline", return_value=0.2), \
+                patch.object(proxy_logic, "request_archivo", side_effect=delayed(1, make_response(b"archived"))):
+            start = time.time()
+            response = self.request()
+        self.assertIsNone(response)
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_background_refresh_does_not_use_the_request(self):
+        self.wrapped_request.is_head_request.return_value = False
+        submitted = []
+        pool = Mock()
+        pool.submit.side_effect = submitted.append
+        with patch.object(fetch_pool, "FETCH_POOL", pool):
+            proxy_logic.refresh_latest_archived(
+                self.wrapped_request, {}, "http://example.org/onto", "ttl", ("key",)
+            )
+        # proxy.py reuses the request parser once the stale copy is sent
+        self.wrapped_request.is_get_request.side_effect = AssertionError("request used after its response")
+        self.wrapped_request.is_head_request.side_effect = AssertionError("request used after its response")
+        with self.archivo("https"):
+            submitted[0]()
+        self.assertEqual(response_cache.RESPONSE_CACHE.get(("key",)).content, b"archived")
+
+    def test_learned_scheme_is_requested_first(self):
+        scheme_preference.SCHEME_PREFERENCES.learn("https://example.org/onto")
+        with self.archivo("https"):
+            self.assertEqual(self.request().content, b"archived")
+        self.assertEqual(self.requested_urls, [f"{proxy_logic.archivo_api}?o=https://example.org/onto&f=ttl"])
+
+    def test_index_scheme_falls_back_to_other_form(self):
+        self.wrapped_request.archivo_iri = "http://example.org/onto"
+        with self.archivo("https"):
+            self.assertEqual(self.request().content, b"archived")
+        self.assertEqual(len(self.requested_urls), 2)
+        self.assertIn("o=http://", self.requested_urls[0])
+        self.assertEqual(scheme_preference.SCHEME_PREFERENCES.get("http://example.org/onto"), "https")
+
+
+class TestFetchDegraded(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapped_request = Mock()
+        self.wrapped_request.is_get_request.return_value = True
+        self.wrapped_request.get_request_headers.return_value = {}
+        self.wrapped_request.get_request_url_host_path.return_value = (
+            "http://example.org/onto", "example.org", "/onto"
+        )
+        self.wrapped_request.get_request_headers.return_value = {}
+        self.negotiation = AcceptNegotiation("text/turtle", "ttl", ("text/turtle",))
+        patches = [
+            patch.object(response_cache, "RESPONSE_CACHE", ResponseCache(max_bytes=1024, ttl=60)),
+            patch.object(proxy_logic, "is_archivo_ontology_request", return_value=True),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch_degraded(self, onto_version):
+        config = proxy_logic.Config(ontoVersion=onto_version)
+        with patch.object(proxy_logic, "request_ontology", return_value=make_response(b"original")) as original, \
+                patch.object(proxy_logic, "request_archivo") as archivo:
+            response = proxy_logic.fetch_degraded(self.wrapped_request, {}, config, self.negotiation)
+        archivo.assert_not_called()
+        return response, original.call_count
+
+    def test_latest_archived_serves_only_cached_copies(self):
+        response, _ = self.fetch_degraded(OntoVersion.LATEST_ARCHIVED)
+        self.assertEqual(response.status_code, 503)
+        key = proxy_logic.archivo_cache_key("http://example.org/onto", "ttl", OntoVersion.LATEST_ARCHIVED)
+        response_cache.RESPONSE_CACHE.put(key, make_response(b"archived"))
+        response, original_calls = self.fetch_degraded(OntoVersion.LATEST_ARCHIVED)
+        self.assertEqual(response.content, b"archived")
+        self.assertEqual(original_calls, 0)
+
+    def test_failover_passes_through_to_the_original(self):
+        response, original_calls = self.fetch_degraded(OntoVersion.ORIGINAL_FAILOVER_LIVE_LATEST)
+        self.assertEqual(response.content, b"original")
+        self.assertEqual(original_calls, 1)
+
+
+class TestInterceptedRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapped_request = Mock()
+        self.wrapped_request.is_head_request.return_value = False
+        self.wrapped_request.get_request_headers.return_value = {}
+        self.wrapped_request.get_request_url_host_path.return_value = (
+            "https://example.org/page", "example.org", "/page"
+        )
+
+    def test_restricted_access_denial_is_not_passed_through(self):
+        config = proxy_logic.Config(restrictedAccess=True)
+        with patch.object(proxy_logic, "is_archivo_ontology_request", return_value=False), \
+                patch.object(proxy_logic, "upstream_request") as upstream:
+            response = proxy_logic.get_response_from_intercepted_request(self.wrapped_request, config)
+        self.assertEqual(response.status_code, 403)
+        upstream.assert_not_called()
+
+    def test_upstream_error_is_passed_through(self):
+        with patch.object(proxy_logic, "proxy_logic", return_value=make_response(b"", 500)), \
+                patch.object(proxy_logic, "request_ontology", return_value=make_response(b"original")) as original:
+            response = proxy_logic.get_response_from_intercepted_request(
+                self.wrapped_request, proxy_logic.Config()
+            )
+        self.assertEqual(response.content, b"original")
+        self.assertEqual(original.call_count, 1)
+
+
+class TestRequestOntology(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapped_request = Mock()
+        self.wrapped_request.is_head_request.return_value = False
+        self.health = HostHealth(
+            min_timeout=0.5, max_timeout=5, failure_threshold=2, open_seconds=60
+        )
+        patcher = patch.object(host_health, "HOST_HEALTH", self.health)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self):
+        return proxy_logic.request_ontology(self.wrapped_request, "http://example.org/onto", {})
+
+    def test_open_circuit_fails_fast(self):
+        with patch.object(proxy_logic, "upstream_request", side_effect=requests.ConnectionError) as upstream:
+            self.assertIsNone(self.request())
+            self.assertIsNone(self.request())
+            self.assertIsNone(self.request())
+        self.assertEqual(upstream.call_count, 2)
+        self.assertEqual(self.health.circuit("example.org"), "open")
+
+    def test_timeout_follows_observed_latency(self):
+        with patch.object(proxy_logic, "upstream_request", return_value=make_response(b"onto")) as upstream:
+            self.request()
+            self.assertEqual(upstream.call_args.args[4], 3.0)
+            self.request()
+        # the first request took far less than a second
+        self.assertEqual(upstream.call_args.args[4], 0.5)
+
+    def test_gateway_errors_count_as_failures(self):
+        with patch.object(proxy_logic, "upstream_request", return_value=make_response(b"", 503)):
+            self.assertEqual(self.request().status_code, 503)
+            self.request()
+        self.assertEqual(self.health.circuit("example.org"), "open")
+
+    def test_full_queue_is_answered_with_503(self):
+        limiter = UpstreamLimiter(max_concurrent=1, max_per_host=1, max_queue=0, queue_timeout=3)
+        limiter.acquire("example.org")
+        with patch.object(upstream_limits, "UPSTREAM_LIMITER", limiter), \
+                patch.object(proxy_logic, "upstream_request") as upstream:
+            response = self.request()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "3")
+        upstream.assert_not_called()
+
+    def test_slot_is_released_after_failure(self):
+        limiter = UpstreamLimiter(max_concurrent=1, max_per_host=1, max_queue=0, queue_timeout=3)
+        with patch.object(upstream_limits, "UPSTREAM_LIMITER", limiter), \
+                patch.object(proxy_logic, "upstream_request", side_effect=requests.ConnectionError):
+            self.assertIsNone(self.request())
+        self.assertEqual(limiter.stats()["active"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
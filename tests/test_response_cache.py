@@ -0,0 +1,135 @@
+import unittest
+from unittest.mock import Mock, patch
+import requests
+
+from ontologytimemachine.utils import response_cache
+from ontologytimemachine.utils.response_cache import (
+    ResponseCache,
+    conditional_response,
+    store_cached_response,
+)
+
+
+def make_response(content, status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = "https://archivo.dbpedia.org/download"
+    response.headers["Content-Type"] = "text/turtle"
+    response._content = content
+    return response
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_hit_and_miss_counters(self):
+        cache = ResponseCache(max_bytes=1024, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", make_response(b"foo"))
+        response = cache.get("a")
+        self.assertEqual(response.content, b"foo")
+        self.assertEqual(response.headers["Content-Type"], "text/turtle")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_lru_eviction_by_size(self):
+        cache = ResponseCache(max_bytes=10, ttl=60)
+        cache.put("a", make_response(b"aaaa"))
+        cache.put("b", make_response(b"bbbb"))
+        cache.get("a")  # a is now the most recently used entry
+        cache.put("c", make_response(b"cccc"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats()["bytes"], 8)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_too_large_entry_is_not_cached(self):
+        cache = ResponseCache(max_bytes=2, ttl=60)
+        self.assertFalse(cache.put("a", make_response(b"abc")))
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl_expiry(self):
+        cache = ResponseCache(max_bytes=1024, ttl=10)
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=100):
+            cache.put("a", make_response(b"foo"))
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=105):
+            self.assertIsNotNone(cache.get("a"))
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=111):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_entries_without_ttl_never_expire(self):
+        cache = ResponseCache(max_bytes=1024, ttl=None)
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=100):
+            cache.put("a", make_response(b"foo"))
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=10**10):
+            self.assertIsNotNone(cache.get("a"))
+
+    def test_stale_entries_within_hard_ttl(self):
+        cache = ResponseCache(max_bytes=1024, ttl=10, hard_ttl=100)
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=100):
+            cache.put("a", make_response(b"foo"))
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=105):
+            self.assertFalse(cache.get("a").stale)
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=150):
+            self.assertIsNone(cache.get("a"))
+            response = cache.get("a", allow_stale=True)
+            self.assertTrue(response.stale)
+            self.assertEqual(response.stored_at, 100)
+        with patch("ontologytimemachine.utils.response_cache.time.time", return_value=250):
+            self.assertIsNone(cache.get("a", allow_stale=True))
+            # kept as last good copy after the hard ttl
+            self.assertEqual(cache.get_last_good("a").content, b"foo")
+        self.assertEqual(len(cache), 1)
+
+
+class TestConditionalResponse(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(response_cache, "RESPONSE_CACHE", ResponseCache(max_bytes=1024, ttl=60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_request(self, headers):
+        wrapped_request = Mock()
+        wrapped_request.is_get_request.return_value = True
+        wrapped_request.get_request_headers.return_value = headers
+        return wrapped_request
+
+    def test_stored_responses_carry_validators(self):
+        response = store_cached_response(self.make_request({}), "a", make_response(b"foo"))
+        self.assertEqual(
+            response.headers["ETag"],
+            '"2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae"',
+        )
+        self.assertIn("Last-Modified", response.headers)
+        cached = response_cache.RESPONSE_CACHE.get("a")
+        self.assertEqual(cached.headers["ETag"], response.headers["ETag"])
+        self.assertEqual(cached.headers["Last-Modified"], response.headers["Last-Modified"])
+
+    def test_refresh_with_same_body_keeps_last_modified(self):
+        first_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+        with patch.object(response_cache, "formatdate", return_value=first_modified):
+            store_cached_response(self.make_request({}), "a", make_response(b"foo"))
+        refreshed = store_cached_response(self.make_request({}), "a", make_response(b"foo"))
+        self.assertEqual(refreshed.headers["Last-Modified"], first_modified)
+        changed = store_cached_response(self.make_request({}), "a", make_response(b"bar"))
+        self.assertNotEqual(changed.headers["Last-Modified"], first_modified)
+
+    def test_matching_etag_is_answered_with_304(self):
+        response = store_cached_response(self.make_request({}), "a", make_response(b"foo"))
+        wrapped_request = self.make_request({"If-None-Match": response.headers["ETag"]})
+        not_modified = conditional_response(wrapped_request, response_cache.RESPONSE_CACHE.get("a"))
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b"")
+        self.assertEqual(not_modified.headers["ETag"], response.headers["ETag"])
+        self.assertNotIn("Content-Type", not_modified.headers)
+
+    def test_other_etag_gets_full_response(self):
+        response = store_cached_response(self.make_request({}), "a", make_response(b"foo"))
+        wrapped_request = self.make_request({"If-None-Match": '"other"'})
+        self.assertIs(conditional_response(wrapped_request, response), response)
+
+
+if __name__ == "__main__":
+    unittest.main()
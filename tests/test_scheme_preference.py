@@ -0,0 +1,67 @@
+import os
+import tempfile
+import time
+import unittest
+
+from ontologytimemachine.utils.scheme_preference import SchemePreferences, split_scheme
+
+
+class TestSchemePreferences(unittest.TestCase):
+
+    def test_split_scheme(self):
+        self.assertEqual(split_scheme("HTTPS://example.org/onto"), ("https", "example.org/onto"))
+        self.assertEqual(split_scheme("example.org/onto"), ("", "example.org/onto"))
+
+    def test_preference_is_shared_by_both_forms(self):
+        preferences = SchemePreferences()
+        self.assertIsNone(preferences.get("http://example.org/onto"))
+        preferences.learn("https://example.org/onto")
+        self.assertEqual(preferences.get("http://example.org/onto"), "https")
+        preferences.learn("http://example.org/onto")
+        self.assertEqual(preferences.get("https://example.org/onto"), "http")
+
+    def test_preferences_survive_reload(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "schemes.json")
+            preferences = SchemePreferences(path)
+            preferences.learn("https://example.org/onto")
+            preferences.save()
+            self.assertEqual(SchemePreferences(path).get("http://example.org/onto"), "https")
+
+    def test_changes_are_saved_in_the_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "schemes.json")
+            preferences = SchemePreferences(path, save_delay=0.2)
+            preferences.learn("https://example.org/a")
+            preferences.learn("https://example.org/b")
+            # learn() does not write the file itself
+            self.assertFalse(os.path.exists(path))
+            deadline = time.time() + 5
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(len(SchemePreferences(path)), 2)
+
+    def test_workers_merge_their_preferences(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "schemes.json")
+            first, second = SchemePreferences(path), SchemePreferences(path)
+            first.learn("https://example.org/a")
+            second.learn("http://example.org/b")
+            first.save()
+            second.save()
+            # the second worker took over the preference saved by the first
+            self.assertEqual(second.get("http://example.org/a"), "https")
+            reloaded = SchemePreferences(path)
+            self.assertEqual(reloaded.get("https://example.org/a"), "https")
+            self.assertEqual(reloaded.get("https://example.org/b"), "http")
+
+    def test_oldest_entries_are_dropped(self):
+        preferences = SchemePreferences(max_entries=1)
+        preferences.learn("https://example.org/a")
+        preferences.learn("https://example.org/b")
+        self.assertIsNone(preferences.get("http://example.org/a"))
+        self.assertEqual(len(preferences), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+
+from ontologytimemachine.utils.single_flight import SingleFlight, SingleFlightTimeout
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_concurrently(self, flight, key, fn, count, share=None):
+        results = []
+        errors = []
+
+        def worker():
+            try:
+                results.append(flight.do(key, fn, share))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight(timeout=5)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return "ontology"
+
+        results, errors = self.run_concurrently(flight, "key", fetch, 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(errors, [])
+        self.assertEqual([result for result, _ in results], ["ontology"] * 5)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True, True])
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_error_is_propagated_to_waiters(self):
+        flight = SingleFlight(timeout=5)
+
+        def fetch():
+            time.sleep(0.2)
+            raise ValueError("upstream failed")
+
+        results, errors = self.run_concurrently(flight, "key", fetch, 3)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+
+    def test_waiter_timeout(self):
+        flight = SingleFlight(timeout=0.05)
+
+        def fetch():
+            time.sleep(0.5)
+            return "ontology"
+
+        results, errors = self.run_concurrently(flight, "key", fetch, 2)
+        self.assertEqual(results, [("ontology", False)])
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], SingleFlightTimeout)
+
+    def test_share_hands_out_one_result_per_caller(self):
+        flight = SingleFlight(timeout=5)
+        shares = []
+
+        def fetch():
+            time.sleep(0.2)
+            return "ontology"
+
+        def share(result, callers):
+            shares.append(callers)
+            return [f"{result} {index}" for index in range(callers)]
+
+        results, errors = self.run_concurrently(flight, "key", fetch, 4, share)
+        self.assertEqual(errors, [])
+        self.assertEqual(shares, [4])
+        self.assertEqual(sorted(result for result, _ in results), [f"ontology {index}" for index in range(4)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import io
+import threading
+import unittest
+
+import requests
+
+from ontologytimemachine.utils.streaming import (
+    END_OF_STREAM,
+    ResponseStream,
+    SharedBody,
+    buffer_or_stream,
+    is_streamed,
+)
+
+
+def make_response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(body)
+    return response
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_small_body_is_buffered(self):
+        response = buffer_or_stream(make_response(b"x" * 100), 1024)
+        self.assertFalse(is_streamed(response))
+        self.assertEqual(response.content, b"x" * 100)
+
+    def test_large_body_is_streamed(self):
+        body = bytes(range(256)) * 1024
+        response = buffer_or_stream(make_response(body), 1024)
+        self.assertTrue(is_streamed(response))
+        self.assertEqual(b"".join(response.body_chunks), body)
+
+    def test_stream_is_bounded(self):
+        body = b"x" * (64 * 1024 * 10)
+        response = buffer_or_stream(make_response(body), 1024)
+        wakeups = threading.Semaphore(0)
+        stream = ResponseStream(response, 2, wakeups.release)
+        pump = threading.Thread(target=stream.pump)
+        pump.start()
+        received = []
+        while True:
+            wakeups.acquire()
+            # the producer never runs more than two chunks ahead of the consumer
+            self.assertLessEqual(stream._chunks.qsize(), 2)
+            chunk = stream.get()
+            if chunk is END_OF_STREAM:
+                break
+            if chunk is not None:
+                received.append(chunk)
+        pump.join()
+        self.assertIsNone(stream.error)
+        self.assertEqual(b"".join(received), body)
+
+    def test_close_stops_producer(self):
+        response = buffer_or_stream(make_response(b"x" * (64 * 1024 * 10)), 1024)
+        stream = ResponseStream(response, 1, lambda: None)
+        pump = threading.Thread(target=stream.pump)
+        pump.start()
+        stream.close()
+        pump.join(timeout=2)
+        self.assertFalse(pump.is_alive())
+
+    def test_shared_body_is_read_once(self):
+        body = bytes(range(256)) * 1024
+        response = buffer_or_stream(make_response(body), 1024)
+        reads = []
+        chunks = response.body_chunks
+
+        def read_chunks():
+            for chunk in chunks:
+                reads.append(len(chunk))
+                yield chunk
+
+        response.body_chunks = read_chunks()
+        shared = SharedBody(response, 3).responses()
+        received = [None] * 3
+
+        def read(index):
+            received[index] = b"".join(shared[index].body_chunks)
+            shared[index].close()
+
+        threads = [threading.Thread(target=read, args=(index,)) for index in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(received, [body] * 3)
+        self.assertEqual(sum(reads), len(body))
+
+    def test_shared_body_closes_upstream_with_last_reader(self):
+        response = buffer_or_stream(make_response(b"x" * (64 * 1024 * 10)), 1024)
+        first, second = SharedBody(response, 2).responses()
+        next(first.body_chunks)
+        first.close()
+        self.assertFalse(response.raw.closed)
+        second.close()
+        self.assertTrue(response.raw.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ontologytimemachine.utils.streaming import buffer_or_stream, is_streamed
+from ontologytimemachine.utils.upstream import AsyncUpstream, SessionUpstream
+
+
+LARGE_BODY = b"<a> <b> <c> .\n" * 50000
+
+
+class OntologyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/ontology")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = LARGE_BODY if self.path == "/large" else b"<a> <b> <c> ."
+        self.send_response(200)
+        self.send_header("Content-Type", "text/turtle")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestUpstream(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), OntologyHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_async_upstream_returns_requests_response(self):
+        upstream = AsyncUpstream(False, 10, 5, 5.0)
+        try:
+            response = upstream.request("GET", self.base_url + "/ontology", {}, True, 3)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b"<a> <b> <c> .")
+            self.assertEqual(response.headers["content-type"], "text/turtle")
+        finally:
+            upstream.close()
+
+    def test_async_upstream_redirect_handling(self):
+        upstream = AsyncUpstream(False, 10, 5, 5.0)
+        try:
+            response = upstream.request("GET", self.base_url + "/redirect", {}, False, 3)
+            self.assertEqual(response.status_code, 302)
+            response = upstream.request("GET", self.base_url + "/redirect", {}, True, 3)
+            self.assertEqual(response.status_code, 200)
+        finally:
+            upstream.close()
+
+    def test_streamed_bodies(self):
+        for upstream in (AsyncUpstream(False, 10, 5, 5.0), SessionUpstream(10, 5, 30.0)):
+            try:
+                response = buffer_or_stream(
+                    upstream.request("GET", self.base_url + "/ontology", {}, True, 3, stream=True), 1024
+                )
+                self.assertFalse(is_streamed(response))
+                self.assertEqual(response.content, b"<a> <b> <c> .")
+                response = buffer_or_stream(
+                    upstream.request("GET", self.base_url + "/large", {}, True, 3, stream=True), 1024
+                )
+                self.assertTrue(is_streamed(response))
+                self.assertEqual(b"".join(response.body_chunks), LARGE_BODY)
+                response.close()
+            finally:
+                upstream.close()
+
+    def test_session_upstream_reuses_connections(self):
+        upstream = SessionUpstream(10, 5, 30.0)
+        try:
+            for _ in range(3):
+                response = upstream.request("GET", self.base_url + "/ontology", {}, True, 3)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, b"<a> <b> <c> .")
+            (pool_stats,) = upstream.stats().values()
+            self.assertEqual(pool_stats["connections_opened"], 1)
+            self.assertEqual(pool_stats["requests"], 3)
+            self.assertEqual(pool_stats["idle_connections"], 1)
+        finally:
+            upstream.close()
+
+    def test_session_upstream_reaps_idle_pools(self):
+        upstream = SessionUpstream(10, 5, 0.0)
+        try:
+            upstream.request("GET", self.base_url + "/ontology", {}, True, 3)
+            self.assertEqual(len(upstream.stats()), 1)
+            self.assertEqual(upstream.reap_idle_connections(), 1)
+            self.assertEqual(upstream.stats(), {})
+        finally:
+            upstream.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import threading
+import unittest
+
+from ontologytimemachine.utils.upstream_limits import UpstreamLimiter
+
+
+class TestUpstreamLimiter(unittest.TestCase):
+
+    def test_per_host_limit_leaves_other_hosts_alone(self):
+        limiter = UpstreamLimiter(max_concurrent=10, max_per_host=1, max_queue=0, queue_timeout=1)
+        self.assertTrue(limiter.acquire("archivo.dbpedia.org"))
+        self.assertFalse(limiter.acquire("archivo.dbpedia.org"))
+        self.assertTrue(limiter.acquire("example.org"))
+        limiter.release("archivo.dbpedia.org")
+        self.assertTrue(limiter.acquire("archivo.dbpedia.org"))
+        self.assertEqual(limiter.stats()["active"], 2)
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_waiting_request_gets_released_slot(self):
+        limiter = UpstreamLimiter(max_concurrent=1, max_per_host=0, max_queue=1, queue_timeout=5)
+        self.assertTrue(limiter.acquire("a"))
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(limiter.acquire("b")))
+        waiter.start()
+        while limiter.stats()["waiting"] == 0:
+            pass
+        # the queue holds a single waiting request
+        self.assertFalse(limiter.acquire("c"))
+        limiter.release("a")
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter.stats(), {"active": 1, "waiting": 0, "rejected": 1, "hosts": 1})
+
+    def test_wait_times_out(self):
+        limiter = UpstreamLimiter(max_concurrent=1, max_per_host=0, max_queue=1, queue_timeout=0.05)
+        self.assertTrue(limiter.acquire("a"))
+        self.assertFalse(limiter.acquire("b"))
+        self.assertEqual(limiter.retry_after, 1)
+
+    def test_zero_disables_the_limits(self):
+        limiter = UpstreamLimiter(max_concurrent=0, max_per_host=0, max_queue=0, queue_timeout=0)
+        for _ in range(100):
+            self.assertTrue(limiter.acquire("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,15 @@ from ontologytimemachine.utils.utils import (
     select_highest_priority_mime_from_archivo,
     parse_accept_header_with_priority,
     set_onto_format_headers,
+    negotiate_accept_header,
+    is_not_modified,
+)
+from ontologytimemachine.utils.config import (
+    Config,
+    OntoFormat,
+    OntoFormatConfig,
+    OntoPrecedence,
+    OntoVersion,
 )
 
 
@@ -96,6 +105,52 @@ class TestUtils(unittest.TestCase):
         format = get_format_from_accept_header(headers)
         self.assertEqual(format, "ttl")
 
+    def test_negotiate_accept_header(self):
+        conf = OntoFormatConfig(OntoFormat.TURTLE, OntoPrecedence.ENFORCED_PRIORITY)
+        negotiation = negotiate_accept_header("*/*", conf, OntoVersion.LATEST_ARCHIVED)
+        self.assertEqual(negotiation.accept_header, "text/turtle")
+        self.assertEqual(negotiation.format, "ttl")
+        self.assertEqual(negotiation.requested_mimetypes, ("text/turtle",))
+        self.assertIs(negotiate_accept_header("*/*", conf, OntoVersion.LATEST_ARCHIVED), negotiation)
+
+        negotiation = negotiate_accept_header("application/json", conf, OntoVersion.LATEST_ARCHIVED)
+        self.assertEqual(negotiation.accept_header, "application/json")
+        self.assertIsNone(negotiation.format)
+
+        negotiation = negotiate_accept_header("", conf, OntoVersion.ORIGINAL)
+        self.assertEqual(negotiation.accept_header, "")
+        self.assertIsNone(negotiation.format)
+
+    def test_set_onto_format_headers_patches_request(self):
+        wrapped_request = Mock()
+        wrapped_request.get_request_accept_header.return_value = ""
+        config = Config(ontoFormatConf=OntoFormatConfig(OntoFormat.RDFXML))
+        negotiation = set_onto_format_headers(wrapped_request, config)
+        wrapped_request.set_request_accept_header.assert_called_once_with("application/rdf+xml")
+        self.assertEqual(negotiation.format, "owl")
+
+    def test_is_not_modified(self):
+        response_headers = {"ETag": '"abc"', "Last-Modified": "Tue, 01 Oct 2024 10:00:00 GMT"}
+        self.assertTrue(is_not_modified({"if-none-match": '"abc"'}, response_headers))
+        self.assertTrue(is_not_modified({"If-None-Match": 'W/"xyz", W/"abc"'}, response_headers))
+        self.assertTrue(is_not_modified({"If-None-Match": "*"}, response_headers))
+        self.assertFalse(is_not_modified({"If-None-Match": '"xyz"'}, response_headers))
+        # If-None-Match takes precedence over If-Modified-Since
+        self.assertFalse(
+            is_not_modified(
+                {"If-None-Match": '"xyz"', "If-Modified-Since": "Wed, 02 Oct 2024 10:00:00 GMT"},
+                response_headers,
+            )
+        )
+        self.assertTrue(
+            is_not_modified({"If-Modified-Since": "Tue, 01 Oct 2024 10:00:00 GMT"}, response_headers)
+        )
+        self.assertFalse(
+            is_not_modified({"If-Modified-Since": "Mon, 30 Sep 2024 10:00:00 GMT"}, response_headers)
+        )
+        self.assertFalse(is_not_modified({"If-Modified-Since": "yesterday"}, response_headers))
+        self.assertFalse(is_not_modified({}, response_headers))
+
 
 if __name__ == "__main__":
     unittest.main()